@@ -0,0 +1,360 @@
+"""
+cache of decoded FIT files
+
+every message a decoder reports (all of its fields, not only the ones that are exported)
+is kept in one binary file per FIT file, keyed by the file's content hash and the
+decoder version, so converting a file again (with --fit-overwrite, other options or
+another set of exported fields) does not decode it again
+
+messages with the same type and field names are stored together as columns: numbers
+and times as numpy arrays of the narrowest type that holds them exactly, strings as one
+utf-8 blob with offsets, and anything else (such as the tuples of array fields) as json
+with its types tagged, plus the order the messages came in. Loading reads the file once
+and turns the columns back into the same (name, value) pairs. Nothing is unpickled, so
+a cache file can at worst make for wrong outputs; a file with values json cannot hold
+is not cached
+
+files are evicted least recently used first (a hit touches the file's mtime) once the
+cache is over its size limit
+"""
+
+import array
+import datetime
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'fit_processing', 'activities')
+CACHE_SUFFIX = '.fitcache'
+DEFAULT_MAX_MB = 1024
+
+# once over its limit, the cache is evicted down to this fraction of it, so it is not
+# scanned again on every file stored
+EVICT_TO = 0.9
+
+_MAGIC = b'FITC'
+_VERSION = 2
+# magic, version, metadata size
+_HEADER = struct.Struct('<4sII')
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_INT_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _to_json(value):
+    """
+    value as json; types json has no equivalent for are tagged
+    """
+    if value is None or type(value) in (bool, int, float, str):
+        return value
+    elif type(value) is tuple:
+        return {'tuple': [_to_json(item) for item in value]}
+    elif type(value) is list:
+        return {'list': [_to_json(item) for item in value]}
+    elif type(value) is bytes:
+        return {'bytes': value.hex()}
+    elif type(value) is datetime.datetime and value.tzinfo is None:
+        return {'datetime': (value - _EPOCH) // _MICROSECOND}
+    raise ValueError('cannot cache a %s' % type(value).__name__)
+
+
+def _from_json(value):
+    if type(value) is not dict:
+        return value
+    (tag, item), = value.items()
+    if tag == 'tuple':
+        return tuple(_from_json(part) for part in item)
+    elif tag == 'list':
+        return [_from_json(part) for part in item]
+    elif tag == 'bytes':
+        return bytes.fromhex(item)
+    elif tag == 'datetime':
+        return _EPOCH + item * _MICROSECOND
+    raise ValueError('not a cached value: %r' % value)
+
+
+def _encode_column(values):
+    """
+    (kind, [arrays]) holding values; None is kept in a mask after the data
+    """
+    present = [value for value in values if value is not None]
+    mask = None
+    if len(present) < len(values):
+        mask = np.array([value is not None for value in values], dtype=np.bool_)
+    types = set(type(value) for value in present)
+    if not present:
+        return 'none', []
+    if types == {int}:
+        try:
+            data = np.array(present, dtype=np.int64)
+        except OverflowError:
+            data = None
+        if data is not None:
+            for dtype in _INT_DTYPES:
+                info = np.iinfo(dtype)
+                if data.min() >= info.min and data.max() <= info.max:
+                    data = data.astype(dtype)
+                    break
+            return 'int', [data] + ([mask] if mask is not None else [])
+    elif types == {float}:
+        data = np.array(present, dtype=np.float64)
+        narrow = data.astype(np.float32)
+        if np.array_equal(narrow.astype(np.float64), data, equal_nan=True):
+            data = narrow
+        return 'float', [data] + ([mask] if mask is not None else [])
+    elif types == {datetime.datetime} and all(value.tzinfo is None for value in present):
+        data = np.array([(value - _EPOCH) // _MICROSECOND for value in present], dtype=np.int64)
+        return 'datetime', [data] + ([mask] if mask is not None else [])
+    elif types == {str}:
+        encoded = [value.encode('utf-8', 'surrogatepass') for value in present]
+        offsets = np.cumsum([0] + [len(value) for value in encoded], dtype=np.int64)
+        data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return 'str', [data, offsets] + ([mask] if mask is not None else [])
+    data = json.dumps([_to_json(value) for value in values]).encode('ascii')
+    return 'json', [np.frombuffer(data, dtype=np.uint8)]
+
+
+def _decode_column(kind, arrays, length):
+    if kind == 'none':
+        return [None] * length
+    if kind == 'json':
+        return [_from_json(value)
+                for value in json.loads(arrays[0].tobytes().decode('ascii'))]
+    if kind == 'str':
+        data, offsets = arrays[0].tobytes(), arrays[1].tolist()
+        present = [data[start:end].decode('utf-8', 'surrogatepass')
+                   for start, end in zip(offsets[:-1], offsets[1:])]
+        mask = arrays[2] if len(arrays) > 2 else None
+    else:
+        data = arrays[0]
+        if kind == 'datetime':
+            present = data.astype('datetime64[us]').astype(object).tolist()
+        else:
+            present = data.tolist()
+        mask = arrays[1] if len(arrays) > 1 else None
+    if mask is None:
+        return present
+    values = [None] * length
+    for index, value in zip(np.flatnonzero(mask).tolist(), present):
+        values[index] = value
+    return values
+
+
+class RecordingFitFile(object):
+    """
+    passes (message name, [(field name, value), ...]) pairs through from messages while
+    collecting them by type and field names, to be stored once the file is converted
+    """
+
+    def __init__(self, messages):
+        self._messages = messages
+        # (message name, field names) -> index, and the value columns of each
+        self.shapes = {}
+        self.columns = []
+        self.order = array.array('I')
+
+    def iter_message_fields(self):
+        shapes = self.shapes
+        columns = self.columns
+        order = self.order
+        for message in self._messages:
+            name, fields = message
+            shape = (name, tuple(field_name for field_name, _ in fields))
+            index = shapes.get(shape)
+            if index is None:
+                index = shapes[shape] = len(columns)
+                columns.append([[] for _ in fields])
+            for column, (_, value) in zip(columns[index], fields):
+                column.append(value)
+            order.append(index)
+            yield message
+
+
+class CachedActivity(object):
+    """
+    the messages of a cache file; iter_message_fields yields them as the decoder that
+    filled it (decoder_version) did
+    """
+
+    def __init__(self, data):
+        magic, version, metadata_size = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('not an activity cache file of version %d' % _VERSION)
+        metadata = json.loads(bytes(data[_HEADER.size:_HEADER.size + metadata_size]).decode('utf-8'))
+        self.decoder_version = metadata['decoder_version']
+        self.shapes = [(name, field_names) for name, field_names in metadata['shapes']]
+
+        # offsets count from the start of the sections, after the metadata
+        start = _align(_HEADER.size + metadata_size)
+
+        def section(dtype, offset, count):
+            return np.frombuffer(data, dtype=dtype, count=count, offset=start + offset)
+
+        self.order = section(np.uint32, *metadata['order'])
+        self.columns = [[(kind, [section(dtype, offset, count) for dtype, offset, count in arrays])
+                         for kind, arrays in shape_columns]
+                        for shape_columns in metadata['columns']]
+
+    def iter_message_fields(self):
+        counts = np.bincount(self.order, minlength=len(self.shapes)).tolist()
+        rows = []
+        for (name, field_names), shape_columns, count in zip(self.shapes, self.columns, counts):
+            values = [_decode_column(kind, arrays, count) for kind, arrays in shape_columns]
+            rows.append(iter(zip(*values)) if values else iter([()] * count))
+        for index in self.order.tolist():
+            name, field_names = self.shapes[index]
+            yield name, list(zip(field_names, next(rows[index])))
+
+
+def serialize(recording, decoder_version):
+    """
+    the bytes of the cache file for a RecordingFitFile
+    """
+    shapes = sorted(recording.shapes.items(), key=lambda item: item[1])
+    # (offset, array) of each section, and where the next one goes
+    sections = []
+    end = 0
+
+    def add(data):
+        nonlocal end
+        data = np.ascontiguousarray(data)
+        sections.append((_align(end), data))
+        end = _align(end) + data.nbytes
+        return [data.dtype.str, sections[-1][0], len(data)]
+
+    order = add(np.frombuffer(recording.order, dtype=np.uint32))[1:]
+    columns = []
+    for (name, field_names), index in shapes:
+        shape_columns = []
+        for values in recording.columns[index]:
+            kind, arrays = _encode_column(values)
+            shape_columns.append([kind, [add(data) for data in arrays]])
+        columns.append(shape_columns)
+    metadata = json.dumps({
+        'decoder_version': decoder_version,
+        'shapes': [[name, list(field_names)] for (name, field_names), _ in shapes],
+        'order': order,
+        'columns': columns,
+    }).encode('utf-8')
+    start = _align(_HEADER.size + len(metadata))
+    out = bytearray(start + end)
+    _HEADER.pack_into(out, 0, _MAGIC, _VERSION, len(metadata))
+    out[_HEADER.size:_HEADER.size + len(metadata)] = metadata
+    for section_offset, data in sections:
+        out[start + section_offset:start + section_offset + data.nbytes] = data.tobytes()
+    return bytes(out)
+
+
+class ActivityCache(object):
+    """
+    a directory of cache files of at most max_bytes (about; see EVICT_TO)
+
+    files stored by worker processes are counted through pop_changes()/merge(), so that a
+    single process evicts
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=DEFAULT_MAX_MB * 1000000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes in the cache, counted by count()
+        self.size = 0
+        self._stored = 0
+
+    def path(self, content_hash, decoder_version):
+        return os.path.join(self.directory, '%s-%s%s' % (
+            content_hash, re.sub(r'[^0-9A-Za-z.]+', '_', decoder_version), CACHE_SUFFIX))
+
+    def load(self, content_hash, decoder_version):
+        """
+        the CachedActivity of a file, or None if it is not cached
+        """
+        path = self.path(content_hash, decoder_version)
+        try:
+            with open(path, 'rb') as f:
+                cached = CachedActivity(f.read())
+            os.utime(path)
+        except (OSError, ValueError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached
+
+    def store(self, content_hash, decoder_version, recording, used_decoder_version):
+        """
+        stores the messages of a RecordingFitFile, decoded by used_decoder_version (which
+        can be a fallback of decoder_version), unless it has values that cannot be cached
+        """
+        try:
+            data = serialize(recording, used_decoder_version)
+        except ValueError:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        path = self.path(content_hash, decoder_version)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.replace(temporary, path)
+        self._stored += len(data)
+
+    def pop_changes(self):
+        """
+        bytes stored and hit/miss counts since the last call
+        """
+        changes = (self._stored, self.hits, self.misses)
+        self._stored = 0
+        self.hits = 0
+        self.misses = 0
+        return changes
+
+    def merge(self, changes):
+        stored, hits, misses = changes
+        self.hits += hits
+        self.misses += misses
+        self.size += stored
+        if self.size > self.max_bytes:
+            self.evict(int(self.max_bytes * EVICT_TO))
+
+    def count(self):
+        """
+        counts the bytes already in the cache; done before any files are stored
+        """
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        # (path, size, mtime) of every cache file
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        return entries
+
+    def evict(self, max_bytes):
+        """
+        removes the least recently used files until at most max_bytes are left
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
@@ -0,0 +1,252 @@
+"""
+incremental archives of processed data
+
+a zip is updated rather than rebuilt: a new copy is written with the unchanged members'
+compressed bytes copied over as they are, and renamed over the old one, so only new
+and changed members are compressed and an interrupted update leaves the old archive. Files are deflated in parallel threads (zlib releases the
+GIL) and written in order. tar.zst archives (which need the zstandard package) are
+always rebuilt, using zstd's own threads.
+
+each archive's members are listed, with their size and mtime, in the manifest of the
+directory the archive is written to; members of a censored archive are named like the
+censor stage's manifest sources
+"""
+
+import os
+import struct
+import sys
+import tarfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import MANIFEST_FILENAME, Manifest
+from timezone_index import CACHE_FILENAME as TIMEZONE_CACHE_FILENAME
+from track_columns import SIDECAR_SUFFIX
+
+ARCHIVE_FORMATS = ['zip', 'tar.zst']
+
+# bookkeeping, not data
+EXCLUDED_FILENAMES = set([MANIFEST_FILENAME, MANIFEST_FILENAME + '-journal',
+                          TIMEZONE_CACHE_FILENAME])
+EXCLUDED_SUFFIXES = (SIDECAR_SUFFIX,)
+
+ZSTD_LEVEL = 10
+
+# files read ahead of the one being written, per thread
+READ_AHEAD = 2
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+# zipfile has no public way to add data that is already compressed, so _write_compressed
+# does what ZipFile.write does through these attributes, which are the same in every
+# Python from 3.5 to 3.14; elsewhere, or if one is missing, members are decompressed and
+# written with writestr, which compresses them again
+_RAW_WRITE_VERSIONS = ((3, 5), (3, 15))
+_RAW_WRITE_ATTRIBUTES = ['fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify',
+                         '_allowZip64']
+
+
+def archive_extension(archive_format):
+    return '.' + archive_format
+
+
+def list_members(source_dir):
+    """
+    returns [(member name, path, is directory)] for source_dir, sorted; names are relative
+    to source_dir, as with shutil.make_archive(..., root_dir=source_dir)
+    """
+    members = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        prefix = os.path.relpath(dirpath, source_dir)
+        if prefix == os.curdir:
+            prefix = ''
+        else:
+            members.append((prefix + '/', dirpath, True))
+        for filename in sorted(filenames):
+            if filename in EXCLUDED_FILENAMES or filename.endswith(EXCLUDED_SUFFIXES):
+                continue
+            members.append((os.path.join(prefix, filename), os.path.join(dirpath, filename), False))
+    return members
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _deflate(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return zlib.crc32(data), len(data), compressor.compress(data) + compressor.flush()
+
+
+def _can_write_raw(zip_file):
+    return (_RAW_WRITE_VERSIONS[0] <= sys.version_info[:2] < _RAW_WRITE_VERSIONS[1]
+            and all(hasattr(zip_file, attribute) for attribute in _RAW_WRITE_ATTRIBUTES)
+            and not getattr(zip_file, '_writing', False))
+
+
+def _write_compressed(zip_file, zinfo, data):
+    """
+    writes a member whose data is already compressed (deflated, or stored); zipfile itself
+    only writes data it compresses
+    """
+    if not _can_write_raw(zip_file):
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        zip_file.writestr(zinfo, data, zinfo.compress_type)
+        return
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if zip64 and not zip_file._allowZip64:
+        raise zipfile.LargeZipFile('%s would need ZIP64 extensions' % zinfo.filename)
+    zip_file.fp.seek(zip_file.start_dir)
+    zinfo.header_offset = zip_file.start_dir
+    zip_file.fp.write(zinfo.FileHeader(zip64))
+    zip_file.fp.write(data)
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file.filelist.append(zinfo)
+    zip_file.NameToInfo[zinfo.filename] = zinfo
+    zip_file._didModify = True
+
+
+def _raw_member(zip_file, zinfo):
+    """
+    returns the compressed bytes of a member without decompressing them
+    """
+    zip_file.fp.seek(zinfo.header_offset)
+    header = _LOCAL_HEADER.unpack(zip_file.fp.read(_LOCAL_HEADER.size))
+    name_length, extra_length = header[-2:]
+    zip_file.fp.seek(name_length + extra_length, os.SEEK_CUR)
+    return zip_file.fp.read(zinfo.compress_size)
+
+
+def _copy_zinfo(zinfo):
+    copied = zipfile.ZipInfo(zinfo.filename, zinfo.date_time)
+    for attribute in ['compress_type', 'external_attr', 'create_system', 'CRC',
+                      'compress_size', 'file_size', 'comment']:
+        setattr(copied, attribute, getattr(zinfo, attribute))
+    # the sizes go in the local header, so there is no data descriptor after the data
+    copied.flag_bits = zinfo.flag_bits & ~0x08
+    return copied
+
+
+def _add_members(zip_file, members, workers, old_zip=None, reused=()):
+    """
+    writes members in order; files are deflated in parallel, except those named in
+    reused, whose compressed bytes are copied from old_zip
+    """
+    with ThreadPoolExecutor(workers) as pool:
+        pending = deque()
+        for name, path, is_directory in members:
+            if is_directory or name in reused:
+                future = None
+            else:
+                future = pool.submit(_deflate, path)
+            pending.append((name, path, is_directory, future))
+            while len(pending) > READ_AHEAD * workers or (pending and pending[0][3] is None):
+                _write_member(zip_file, *pending.popleft(), old_zip=old_zip, reused=reused)
+        while pending:
+            _write_member(zip_file, *pending.popleft(), old_zip=old_zip, reused=reused)
+
+
+def _write_member(zip_file, name, path, is_directory, future, old_zip=None, reused=()):
+    if name in reused:
+        _write_compressed(zip_file, _copy_zinfo(reused[name]), _raw_member(old_zip, reused[name]))
+        return
+    zinfo = zipfile.ZipInfo.from_file(path, name)
+    if is_directory:
+        zip_file.writestr(zinfo, b'')
+        return
+    zinfo.CRC, zinfo.file_size, data = future.result()
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = len(data)
+    _write_compressed(zip_file, zinfo, data)
+
+
+def update_zip(archive_path, members, previous, workers):
+    """
+    brings the zip at archive_path up to date with members; previous is what the manifest
+    recorded for it last time. returns the number of members (re)compressed
+    """
+    current = dict((name, _fingerprint(path)) for name, path, is_directory in members
+                   if not is_directory)
+    existing = {}
+    if os.path.exists(archive_path):
+        try:
+            with zipfile.ZipFile(archive_path) as zip_file:
+                existing = dict((zinfo.filename, zinfo) for zinfo in zip_file.infolist())
+        except zipfile.BadZipFile:
+            existing = {}
+    unchanged = set(name for name in current
+                    if name in existing and previous.get(name) == current[name])
+    changed = [member for member in members
+               if member[0] not in existing or (not member[2] and member[0] not in unchanged)]
+    names = set(member[0] for member in members)
+    stale = [name for name in existing if name not in names or
+             (name in current and name not in unchanged)]
+
+    if existing and (stale or changed):
+        # even with only new members, a copy is written and renamed over the archive
+        # rather than appending in place, which would leave it without a central directory
+        # if interrupted; copying the unchanged members' compressed bytes is cheap
+        reused = dict((name, existing[name]) for name, path, is_directory in members
+                      if name in existing and (is_directory or name in unchanged))
+        temporary_path = archive_path + '.tmp'
+        with zipfile.ZipFile(archive_path) as old_zip:
+            with zipfile.ZipFile(temporary_path, 'w') as zip_file:
+                _add_members(zip_file, members, workers, old_zip, reused)
+        os.replace(temporary_path, archive_path)
+    elif not existing:
+        temporary_path = archive_path + '.tmp'
+        with zipfile.ZipFile(temporary_path, 'w') as zip_file:
+            _add_members(zip_file, members, workers)
+        os.replace(temporary_path, archive_path)
+    return len([member for member in changed if not member[2]])
+
+
+def write_tar_zst(archive_path, members, workers):
+    # only needed for this format
+    import zstandard
+
+    temporary_path = archive_path + '.tmp'
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=workers)
+    with open(temporary_path, 'wb') as f:
+        with compressor.stream_writer(f) as stream:
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for name, path, is_directory in members:
+                    tar.add(path, arcname=name.rstrip('/'), recursive=False)
+    os.replace(temporary_path, archive_path)
+    return len([member for member in members if not member[2]])
+
+
+def build_archive(archive_output_dir, archive_filename, source_dir, archive_format='zip',
+                  workers=None):
+    """
+    creates or updates archive_output_dir/archive_filename.<format> from source_dir and
+    records its members in archive_output_dir's manifest
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    archive_name = archive_filename + archive_extension(archive_format)
+    archive_path = os.path.join(archive_output_dir, archive_name)
+    # the archive may be written inside the directory it is made of
+    members = [member for member in list_members(source_dir)
+               if os.path.abspath(member[1]) not in (os.path.abspath(archive_path),
+                                                     os.path.abspath(archive_path + '.tmp'))]
+    with Manifest(archive_output_dir) as manifest:
+        previous = manifest.archive_members(archive_name)
+        if archive_format == 'zip':
+            written = update_zip(archive_path, members, previous, workers)
+        elif archive_format == 'tar.zst':
+            written = write_tar_zst(archive_path, members, workers)
+        else:
+            raise ValueError('cannot write %s archives' % archive_format)
+        manifest.record_archive(archive_name, dict(
+            (name, _fingerprint(path)) for name, path, is_directory in members if not is_directory))
+    print('wrote %s (%d of %d files compressed)' % (
+        archive_path, written, len([member for member in members if not member[2]])))
+    return archive_path
@@ -0,0 +1,455 @@
+"""
+benchmarks of the processing stages
+
+    python3 benchmark.py fused /path/to/fit_dir /path/to/censor.csv
+
+converts and censors the FIT files in fit_dir twice in a temporary directory: once
+with the censor stage reading the converted files back, and once with the censoring
+fused into the conversion (process_all --fused-censor). It prints the time and the
+bytes read and written by each (from /proc/self/io, where there is one) and checks
+that both produce the same censored files
+
+    python3 benchmark.py geometry [--points 10000 100000 1000000]
+
+times the GPX distance, velocity and energy calculations on random tracks of each
+length: one point pair at a time with distcalc (as calculate_distances used to, up to
+--scalar-points), and vectorized with geometry in float64 and float32
+
+    python3 benchmark.py smoothing [--tracks 1000 --points 3600 --bandwidths 2 5 10 30 60 120 300]
+
+smooths the speed and elevation of random 1 Hz tracks with every bandwidth, in one
+batched pass per track (smoothing.gaussian_smooth) and with a direct convolution per
+series and bandwidth for the first few tracks, and checks they agree
+
+    python3 benchmark.py pipeline /path/to/fit_source_dir [--workers 1]
+
+imports and converts the FIT files in fit_source_dir twice in a temporary directory:
+copying all of them before converting any (the import and conversion times are
+printed separately), and converting them as they are copied (import_and_process_garmin_fit).
+The temporary directory should be on another filesystem than the source, or files may
+be reflinked rather than copied. The second run may read the source from the page cache
+
+    python3 benchmark.py cache /path/to/fit_dir [--fit-decoder fitparse]
+
+decodes every message of the FIT files in fit_dir, and reads them back from a
+temporary activity cache (activity_cache), and checks both give the same messages
+
+    python3 benchmark.py input /path/to/fit_dir [--fit-decoder fast fitparse]
+
+decodes the FIT files in fit_dir with each decoder, read (through a buffered file for
+fitparse, into bytes for the fast decoder) and memory-mapped (fast_fit.open_mapped), and
+prints the throughput of each. Files that have just been read come from the page cache
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import activity_cache
+import calculate_workout_variables
+import censor_and_package
+import convert_fit_to_csv
+import fast_fit
+import fitparse
+import geometry
+import import_and_process_garmin_fit
+import smoothing
+import timezone_index
+from manifest import MANIFEST_FILENAME, file_fingerprint
+from track_columns import OUTPUT_FORMATS, SIDECAR_SUFFIX, read_columns
+
+
+def io_counters():
+    """
+    (bytes read, bytes written) by this process so far, or None if unknown
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except (IOError, ValueError):
+        return None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+class Measurement(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.
+        self.cpu_seconds = 0.
+        self.read = 0
+        self.written = 0
+
+    def __enter__(self):
+        self._start = (time.perf_counter(), time.process_time(), io_counters())
+        return self
+
+    def __exit__(self, *exc_info):
+        start_wall, start_cpu, start_io = self._start
+        self.seconds += time.perf_counter() - start_wall
+        self.cpu_seconds += time.process_time() - start_cpu
+        end_io = io_counters()
+        if start_io is None or end_io is None:
+            self.read = self.written = None
+        elif self.read is not None:
+            self.read += end_io[0] - start_io[0]
+            self.written += end_io[1] - start_io[1]
+
+    def report(self):
+        if self.read is None:
+            io = 'I/O unknown'
+        else:
+            io = 'read %.1f MB, wrote %.1f MB' % (self.read / 1e6, self.written / 1e6)
+        return '%-24s %7.2fs wall %7.2fs cpu  %s' % (self.name, self.seconds, self.cpu_seconds, io)
+
+
+def same_columns(path_a, path_b):
+    columns_a, timezones_a = read_columns(path_a)
+    columns_b, timezones_b = read_columns(path_b)
+    if list(columns_a) != list(columns_b) or timezones_a != timezones_b:
+        return False
+    for name, (values, valid) in columns_a.items():
+        other_values, other_valid = columns_b[name]
+        if not (np.array_equal(valid, other_valid)
+                and np.array_equal(values[valid], other_values[other_valid])):
+            return False
+    return True
+
+
+def same_files(directory_a, directory_b, ignored_suffixes=()):
+    ignored_suffixes = tuple(ignored_suffixes)
+    names = sorted(name for name in os.listdir(directory_a)
+                   if not ignored_suffixes or not name.endswith(ignored_suffixes))
+    if names != sorted(name for name in os.listdir(directory_b)
+                       if not ignored_suffixes or not name.endswith(ignored_suffixes)):
+        return False
+    for name in names:
+        path_a = os.path.join(directory_a, name)
+        path_b = os.path.join(directory_b, name)
+        # typed formats are compared by their columns; npz members carry their write time
+        if name.endswith('.csv'):
+            if not filecmp.cmp(path_a, path_b, shallow=False):
+                return False
+        elif not same_columns(path_a, path_b):
+            return False
+    return True
+
+
+def benchmark_fused(fit_dir, censorfile, output_format='csv', compact_numeric=False,
+                    decoder='fitparse'):
+    censor_string = censor_and_package.CENSOR_STRING
+    work_dir = tempfile.mkdtemp(prefix='fit_benchmark_')
+    try:
+        results = {}
+        for mode in ['separate', 'fused']:
+            converted = os.path.join(work_dir, mode, 'fit_csv')
+            censored = os.path.join(work_dir, mode, 'censored')
+            os.makedirs(converted)
+            fused_censor = None
+            if mode == 'fused':
+                fused_censor = censor_and_package.fused_censor(censorfile, censored, censor_string)
+            with Measurement('%s: convert' % mode) as convert:
+                convert_fit_to_csv.main(fit_dir, converted, False, False, fit_decoder=decoder,
+                                        fit_compact_numeric=compact_numeric,
+                                        fit_output_format=output_format, fit_censor=fused_censor)
+            with Measurement('%s: censor stage' % mode) as censor:
+                censor_and_package.main([converted], censored, censorfile, censor_string,
+                                        {'archive_results': False})
+            results[mode] = (convert, censor, os.path.join(censored, 'fit_csv'))
+        print('')
+        for mode in ['separate', 'fused']:
+            convert, censor, _ = results[mode]
+            print(convert.report())
+            print(censor.report())
+            total = Measurement('%s: total' % mode)
+            total.seconds = convert.seconds + censor.seconds
+            total.cpu_seconds = convert.cpu_seconds + censor.cpu_seconds
+            if convert.read is not None and censor.read is not None:
+                total.read = convert.read + censor.read
+                total.written = convert.written + censor.written
+            else:
+                total.read = None
+            print(total.report())
+        print('censored files are the same: %s' % same_files(results['separate'][2],
+                                                              results['fused'][2]))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def benchmark_pipeline(fit_source_dir, workers=1, decoder='fitparse'):
+    work_dir = tempfile.mkdtemp(prefix='fit_benchmark_')
+    try:
+        measurements = []
+        converted = {}
+        for mode in ['sequential', 'pipelined']:
+            fit_dir = os.path.join(work_dir, mode, 'fit_files')
+            converted[mode] = os.path.join(work_dir, mode, 'fit_csv')
+            os.makedirs(fit_dir)
+            os.makedirs(converted[mode])
+            if mode == 'sequential':
+                with Measurement('sequential: import') as copy:
+                    import_and_process_garmin_fit.print_import_summary(
+                        import_and_process_garmin_fit.import_files(fit_source_dir, fit_dir))
+                with Measurement('sequential: convert') as convert:
+                    convert_fit_to_csv.main(fit_dir, converted[mode], False, False, workers,
+                                            decoder)
+                total = Measurement('sequential: total')
+                total.seconds = copy.seconds + convert.seconds
+                total.cpu_seconds = copy.cpu_seconds + convert.cpu_seconds
+                total.read = None
+                measurements.extend([copy, convert, total])
+            else:
+                with Measurement('pipelined: total') as total:
+                    import_and_process_garmin_fit.main(fit_source_dir, fit_dir, converted[mode],
+                                                       False, False, workers, decoder)
+                measurements.append(total)
+        print('')
+        for measurement in measurements:
+            print(measurement.report())
+        print('converted files are the same: %s' % same_files(
+            converted['sequential'], converted['pipelined'],
+            # sidecars record the outputs' modification times
+            ignored_suffixes=[MANIFEST_FILENAME, timezone_index.CACHE_FILENAME, SIDECAR_SUFFIX]))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def benchmark_cache(fit_dir, decoder='fitparse'):
+    paths = sorted(os.path.join(fit_dir, name) for name in os.listdir(fit_dir)
+                   if name[-4:].lower() == '.fit')
+    cache_dir = tempfile.mkdtemp(prefix='fit_benchmark_')
+    try:
+        cache = activity_cache.ActivityCache(cache_dir, float('inf'))
+        version = convert_fit_to_csv.cache_version(decoder)
+        decode = Measurement('decode (%s)' % decoder)
+        load = Measurement('load from cache')
+        messages = 0
+        same = True
+        for path in paths:
+            content_hash = file_fingerprint(path)['hash']
+            # decoded as convert_job does when filling the cache
+            with decode:
+                decoded = None
+                if decoder == 'fast':
+                    recording = activity_cache.RecordingFitFile(convert_fit_to_csv.iter_message_fields(
+                        fast_fit.FastFitFile(path, fast_fit.ALL_FIELDS)))
+                    try:
+                        decoded = list(recording.iter_message_fields())
+                    except fast_fit.FastFitUnsupported:
+                        pass
+                if decoded is None:
+                    fitfile = fitparse.FitFile(path, data_processor=fitparse.StandardUnitsDataProcessor())
+                    recording = activity_cache.RecordingFitFile(
+                        convert_fit_to_csv.iter_message_fields(fitfile))
+                    decoded = list(recording.iter_message_fields())
+            cache.store(content_hash, version, recording, version)
+            with load:
+                loaded = list(cache.load(content_hash, version).iter_message_fields())
+            messages += len(decoded)
+            same = same and loaded == decoded
+        cache.count()
+        size = sum(os.path.getsize(path) for path in paths)
+        print('%d files, %.1f MB, %d messages; cache %.1f MB' % (
+            len(paths), size / 1e6, messages, cache.size / 1e6))
+        for measurement in [decode, load]:
+            print('%s  %7.0f messages/s' % (measurement.report(),
+                                            messages / max(measurement.seconds, 1e-9)))
+        print('cached messages are the same: %s' % same)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def decode_messages(path, decoder, mapped):
+    if decoder == 'fast':
+        if mapped:
+            fitfile = fast_fit.FastFitFile(fast_fit.open_mapped(path), convert_fit_to_csv.decoded_fields)
+        else:
+            with open(path, 'rb') as f:
+                fitfile = fast_fit.FastFitFile(f.read(), convert_fit_to_csv.decoded_fields)
+    else:
+        fitfile = fitparse.FitFile(fast_fit.open_mapped(path) if mapped else path,
+                                   data_processor=fitparse.StandardUnitsDataProcessor())
+    return sum(1 for _ in convert_fit_to_csv.iter_message_fields(fitfile))
+
+
+def benchmark_input(fit_dir, decoders):
+    paths = sorted(os.path.join(fit_dir, name) for name in os.listdir(fit_dir)
+                   if name[-4:].lower() == '.fit')
+    size = sum(os.path.getsize(path) for path in paths)
+    print('%d files, %.1f MB' % (len(paths), size / 1e6))
+    for decoder in decoders:
+        for mapped in [False, True]:
+            measurement = Measurement('%s, %s' % (decoder, 'mapped' if mapped else 'read'))
+            messages = 0
+            for path in paths:
+                with measurement:
+                    try:
+                        messages += decode_messages(path, decoder, mapped)
+                    except fast_fit.FastFitUnsupported:
+                        pass
+            print('%s  %6.2f MB/s, %d messages' % (measurement.report(),
+                                                  size / 1e6 / max(measurement.seconds, 1e-9),
+                                                  messages))
+
+
+def random_track(n_points, seed=0):
+    """
+    (latitudes, longitudes, elevations) of a random walk with points about 5 m apart
+    """
+    rng = np.random.default_rng(seed)
+    latitudes = 51.5 + np.cumsum(rng.normal(0, 3e-5, n_points))
+    longitudes = -0.1 + np.cumsum(rng.normal(0, 5e-5, n_points))
+    elevations = 20 + np.cumsum(rng.normal(0, 0.1, n_points))
+    return latitudes, longitudes, elevations
+
+
+def track_variables(latitudes, longitudes, elevations, dtype=np.float64):
+    """
+    the distances, energy increases and accelerations process_file works out
+    """
+    distances = geometry.distances(latitudes, longitudes, geometry.EARTH_RADIUS_MILES, dtype)
+    velocities = geometry.velocities(distances)
+    accelerations = geometry.accelerations(velocities)
+    elevation_changes = np.diff(elevations.astype(dtype))
+    return distances, geometry.energy_increases(velocities, elevation_changes), accelerations
+
+
+def relative_difference(values, reference):
+    values = np.asarray(values, dtype=np.float64)
+    scale = np.maximum(np.abs(reference), np.finfo(np.float64).tiny)
+    return float(np.max(np.abs(values - reference) / scale)) if len(reference) else 0.
+
+
+def benchmark_geometry(points, scalar_points):
+    for n_points in points:
+        latitudes, longitudes, elevations = random_track(n_points)
+        print('%d points' % n_points)
+        reference = None
+        if n_points <= scalar_points:
+            with Measurement('scalar distcalc') as scalar:
+                pairs = [{'lat': lat, 'lon': lon} for lat, lon in zip(latitudes, longitudes)]
+                reference = np.asarray([calculate_workout_variables.distcalc(c2, c1)
+                                        for c1, c2 in zip(pairs[1:], pairs[:-1])])
+            print('  %-24s %9.2f ms' % (scalar.name, scalar.seconds * 1000))
+        for dtype in ['float64', 'float32']:
+            with Measurement('vectorized %s' % dtype) as vectorized:
+                distances, _, _ = track_variables(latitudes, longitudes, elevations,
+                                                  geometry.DTYPES[dtype])
+            if reference is None and dtype == 'float64':
+                reference = distances
+            print('  %-24s %9.2f ms  %d distances differ, by at most %.1e' % (
+                vectorized.name, vectorized.seconds * 1000, np.sum(distances != reference),
+                relative_difference(distances, reference)))
+
+
+def direct_smooth(positions, values, bandwidth):
+    """
+    kernel-weighted means of values at positions, one gaussian kernel at a time
+    """
+    valid = np.isfinite(values)
+    radius = int(np.ceil(smoothing.GAP_SIGMAS * bandwidth))
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (offsets / bandwidth)**2)
+    index = np.rint(positions - positions[0]).astype(np.int64)
+    sums = np.bincount(index[valid], weights=values[valid], minlength=index[-1] + 1)
+    counts = np.bincount(index[valid], minlength=index[-1] + 1).astype(np.float64)
+    numerators = np.convolve(sums, kernel)[radius:radius + len(sums)]
+    denominators = np.convolve(counts, kernel)[radius:radius + len(counts)]
+    return numerators[index] / denominators[index]
+
+
+def benchmark_smoothing(n_tracks, n_points, bandwidths, direct_tracks=10):
+    tracks = []
+    for seed in range(n_tracks):
+        latitudes, longitudes, elevations = random_track(n_points, seed)
+        times = np.datetime64('2020-01-01T00:00:00') + np.arange(n_points) * np.timedelta64(1, 's')
+        speeds = geometry.velocities(geometry.distances(latitudes, longitudes))
+        tracks.append((np.datetime_as_string(times) + 'Z', geometry.distances(latitudes, longitudes),
+                       np.concatenate([[np.nan], speeds]), elevations))
+    positions = np.arange(n_points, dtype=np.float64)
+    print('%d tracks x %d points, %d bandwidths' % (n_tracks, n_points, len(bandwidths)))
+    with Measurement('batched smoothing') as batched:
+        for _, _, speeds, elevations in tracks:
+            smoothing.gaussian_smooth(positions, [speeds, elevations], bandwidths)
+    print('  %-36s %8.2fs' % (batched.name, batched.seconds))
+    direct_tracks = min(direct_tracks, n_tracks)
+    with Measurement('direct, one bandwidth at a time') as direct:
+        for _, _, speeds, elevations in tracks[:direct_tracks]:
+            for values in [speeds, elevations]:
+                for bandwidth in bandwidths:
+                    direct_smooth(positions, values, bandwidth)
+    print('  %-36s %8.2fs (extrapolated from %d tracks)' % (
+        direct.name, direct.seconds * n_tracks / direct_tracks, direct_tracks))
+    difference = 0.
+    for _, _, _, elevations in tracks[:direct_tracks]:
+        smoothed = smoothing.gaussian_smooth(positions, elevations, bandwidths)
+        for i, bandwidth in enumerate(bandwidths):
+            difference = max(difference, relative_difference(
+                smoothed[i], direct_smooth(positions, elevations, bandwidth)))
+    print('  smoothed elevations differ by at most %.1e' % difference)
+    with Measurement('smoothed_features') as features:
+        for times, distances, _, elevations in tracks:
+            smoothing.smoothed_features(times, distances, elevations, bandwidths)
+    print('  %-36s %8.2fs (with reading the times)' % (features.name, features.seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark processing stages')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    fused = subparsers.add_parser('fused', help='conversion + censor stage vs. fused censoring')
+    fused.add_argument('fit_dir')
+    fused.add_argument('censorfile')
+    fused.add_argument('--output-format', choices=OUTPUT_FORMATS, default='csv')
+    fused.add_argument('--compact-numeric', action='store_true', default=False)
+    fused.add_argument('--fit-decoder', choices=['fast', 'fitparse'], default='fitparse')
+
+    geometry_parser = subparsers.add_parser('geometry', help='scalar vs. vectorized GPX distances')
+    geometry_parser.add_argument('--points', type=int, nargs='+', default=[10000, 100000, 1000000])
+    geometry_parser.add_argument('--scalar-points', type=int, default=100000,
+                                 help='longest track to also compute point by point')
+
+    smoothing_parser = subparsers.add_parser('smoothing', help='batched vs. direct kernel smoothing')
+    smoothing_parser.add_argument('--tracks', type=int, default=1000)
+    smoothing_parser.add_argument('--points', type=int, default=3600)
+    smoothing_parser.add_argument('--bandwidths', type=float, nargs='+',
+                                  default=[2, 5, 10, 30, 60, 120, 300])
+
+    pipeline = subparsers.add_parser('pipeline', help='import then convert vs. converting while importing')
+    pipeline.add_argument('fit_source_dir')
+    pipeline.add_argument('--workers', type=int, default=1)
+    pipeline.add_argument('--fit-decoder', choices=['fast', 'fitparse'], default='fitparse')
+
+    cache = subparsers.add_parser('cache', help='decoding FIT files vs. loading them from the cache')
+    cache.add_argument('fit_dir')
+    cache.add_argument('--fit-decoder', choices=['fast', 'fitparse'], default='fitparse')
+
+    input_parser = subparsers.add_parser('input', help='read vs. memory-mapped FIT input')
+    input_parser.add_argument('fit_dir')
+    input_parser.add_argument('--fit-decoder', choices=['fast', 'fitparse'], nargs='+',
+                              default=['fast', 'fitparse'])
+
+    args = parser.parse_args()
+    if args.benchmark == 'fused':
+        benchmark_fused(args.fit_dir, args.censorfile, args.output_format, args.compact_numeric,
+                        args.fit_decoder)
+    elif args.benchmark == 'geometry':
+        benchmark_geometry(args.points, args.scalar_points)
+    elif args.benchmark == 'smoothing':
+        benchmark_smoothing(args.tracks, args.points, args.bandwidths)
+    elif args.benchmark == 'pipeline':
+        benchmark_pipeline(args.fit_source_dir, args.workers, args.fit_decoder)
+    elif args.benchmark == 'cache':
+        benchmark_cache(args.fit_dir, args.fit_decoder)
+    elif args.benchmark == 'input':
+        benchmark_input(args.fit_dir, args.fit_decoder)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,130 +1,217 @@
-from bs4 import BeautifulSoup
 import numpy as np 
 PI = np.pi
 import csv
+import multiprocessing
 import os
 from collections import OrderedDict
 import re
 
+from track_columns import output_extension, write_columns, write_sidecar
+from manifest import GPX_STAGE, Manifest, file_fingerprint
+from gpx_stream import read_track
+import geometry
+import profiling
+import smoothing
+from geometry import FPS_TO_MPH, G_FPS, MIPS_TO_MPH
+
 OUTPUT_FILE = 'gpx_processed_info.csv' 
 
 MAX_SPEED = 50#mph
 
 #radius of earth in miles
-C_R = 6371/1.60934
+C_R = geometry.EARTH_RADIUS_MILES
 def distcalc(c1, c2):
-    lat1 = float(c1['lat'])*PI/180.
-    lon1 = float(c1['lon'])*PI/180.
-
-    lat2 = float(c2['lat'])*PI/180.
-    lon2 = float(c2['lon'])*PI/180.
-
-    dlat = lat2-lat1
-    dlon = lon2-lon1
-
-    a = np.sin(dlat/2.)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    d = C_R * c 
-    return d 
+    return geometry.haversine(float(c1['lat'])*PI/180., float(c1['lon'])*PI/180.,
+                              float(c2['lat'])*PI/180., float(c2['lon'])*PI/180., C_R)
 
-def calculate_distances(points):
-    dists = np.asarray([distcalc(c2.attrs,c1.attrs) for c1, c2 in zip(points[1:],points[:-1])])
-    return dists 
+def calculate_distances(latitudes, longitudes, dtype=np.float64):
+    return geometry.distances(latitudes, longitudes, C_R, dtype)
 
 def calculate_velocities(distances):
-    #convert mi/s to mph
-    velocities = distances * 3600
-    return velocities 
+    return geometry.velocities(distances)
 
 def calculate_accelerations(velocities):
-    return np.diff(velocities)
+    return geometry.accelerations(velocities)
 
-MIPS_TO_MPH = 3600.
+G_MPHPS = 32 * FPS_TO_MPH
 
-FPS_TO_MPH = 3600./5280
+SUMMARY_FIELDS = ['sum_v','sum_v2','sum_v3','abs_elevation','sum_a', 'sum_e']
 
-G_FPS = 32.
+OUTPUT_SUBDIR = 'raw_csv'
 
-G_MPHPS = 32 * FPS_TO_MPH
+def output_filename(filename, output_format='csv'):
+    """
+    name of the output for filename, relative to the target directory
+    """
+    return re.sub(r'([^.]+)\.gpx', OUTPUT_SUBDIR + r'/\1', filename) + output_extension(output_format)
+
+def summary_fields(smoothing_bandwidths=()):
+    return ['filename'] + SUMMARY_FIELDS + smoothing.feature_names(smoothing_bandwidths)
 
-def process_file(filename, target_dir):
-    new_filename = re.sub(r'([^.]+)\.gpx', r'raw_csv/\1.csv', filename)
-    if os.path.exists(new_filename):
+def process_file(filename, source_dir, target_dir, output_format='csv', overwrite=False,
+                 dtype='float64', smoothing_bandwidths=()):
+    """
+    writes the distances and elevation changes of source_dir/filename to target_dir and
+    returns its summary variables, or None if the output already exists; with
+    smoothing_bandwidths (seconds), the summary also has the variables of the speed and
+    elevation smoothed with each (see smoothing.smoothed_features)
+    """
+    new_filename = os.path.join(target_dir, output_filename(filename, output_format))
+    if os.path.exists(new_filename) and not overwrite:
         #print '%s already exists. skipping.' % new_filename
         return None
     print('processing %s' % filename )
-    with open(os.path.join(target_dir, filename),'r') as f:
-        soup = BeautifulSoup(f.read(), 'lxml')
-        track = soup.find('trk')
-        segments = track.find('trkseg')
-        points = segments.find_all('trkpt')
-        times = [p.find('time').text for p in points]
-        elevations = np.asarray([float(p.find('ele').text) for p in points])
+    # only the first segment of the first track is used
+    track = read_track(os.path.join(source_dir, filename), first_segment=True)
+    times = track['time']
+    elevations = track['elevation']
     #lon-lat based
-    distances = calculate_distances(points)
+    distances = calculate_distances(track['latitude'], track['longitude'], geometry.DTYPES[dtype])
     velocities = calculate_velocities(distances)
     #if velocity > MAX_SPEED, then it indicates discontinuity
     velocities = velocities * (velocities < MAX_SPEED)
     accelerations = calculate_accelerations(velocities)
     #elevation
-    elevation_changes = np.diff(elevations)
+    elevation_changes = np.diff(elevations.astype(distances.dtype))
     sum_v = np.sum(velocities)
     sum_v2 = np.sum(velocities**2)
     sum_v3 = np.sum(velocities**3)
     abs_elevation = np.sum(np.abs(elevation_changes))/2
     sum_a = np.sum(accelerations * (accelerations > 0))
     #alternative type of accelerations measurement
-    velocities_mph = 3600 * velocities 
-    energy_increases = velocities_mph[1:]**2 - velocities_mph[:-1]**2
-    energy_increases = energy_increases - FPS_TO_MPH**2 * G_FPS * elevation_changes[1:] * (elevation_changes[1:] < 0)
+    energy_increases = geometry.energy_increases(velocities, elevation_changes)
     energy_increases = np.sum(energy_increases * (energy_increases > 0))
-    with open(new_filename, 'w') as f:
-        f.write('time,distance,elevation_change')
-        for t, d, e in zip(times[1:], distances, elevation_changes):
+    if output_format == 'csv':
+        with open(new_filename, 'w') as f:
+            f.write('time,distance,elevation_change')
+            for t, d, e in zip(times[1:], distances, elevation_changes):
+                f.write('\n')
+                f.write(','.join([str(t), str(d), str(e)]))
+    else:
+        columns = OrderedDict([
+            ('time', np.array(times[1:], dtype=str)),
+            ('distance', distances),
+            ('elevation_change', elevation_changes),
+        ])
+        with open(new_filename, 'wb') as f:
+            write_columns(f, OrderedDict(
+                (name, (values, np.ones(len(values), dtype=bool))) for name, values in columns.items()
+            ), output_format)
+    # there are no coordinates in the output, so censoring can always copy it as is
+    write_sidecar(new_filename, len(distances), None)
+    measurement = profiling.current()
+    measurement.add(rows_in=len(elevations), rows_out=len(distances))
+    measurement.add_outputs([new_filename])
+    summary = {
+        'sum_v':sum_v,
+        'sum_v2':sum_v2,
+        'abs_elevation':abs_elevation,
+        'sum_a':sum_a,
+        'sum_v3':sum_v3,
+        'sum_e':energy_increases
+    }
+    if smoothing_bandwidths:
+        summary.update(smoothing.smoothed_features(times, distances, elevations,
+                                                   smoothing_bandwidths))
+    return summary
+
+def process_job(job):
+    """
+    process_file(*job); can be run in a worker process
+    returns (filename, summary variables)
+    """
+    with profiling.measure_file('gpx', job[0], os.path.join(job[1], job[0])):
+        return job[0], process_file(*job)
+
+def read_summary(path, fields):
+    """
+    {filename: row} of the summary at path, or {} if there is none or it has other fields
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        if next(reader, None) != fields:
+            return {}
+        return OrderedDict((row[0], dict(zip(fields, row))) for row in reader if row)
+
+def write_summary(path, fileinfo, fields=None):
+    if fields is None:
+        fields = summary_fields()
+    with open(path, 'w') as f:
+        f.write(','.join(fields))
+        for fn, data in fileinfo.items():
             f.write('\n')
-            f.write(','.join([str(t), str(d), str(e)]))
-            return {
-                'sum_v':sum_v,
-                'sum_v2':sum_v2,
-                'abs_elevation':abs_elevation,
-                'sum_a':sum_a,
-                'sum_v3':sum_v3,
-                'sum_e':energy_increases
-            }
-
-def main(gpx_source_dir, gpx_target_dir, gpx_summary_filename):
-    original_dir = os.getcwd()
-    os.makedirs(gpx_target_dir, exist_ok=True)
-    
-    os.chdir(gpx_source_dir)
-    file_list = [x for x in os.listdir('.') if x[-4:].lower()=='.gpx']
+            f.write(','.join([str(x) for x in [fn] + [data[field] for field in fields[1:]]]))
+
+def main(gpx_source_dir, gpx_target_dir, gpx_summary_filename, gpx_output_format='csv',
+         gpx_dtype='float64', gpx_workers=1, gpx_smoothing_bandwidths=(),
+         gpx_write_summary=False):
+    """
+    processes the GPX files in gpx_source_dir that changed since the last run, on
+    gpx_workers processes; returns the summary variables of each, in file name order
+
+    with gpx_write_summary, gpx_target_dir/gpx_summary_filename is brought up to date
+    with the summaries of every file in gpx_source_dir
+    """
+    gpx_source_dir = os.path.abspath(gpx_source_dir)
+    gpx_target_dir = os.path.abspath(gpx_target_dir)
+    os.makedirs(os.path.join(gpx_target_dir, OUTPUT_SUBDIR), exist_ok=True)
+
+    file_list = [x for x in os.listdir(gpx_source_dir) if x[-4:].lower()=='.gpx']
     file_list.sort()
-    fileinfo = OrderedDict()
+    # the manifest goes next to the outputs, as with FIT files
+    manifest = Manifest(gpx_target_dir)
+    options = {'output_format': gpx_output_format}
+    # only recorded when not the default, so files processed before it existed stay current
+    if gpx_dtype != 'float64':
+        options['dtype'] = gpx_dtype
+    if gpx_smoothing_bandwidths:
+        options['smoothing_bandwidths'] = [float(bandwidth) for bandwidth in gpx_smoothing_bandwidths]
+    fields = summary_fields(gpx_smoothing_bandwidths)
+    summary_path = os.path.join(gpx_target_dir, gpx_summary_filename)
+    summary = read_summary(summary_path, fields) if gpx_write_summary else {}
+    jobs = []
+    fingerprints = {}
     for file in file_list:
-        td = process_file(file, gpx_target_dir)
+        entry = manifest.lookup(GPX_STAGE, file)
+        fingerprint = file_fingerprint(os.path.join(gpx_source_dir, file), entry)
+        # a file missing from the summary is processed again to fill it in
+        if (manifest.is_current(entry, fingerprint, options, gpx_target_dir)
+                and (not gpx_write_summary or file in summary)):
+            manifest.update_fingerprint(entry, fingerprint)
+            continue
+        fingerprints[file] = fingerprint
+        # a changed file is processed again even though its output exists
+        jobs.append((file, gpx_source_dir, gpx_target_dir, gpx_output_format,
+                     entry is not None or gpx_write_summary, gpx_dtype, gpx_smoothing_bandwidths))
+
+    fileinfo = OrderedDict()
+    def record(result):
+        file, td = result
         if td is not None: 
             fileinfo[file] = td
-    #no longer interested in actually summing up variables here...
-    if True:
-        return 0
-    with open(os.path.join(gpx_target_dir, gpx_summary_filename), 'w') as f:
-        f.write(','.join(['filename','sum_v','sum_v2','sum_v3','abs_elevation','sum_a', 'sum_e']))
-        for fn, data in fileinfo.iteritems():
-            f.write('\n')
-            f.write(','.join([str(x) for x in [
-                fn,
-                data['sum_v'],
-                data['sum_v2'],
-                data['sum_v3'],
-                data['abs_elevation'],
-                data['sum_a'],
-                data['sum_e']
-            ]
-            ]
-            ))
+        # an output left by a run from before the manifest is taken as is
+        manifest.record(GPX_STAGE, file, fingerprints[file],
+                        [output_filename(file, gpx_output_format)], options=options)
+
+    if gpx_workers > 1 and len(jobs) > 1:
+        # results come back in job order, so the manifest and summary are the same as with one process
+        with multiprocessing.Pool(min(gpx_workers, len(jobs)), initializer=profiling.init_worker,
+                                  initargs=(profiling.settings(),)) as pool:
+            for result in pool.imap(process_job, jobs):
+                record(result)
+    else:
+        for job in jobs:
+            record(process_job(job))
+    manifest.close()
+    if gpx_write_summary:
+        # rows of unchanged files are kept as they were; files that are gone are dropped
+        summary.update(fileinfo)
+        write_summary(summary_path, OrderedDict(
+            (file, summary[file]) for file in file_list if file in summary), fields)
     print('processed gpx files')
-    
-    os.setwd(original_dir)
+    return fileinfo
 
 
 if __name__=='__main__':
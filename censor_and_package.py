@@ -1,14 +1,23 @@
 import os
 import csv
 import re 
-from bs4 import BeautifulSoup
-import bs4
+import itertools
 import shutil
-from io import StringIO
-import zipfile
 import numpy as np 
 PI = np.pi
 import codecs
+import hashlib
+import json
+from collections import OrderedDict
+
+from track_columns import (array_bounds, csv_cell, merge_bounds, read_columns, read_sidecar,
+                           write_columns)
+from manifest import CENSOR_STAGE, Manifest, file_fingerprint
+import archive
+from file_copies import reflink
+import geometry
+import gpx_stream
+import profiling
 
 #should have 3 columns: longitude, latitude, radius (meters)
 #CENSORFILE = 'censor.csv'
@@ -62,51 +71,217 @@ CENSOR_STRING = '[CENSORED]'
 
 #ZIP_FILENAME = 'CLEAN_WORKOUTS.ZIP'
 
-CENSOR_COORDINATES = []
-
 #ADDITIONAL_FILES_TO_COPY = ['workout_gpx/strava_gpx/bike_and_run_gpx_info.ods']
 
-#will overwrite file if it already exists
+#will overwrite file even if the manifest shows it is up to date; otherwise a file is only
+#censored again when it or the censor configuration (see censor_config_hash) changed
 OVERWRITE = False 
-OVERWRITE_CSV = True 
+OVERWRITE_CSV = False 
 OVERWRITE_GPX = False 
 
 BLACKLIST = set(['test_file.csv'])
 
+#rows read, checked and written at a time by transfer_csv
+CSV_CHUNK_ROWS = 4096
+
+#files whose bounding box cannot touch a censor region are reflinked into the target
+#directory (or copied if the filesystem cannot) instead of being parsed and rewritten;
+#never hard-linked, since changing the source in place would change the censored copy too
+REFLINK_UNCENSORED_FILES = True
+
 #radius of earth in meters
-C_R = 6371. * 1000#/1.60934
+C_R = geometry.EARTH_RADIUS_METERS
 def distcalc(c1, c2):
-    lat1 = float(c1['lat'])*PI/180.
-    lon1 = float(c1['lon'])*PI/180.
-
-    lat2 = float(c2['lat'])*PI/180.
-    lon2 = float(c2['lon'])*PI/180.
-
-    dlat = lat2-lat1
-    dlon = lon2-lon1
-
-    a = np.sin(dlat/2.)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
-    d = C_R * c 
-    return d 
-
-def calculate_distances(points):
-    dists = np.asarray([distcalc(c2.attrs,c1.attrs) for c1, c2 in zip(points[1:],points[:-1])])
-    return dists 
-
-def is_censorable(longitude, latitude):
-    censor = False 
-    for cc in CENSOR_COORDINATES:
-        dist = distcalc({'lat':cc['latitude'],
-            'lon':cc['longitude']},
-            {'lat':latitude,'lon':longitude})
-        if dist <= cc['radius']:
-            censor = True 
-            break
-    return censor 
+    return geometry.haversine(float(c1['lat'])*PI/180., float(c1['lon'])*PI/180.,
+                              float(c2['lat'])*PI/180., float(c2['lon'])*PI/180., C_R)
+
+def calculate_distances(latitudes, longitudes, dtype=np.float64):
+    return geometry.distances(latitudes, longitudes, C_R, dtype)
+
+# rows x regions evaluated at once by CensorRegions.mask
+CENSOR_CHUNK_CELLS = 1 << 20
+# grid cells are sized to fit a typical region this many times across, within these bounds
+CENSOR_CELL_REGIONS = 2
+MIN_CENSOR_CELL_DEGREES = 0.002
+MAX_CENSOR_CELL_DEGREES = 1.
+# regions covering more cells than this are checked for every point instead
+MAX_REGION_CELLS = 4096
+
+class CensorRegions(object):
+    """
+    circular censor regions (latitude, longitude, radius in meters) in a grid index
+
+    every region is bucketed into the grid cells its bounding box touches, so a point is
+    only checked against the regions near it; the check itself is distcalc's, evaluated
+    in the same order of operations
+    """
+
+    def __init__(self, regions=(), cell_degrees=None):
+        self.regions = list(regions)
+        self.radii = np.array([float(cc['radius']) for cc in self.regions])
+        if cell_degrees is None:
+            typical_diameter = 2 * np.degrees(np.median(self.radii) / C_R) if len(self.radii) else 0.
+            cell_degrees = min(max(CENSOR_CELL_REGIONS * typical_diameter, MIN_CENSOR_CELL_DEGREES),
+                               MAX_CENSOR_CELL_DEGREES)
+        # a whole number of cells fits around the globe, so longitudes wrap onto the grid
+        self.n_lat_cells = max(1, int(round(180. / cell_degrees)))
+        self.n_lon_cells = 2 * self.n_lat_cells
+        self.cell_degrees = 180. / self.n_lat_cells
+        self.latitudes = np.array([float(cc['latitude']) for cc in self.regions])*PI/180.
+        self.cos_latitudes = np.cos(self.latitudes)
+        self.longitudes = np.array([float(cc['longitude']) for cc in self.regions])*PI/180.
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.regions)
+
+    def _build_grid(self):
+        buckets = {}
+        everywhere = []
+        # bounding boxes of the regions, for may_intersect
+        self.box_min_lat = []
+        self.box_max_lat = []
+        self.box_lon = []
+        self.box_lon_extent = []
+        for i, cc in enumerate(self.regions):
+            latitude = float(cc['latitude'])
+            longitude = float(cc['longitude'])
+            # no point within the radius is further than this in latitude...
+            angle = self.radii[i] / C_R
+            lat_extent = np.degrees(angle) * (1 + 1e-6) + 1e-9
+            if abs(latitude) + lat_extent >= 90 or angle >= PI / 2:
+                # ...and if the region reaches a pole, it spans every longitude
+                lon_extent = 180.
+            else:
+                lon_extent = (np.degrees(np.arcsin(min(1., np.sin(angle) / np.cos(np.radians(latitude)))))
+                              * (1 + 1e-6) + 1e-9)
+            lat_cells = range(self._lat_cell(latitude - lat_extent),
+                              self._lat_cell(latitude + lat_extent) + 1)
+            if lon_extent >= 180.:
+                lon_cells = range(self.n_lon_cells)
+            else:
+                lon_cells = [cell % self.n_lon_cells for cell in range(
+                    int(np.floor((longitude - lon_extent + 180.) / self.cell_degrees)),
+                    int(np.floor((longitude + lon_extent + 180.) / self.cell_degrees)) + 1)]
+            self.box_min_lat.append(latitude - lat_extent)
+            self.box_max_lat.append(latitude + lat_extent)
+            self.box_lon.append(longitude)
+            self.box_lon_extent.append(lon_extent)
+            if len(lat_cells) * len(lon_cells) > MAX_REGION_CELLS:
+                everywhere.append(i)
+                continue
+            for lat_cell in lat_cells:
+                for lon_cell in lon_cells:
+                    buckets.setdefault(lat_cell * self.n_lon_cells + lon_cell, []).append(i)
+        self.box_min_lat = np.array(self.box_min_lat)
+        self.box_max_lat = np.array(self.box_max_lat)
+        self.box_lon = np.array(self.box_lon)
+        self.box_lon_extent = np.array(self.box_lon_extent)
+        self.everywhere = np.array(everywhere, dtype=np.int64)
+        self.buckets = {
+            cell: np.union1d(np.array(indexes, dtype=np.int64), self.everywhere)
+            for cell, indexes in buckets.items()
+        }
+
+    def may_intersect(self, bounds):
+        """
+        False if no point in bounds (min latitude, min longitude, max latitude,
+        max longitude) can be within a region
+        """
+        if not len(self):
+            return False
+        min_lat, min_lon, max_lat, max_lon = bounds
+        if not (-90 <= min_lat and max_lat <= 90 and -180 <= min_lon and max_lon <= 180):
+            return True
+        lat_overlap = (self.box_min_lat <= max_lat) & (self.box_max_lat >= min_lat)
+        lon_overlap = self.box_lon_extent >= 180.
+        for shift in (-360., 0., 360.):
+            lon_overlap |= ((self.box_lon - self.box_lon_extent + shift <= max_lon)
+                            & (self.box_lon + self.box_lon_extent + shift >= min_lon))
+        return bool((lat_overlap & lon_overlap).any())
+
+    def _lat_cell(self, latitude):
+        return min(max(int(np.floor((latitude + 90.) / self.cell_degrees)), 0), self.n_lat_cells - 1)
+
+    def cells(self, longitudes, latitudes):
+        """
+        grid cell of each point; latitudes must be within [-90, 90]
+        """
+        lat_cells = np.clip(np.floor((latitudes + 90.) / self.cell_degrees).astype(np.int64),
+                            0, self.n_lat_cells - 1)
+        lon_cells = np.floor(np.mod(longitudes + 180., 360.) / self.cell_degrees).astype(np.int64)
+        lon_cells = np.minimum(lon_cells, self.n_lon_cells - 1)
+        return lat_cells * self.n_lon_cells + lon_cells
+
+    def contains(self, longitude, latitude):
+        return bool(self.mask([longitude], [latitude])[0])
+
+    def mask(self, longitudes, latitudes):
+        """
+        True where a point (in degrees) is within any region; NaN is never censored
+        """
+        longitudes = np.asarray(longitudes, dtype=float)
+        latitudes = np.asarray(latitudes, dtype=float)
+        censored = np.zeros(len(latitudes), dtype=bool)
+        if not len(self):
+            return censored
+        finite = np.isfinite(longitudes) & np.isfinite(latitudes)
+        # the grid only covers real latitudes; anything else is checked against every region
+        unindexed = np.flatnonzero(finite & (np.abs(latitudes) > 90))
+        if len(unindexed):
+            censored[unindexed] = self._within(longitudes[unindexed], latitudes[unindexed],
+                                               np.arange(len(self)))
+        rows = np.flatnonzero(finite & (np.abs(latitudes) <= 90))
+        if not len(rows):
+            return censored
+        cells = self.cells(longitudes[rows], latitudes[rows])
+        order = np.argsort(cells, kind='stable')
+        cells = cells[order]
+        rows = rows[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        ends = np.r_[starts[1:], len(cells)]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            candidates = self.buckets.get(int(cells[start]), self.everywhere)
+            if not len(candidates):
+                continue
+            group = rows[start:end]
+            censored[group] = self._within(longitudes[group], latitudes[group], candidates)
+        return censored
+
+    def _within(self, longitudes, latitudes, candidates):
+        region_lat = self.latitudes[candidates]
+        region_cos_lat = self.cos_latitudes[candidates]
+        region_lon = self.longitudes[candidates]
+        radii = self.radii[candidates]
+        within = np.zeros(len(latitudes), dtype=bool)
+        chunk = max(1, CENSOR_CHUNK_CELLS // len(candidates))
+        with np.errstate(invalid='ignore'):
+            for start in range(0, len(latitudes), chunk):
+                lat2 = latitudes[start:start + chunk, None]*PI/180.
+                lon2 = longitudes[start:start + chunk, None]*PI/180.
+                d = geometry.haversine(region_lat, region_lon, lat2, lon2, C_R, region_cos_lat)
+                within[start:start + chunk] = (d <= radii).any(axis=1)
+        return within
+
+def parse_coordinates(lines, index):
+    """
+    returns floats in column index of the lines, with NaN where a value cannot be parsed,
+    and a mask of those values
+    """
+    values = np.empty(len(lines))
+    unparsed = np.zeros(len(lines), dtype=bool)
+    for i, line in enumerate(lines):
+        try:
+            values[i] = float(line[index])
+        except ValueError:
+            values[i] = np.nan
+            unparsed[i] = True
+    return values, unparsed
 
 CSV_REGEX = re.compile(r'.*\.csv$')
 GPX_REGEX = re.compile(r'.*\.gpx$')
+# typed track files (see track_columns.write_columns)
+COLUMNS_REGEX = re.compile(r'.*\.(parquet|npz)$')
 
 def find_csv(directory):
     files = os.listdir(directory)
@@ -116,79 +291,233 @@ def find_gpx(directory):
     files = os.listdir(directory)
     return [file for file in files if GPX_REGEX.match(file) and file not in BLACKLIST]
 
-def censor_line(x, template):
-    return [e if not template[i] else CENSOR_STRING for i, e in enumerate(x)]
+def find_columns(directory):
+    files = os.listdir(directory)
+    return [file for file in files if COLUMNS_REGEX.match(file) and file not in BLACKLIST]
 
-def transfer_csv(filename, directory, censor_target_dir):
-    target_file = os.path.join(censor_target_dir, directory, filename)
-    if os.path.isfile(target_file) and not (OVERWRITE or OVERWRITE_CSV):
-        return 1
+def copy_uncensored(source, target):
+    if os.path.lexists(target):
+        os.remove(target)
+    if REFLINK_UNCENSORED_FILES:
+        try:
+            reflink(source, target)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+
+def is_linked(source, target):
+    # older versions hard-linked uncensored files (see copy_uncensored)
+    try:
+        return os.path.samefile(source, target)
+    except OSError:
+        return False
+
+def remove_target(target):
+    # the target may be a hard link to its source (see is_linked); writing over it
+    # would change the source too
+    if os.path.lexists(target):
+        os.remove(target)
+
+def can_copy_uncensored(path, censor_regions):
+    """
+    True if the converter's sidecar for path shows none of its coordinates can be censored
+    """
+    sidecar = read_sidecar(path)
+    if sidecar is None:
+        return False
+    return sidecar['bbox'] is None or not censor_regions.may_intersect(sidecar['bbox'])
+
+TRKPT_REGEX = re.compile(rb'<trkpt\b([^>]*)>', re.IGNORECASE)
+LAT_ATTRIBUTE_REGEX = re.compile(rb'\blat\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+LON_ATTRIBUTE_REGEX = re.compile(rb'\blon\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+
+def gpx_bounds(path):
+    """
+    bounding box of the track points of a GPX file, found without parsing the XML;
+    returns False if some point's coordinates cannot be read this way
+    """
+    bounds = None
+    rest = b''
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(gpx_stream.READ_BLOCK_SIZE), b''):
+            data = rest + block
+            if not rest and data.startswith(gpx_stream.UTF16_BOMS):
+                # the patterns only match encodings that write markup in ASCII
+                return False
+            # a tag cannot contain '<', so every tag before the last one is complete
+            complete = data.rfind(b'<')
+            if complete < 0:
+                complete = len(data)
+            rest = data[complete:]
+            latitudes = []
+            longitudes = []
+            for match in TRKPT_REGEX.finditer(data, 0, complete):
+                latitude = LAT_ATTRIBUTE_REGEX.search(match.group(1))
+                longitude = LON_ATTRIBUTE_REGEX.search(match.group(1))
+                try:
+                    latitudes.append(float(latitude.group(1)))
+                    longitudes.append(float(longitude.group(1)))
+                except (AttributeError, ValueError):
+                    return False
+            latitudes = np.array(latitudes)
+            longitudes = np.array(longitudes)
+            # anything else is never censored
+            finite = np.isfinite(latitudes) & np.isfinite(longitudes)
+            bounds = merge_bounds(bounds, array_bounds([latitudes[finite]], [longitudes[finite]]))
+    if TRKPT_REGEX.search(rest):
+        return False
+    return bounds
+
+def censor_line(x, template, censored_value=None):
+    if censored_value is None:
+        censored_value = CENSOR_STRING
+    return [e if not template[i] else censored_value for i, e in enumerate(x)]
+
+def censor_plan(header):
+    """
+    returns (coordinate column pairs, use_alternate_censoring, should_censor) for a CSV
+    with header; with alternate censoring, rows without coordinates are never flagged
+    """
+    if 'latitude' in header:
+        pairs = [('latitude', 'longitude')]
+        use_alternate_censoring = False
+    elif 'position_lat' in header:
+        pairs = [('position_lat', 'position_long')]
+        use_alternate_censoring = False
+    else:
+        use_alternate_censoring = True
+        pairs = [names for names in ADDITIONAL_LATLONG if names[0] in header and names[1] in header]
+    should_censor = [CENSOR_PARAMS.get(column, False) for i, column in enumerate(header)]
+    return pairs, use_alternate_censoring, should_censor
+
+def censor_mask(coordinates, n_rows, pairs, use_alternate_censoring, censor_regions):
+    """
+    returns (will_censor, unparsed) for a chunk of rows, where coordinates(name) gives the
+    parsed values of a column and which of its cells are not numbers
+    """
+    if not use_alternate_censoring:
+        latitude_name, longitude_name = pairs[0]
+        longitudes, unparsed_longitudes = coordinates(longitude_name)
+        latitudes, unparsed_latitudes = coordinates(latitude_name)
+        #a row missing one or both of the longitude/latitude values is written as is
+        #I do not personally have files like this (I think), but it is possible
+        #will fail to censor latitude/longitude if the other is not present, but that's
+        #not realistic
+        unparsed = unparsed_longitudes | unparsed_latitudes
+        will_censor = censor_regions.mask(longitudes, latitudes)
+    else:
+        unparsed = np.zeros(n_rows, dtype=bool)
+        will_censor = np.zeros(n_rows, dtype=bool)
+        for latitude_name, longitude_name in pairs:
+            #values of 'None' are likely, will just ignore those...
+            will_censor |= censor_regions.mask(coordinates(longitude_name)[0],
+                                               coordinates(latitude_name)[0])
+    return will_censor, unparsed
+
+def censor_rows(lines, will_censor, unparsed, use_alternate_censoring, should_censor,
+                censored_value=None):
+    """
+    yields the rows of a chunk that go into the censored file
+    """
+    for line, censor, missing in zip(lines, will_censor.tolist(), unparsed.tolist()):
+        if missing and not use_alternate_censoring:
+            print('....')
+            yield line
+        elif censor:
+            if not CENSOR_PARAMS['timestamp']:
+                yield censor_line(line, should_censor, censored_value)
+        else:
+            yield line
+
+def transfer_csv(filename, directory, censor_target_dir, censor_regions):
+    output_file = os.path.join(censor_target_dir, os.path.split(directory)[1], filename)
+    if can_copy_uncensored(os.path.join(directory, filename), censor_regions):
+        copy_uncensored(os.path.join(directory, filename), output_file)
+        print('copied %s' % (os.path.join(directory, filename)))
+        return 0
+    remove_target(output_file)
     with open(os.path.join(directory, filename), 'r') as f: 
         reader = csv.reader(f)
-        use_alternate_censoring = False 
-        with codecs.open(os.path.join(censor_target_dir, os.path.split(directory)[1], filename),
-                         'w', encoding='utf8') as of:
+        with codecs.open(output_file, 'w', encoding='utf8') as of:
             writer = csv.writer(of)
             header = next(reader)
             writer.writerow(header)
-            if 'latitude' in header:
-                lat_index = header.index('latitude')
-                lon_index = header.index('longitude')
-            elif 'position_lat' in header:
-                lat_index = header.index('position_lat')
-                lon_index = header.index('position_long')
-            else:
-                use_alternate_censoring=True
-                other_latlong_indexes = []
-                for names in ADDITIONAL_LATLONG:
-                    try:
-                        other_latlong_indexes.append( ( header.index(names[0]), header.index(names[1])) )
-                    except ValueError:
-                        continue 
-            #currently not in use
-            censorable_columns = [i for i, column in enumerate(header) if CENSOR_PARAMS.get(column, False)]
-            #currently in use 
-            should_censor = [CENSOR_PARAMS.get(column, False) for i, column in enumerate(header)]
+            pairs, use_alternate_censoring, should_censor = censor_plan(header)
             #print should_censor
-            for line in reader:
-                if not use_alternate_censoring:
-                    try:
-                        longitude, latitude = ( float(line[lon_index]), float(line[lat_index]) )
-                        if is_censorable(longitude, latitude):
-                            if not CENSOR_PARAMS['timestamp']:
-                                writer.writerow(censor_line(line, should_censor))
-                        else:
-                            writer.writerow(line)
-                    except ValueError:
-                        #likely has one or both of the longitude/latitude values missing
-                        #I do not personally have files like this (I think), but it is possible
-                        #will fail to censor latitude/longitude if the other is not present, but that's
-                        #not realistic
-                        print('....')
-                        writer.writerow(line)
-                else:
-                    will_censor = False 
-                    for latitude_idx, longitude_idx in other_latlong_indexes:
-                        try:
-                            latitude = float(line[latitude_idx])
-                            longitude = float(line[longitude_idx])
-                        except ValueError:
-                            #value of 'None' likely, will just ignore this...
-                            continue 
-                        will_censor = will_censor or is_censorable(latitude, longitude)
-                        if will_censor:
-                            break
-                    if will_censor:
-                        if not CENSOR_PARAMS['timestamp']:
-                            writer.writerow(censor_line(line, should_censor))
-                    else:
-                        writer.writerow(line)
+            while True:
+                lines = list(itertools.islice(reader, CSV_CHUNK_ROWS))
+                if not lines:
+                    break
+                will_censor, unparsed = censor_mask(
+                    lambda name: parse_coordinates(lines, header.index(name)), len(lines),
+                    pairs, use_alternate_censoring, censor_regions,
+                )
+                if not will_censor.any() and not unparsed.any():
+                    writer.writerows(lines)
+                    continue
+                writer.writerows(censor_rows(lines, will_censor, unparsed,
+                                             use_alternate_censoring, should_censor))
         print('transfered %s' % (os.path.join(directory, filename)))
+    return 0
+
+def censor_columns(columns, censor_regions):
+    """
+    returns a censored copy of columns, name -> (values, valid) as read_columns returns them
+    """
+    n_rows = len(next(iter(columns.values()))[0]) if columns else 0
+    if 'latitude' in columns:
+        latlong_names = [('latitude', 'longitude')]
+    elif 'position_lat' in columns:
+        latlong_names = [('position_lat', 'position_long')]
+    else:
+        latlong_names = [names for names in ADDITIONAL_LATLONG
+                         if names[0] in columns and names[1] in columns]
+    censored = np.zeros(n_rows, dtype=bool)
+    for latitude_name, longitude_name in latlong_names:
+        latitudes, latitude_valid = columns[latitude_name]
+        longitudes, longitude_valid = columns[longitude_name]
+        if latitudes.dtype.kind not in 'iuf' or longitudes.dtype.kind not in 'iuf':
+            continue
+        valid = latitude_valid & longitude_valid
+        censored[valid] |= censor_regions.mask(longitudes[valid], latitudes[valid])
+
+    censored_columns = OrderedDict()
+    for name, (values, valid) in columns.items():
+        if CENSOR_PARAMS['timestamp']:
+            values, valid = values[~censored], valid[~censored]
+        elif CENSOR_PARAMS.get(name, False):
+            # blank the values too, so nothing censored is left in the file
+            values = values.copy()
+            values[censored] = np.zeros(1, dtype=values.dtype)[0]
+            valid = valid & ~censored
+        censored_columns[name] = (values, valid)
+    return censored_columns
+
+def transfer_columns(filename, directory, censor_target_dir, censor_regions):
+    """
+    censors a parquet/npz file the way transfer_csv censors a CSV, except that censored
+    cells become missing values instead of CENSOR_STRING
+    """
+    target_file = os.path.join(censor_target_dir, os.path.split(directory)[1], filename)
+    if can_copy_uncensored(os.path.join(directory, filename), censor_regions):
+        copy_uncensored(os.path.join(directory, filename), target_file)
+        print('copied %s' % (os.path.join(directory, filename)))
+        return 0
+    columns, timezones = read_columns(os.path.join(directory, filename))
+    censored_columns = censor_columns(columns, censor_regions)
+    remove_target(target_file)
+    with open(target_file, 'wb') as f:
+        write_columns(f, censored_columns, os.path.splitext(filename)[1][1:], timezones)
+    print('transfered %s' % (os.path.join(directory, filename)))
+    return 0
 
 
 def load_censor_coordinates(censorfile):
-    # not great practice, but easy enough to use here
-    global CENSOR_COORDINATES 
+    """
+    returns the regions of censorfile as CensorRegions
+    """
+    censor_coordinates = []
     with open(censorfile,'r') as f:
         reader = csv.reader(f)
         header = next(reader)
@@ -196,49 +525,178 @@ def load_censor_coordinates(censorfile):
         lon_index = header.index('longitude')
         radius_index = header.index('radius')
         for line in reader:
-            CENSOR_COORDINATES.append({'latitude':float(line[lat_index]),
+            censor_coordinates.append({'latitude':float(line[lat_index]),
                 'longitude':float(line[lon_index]),
                 'radius':float(line[radius_index])}
                 )
-        print(CENSOR_COORDINATES )
-    print('loaded CENSOR_COORDINATES')
-    return 0
+    censor_regions = CensorRegions(censor_coordinates)
+    print('loaded %d censor regions (%d grid cells)' % (len(censor_regions), len(censor_regions.buckets)))
+    return censor_regions
 
-def transfer_gpx(filename, directory, censor_target_dir):
+def transfer_gpx(filename, directory, censor_target_dir, censor_regions):
     target_file = os.path.join(censor_target_dir, os.path.split(directory)[1], filename)
-    if os.path.isfile(target_file) and not (OVERWRITE or OVERWRITE_GPX):
-        return 1
-    with open(os.path.join(directory, filename),'r') as f:
-        data = f.read()
-        soup = BeautifulSoup(data, 'lxml',from_encoding="utf-8")
-    trkpts = soup.find_all('trkpt')
-    for pt in trkpts:
-        lat, lon = (float(pt.attrs['lat']), float(pt.attrs['lon']) )
-        will_censor = is_censorable(lon, lat)
-        if will_censor:
-            if CENSOR_PARAMS['time']:
-                pt.decompose()
-            else:
-                for child in pt.children:
-                    if isinstance(child, bs4.element.Tag):
-                        if CENSOR_PARAMS.get(child.name, False):
-                            child.decompose()
-                if CENSOR_PARAMS.get('lat', False):
-                    pt.attrs['lat'] = CENSOR_STRING
-                if CENSOR_PARAMS.get('lon', False):
-                    pt.attrs['lon'] = CENSOR_STRING 
-                
-    with codecs.open(os.path.join(censor_target_dir, os.path.split(directory)[1],
-                                  filename), 'w', encoding='utf8') as f:
-        try:
-            f.write(soup.prettify())
-        except:
-            print(filename )
-            print(directory )
-            raise Exception('fix that damn unicode bug')
+    bounds = gpx_bounds(os.path.join(directory, filename))
+    if bounds is not False and (bounds is None or not censor_regions.may_intersect(bounds)):
+        copy_uncensored(os.path.join(directory, filename), target_file)
+        print('copied %s' % '/'.join([directory,filename]))
+        return 0
+    remove_target(target_file)
+    # a censored point is dropped if its time is censored; otherwise its censored fields are
+    gpx_stream.censor_gpx(
+        os.path.join(directory, filename), target_file, censor_regions.mask, CENSOR_STRING,
+        drop_points=CENSOR_PARAMS['time'],
+        removed_children=[name for name, censored in CENSOR_PARAMS.items() if censored],
+        censored_attributes=[name for name in ['lat', 'lon'] if CENSOR_PARAMS.get(name, False)],
+    )
     print('processed %s' % '/'.join([directory,filename]))
     return 0 
 
+def censor_config_hash(censor_regions, censor_string=None):
+    """
+    hash of everything besides the source file that decides what a censored file looks like
+    """
+    if censor_string is None:
+        censor_string = CENSOR_STRING
+    config = {
+        'regions': [[float(cc['latitude']), float(cc['longitude']), float(cc['radius'])]
+                    for cc in censor_regions.regions],
+        'params': CENSOR_PARAMS,
+        'additional_latlong': ADDITIONAL_LATLONG,
+        'censor_string': censor_string,
+    }
+    return hashlib.blake2b(json.dumps(config, sort_keys=True).encode('utf8'),
+                           digest_size=20).hexdigest()
+
+class FusedCensor(object):
+    """
+    censoring done by the FIT converter on the rows it has in memory, as it writes them
+    (process_all --fused-censor)
+
+    the censored files are the ones transfer_csv and transfer_columns would write, and
+    they are recorded in the censored folder's manifest, so the censor stage skips them
+    """
+
+    def __init__(self, censor_regions, censor_target_dir, censor_string=None):
+        if censor_string is None:
+            censor_string = CENSOR_STRING
+        self.censor_regions = censor_regions
+        self.censor_target_dir = censor_target_dir
+        self.censor_string = censor_string
+        self.censored_cell = csv_cell(censor_string)
+        self.options = {'censor_config': censor_config_hash(censor_regions, censor_string)}
+        # (manifest source, source fingerprint) of the files censored since pop_entries
+        self.entries = []
+
+    def target(self, directory, filename):
+        """
+        returns (manifest source, path) of the censored copy of directory/filename
+        """
+        source = os.path.join(os.path.split(directory)[1], filename)
+        path = os.path.join(self.censor_target_dir, source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return source, path
+
+    def plan(self, header):
+        return censor_plan(header)
+
+    def censor_chunk(self, plan, lines, text_columns, coordinates):
+        """
+        returns the censored version of a chunk of CSV lines, whose cells (already quoted)
+        are text_columns, or None if the chunk is written as is
+        """
+        pairs, use_alternate_censoring, should_censor = plan
+        will_censor, unparsed = censor_mask(coordinates, len(lines), pairs,
+                                            use_alternate_censoring, self.censor_regions)
+        # rows that are missing coordinates are written as they are (see censor_rows)
+        if not use_alternate_censoring:
+            will_censor &= ~unparsed
+        if not will_censor.any():
+            return None
+        censored_lines = list(lines)
+        for row in np.flatnonzero(will_censor).tolist():
+            if CENSOR_PARAMS['timestamp']:
+                censored_lines[row] = None
+            else:
+                censored_lines[row] = ','.join(censor_line([column[row] for column in text_columns],
+                                                           should_censor, self.censored_cell))
+        return [line for line in censored_lines if line is not None]
+
+    def censor_columns(self, columns):
+        return censor_columns(columns, self.censor_regions)
+
+    def may_censor(self, bounds):
+        return bounds is not None and self.censor_regions.may_intersect(bounds)
+
+    def copy_uncensored(self, source, target):
+        copy_uncensored(source, target)
+
+    def record(self, source, fingerprint):
+        self.entries.append((source, fingerprint))
+
+    def pop_entries(self):
+        entries = self.entries
+        self.entries = []
+        return entries
+
+def fused_censor(censorfile, censor_target_dir, censor_string):
+    return FusedCensor(load_censor_coordinates(censorfile), censor_target_dir, censor_string)
+
+def is_overwritten(filename):
+    if GPX_REGEX.match(filename):
+        return OVERWRITE or OVERWRITE_GPX
+    return OVERWRITE or OVERWRITE_CSV
+
+def censor_directory(manifest, options, directory, censor_target_dir, censor_regions):
+    """
+    censors the files in directory that are new or changed since they were last censored
+    with the same configuration; returns their paths relative to censor_target_dir
+    """
+    csv_files = find_csv(directory)
+    gpx_files = find_gpx(directory)
+    column_files = find_columns(directory)
+    #print gpx_files
+    targets = []
+    for transfer, filenames in [(transfer_csv, csv_files), (transfer_columns, column_files),
+                                (transfer_gpx, gpx_files)]:
+        for filename in filenames:
+            # sources are keyed by their path in censor_target_dir, which is also their output
+            target = os.path.join(os.path.split(directory)[1], filename)
+            targets.append(target)
+            entry = manifest.lookup(CENSOR_STAGE, target)
+            fingerprint = file_fingerprint(os.path.join(directory, filename), entry)
+            if (not is_overwritten(filename)
+                    and manifest.is_current(entry, fingerprint, options, censor_target_dir)
+                    and not is_linked(os.path.join(directory, filename),
+                                      os.path.join(censor_target_dir, target))):
+                manifest.update_fingerprint(entry, fingerprint)
+                continue
+            try:
+                with profiling.measure_file('censor', target, os.path.join(directory, filename)) as measurement:
+                    transfer(filename, directory, censor_target_dir, censor_regions)
+                    measurement.add_outputs([os.path.join(censor_target_dir, target)])
+            except Exception as e:
+                print('!')
+                print(filename )
+                raise e 
+            manifest.record(CENSOR_STAGE, target, fingerprint, [target], options=options)
+    return targets
+
+def remove_orphans(manifest, censor_search_directories, censor_target_dir, targets):
+    """
+    removes censored files in the searched directories whose source is gone
+    """
+    searched = set(os.path.split(directory)[1] for directory in censor_search_directories)
+    targets = set(targets)
+    removed = 0
+    for source in manifest.sources(CENSOR_STAGE):
+        if source in targets or os.path.split(source)[0] not in searched:
+            continue
+        remove_target(os.path.join(censor_target_dir, source))
+        manifest.remove(CENSOR_STAGE, source)
+        removed += 1
+    if removed:
+        print('removed %d censored files whose source is gone' % removed)
+
 def make_directories(censor_search_directories, censor_target_dir):
     counter = 0
     for directory in censor_search_directories:
@@ -248,8 +706,11 @@ def make_directories(censor_search_directories, censor_target_dir):
             counter += 1
     print('made %d necessary directories' % counter )
 
-def zip_target_directory( archive_target_dir, zip_filename, target_directory):
-    shutil.make_archive(os.path.join(archive_target_dir, zip_filename), 'zip', target_directory)
+def zip_target_directory( archive_target_dir, zip_filename, target_directory, archive_format='zip',
+                          archive_workers=None):
+    # updates the archive from a previous run instead of starting over (see archive.py)
+    archive.build_archive(archive_target_dir, zip_filename, target_directory, archive_format,
+                          archive_workers)
 
 def main(
         censor_search_directories,
@@ -260,45 +721,45 @@ def main(
 ):
     #os.chdir(ROOT_DIRECTORY)
     if censorfile != '':
-        load_censor_coordinates(censorfile)
+        censor_regions = load_censor_coordinates(censorfile)
 
     # quick h4ck
     global CENSOR_STRING
     CENSOR_STRING = censor_string
 
     if censorfile != '':
-        make_directories(censor_search_directories, censor_target_dir)
-        for directory in censor_search_directories:
-            print('searching %s' % directory )
-            csv_files = find_csv(directory)
-            gpx_files = find_gpx(directory)
-            #print gpx_files
-            for filename in csv_files:
-                try:
-                    transfer_csv(filename, directory, censor_target_dir)
-                except Exception as e:
-                    print('!')
-                    print(filename )
-                    raise e 
-            for filename in gpx_files:
-                transfer_gpx(filename, directory, censor_target_dir)
+        with profiling.stage('censor'):
+            make_directories(censor_search_directories, censor_target_dir)
+            manifest = Manifest(censor_target_dir)
+            censor_options = {'censor_config': censor_config_hash(censor_regions)}
+            targets = []
+            for directory in censor_search_directories:
+                print('searching %s' % directory )
+                targets.extend(censor_directory(manifest, censor_options, directory, censor_target_dir,
+                                                censor_regions))
+            remove_orphans(manifest, censor_search_directories, censor_target_dir, targets)
+            manifest.close()
     if options['archive_results']:
-        os.makedirs(options['archive_output_dir'], exist_ok=True)
-        for file in options['archive_extra_files']:
+        with profiling.stage('archive'):
+            os.makedirs(options['archive_output_dir'], exist_ok=True)
+            for file in options['archive_extra_files']:
+                # copy2 keeps the mtime, so an unchanged file is not archived again
+                if options['archive_censored_only']:
+                    shutil.copy2(file, os.path.join(censor_target_dir, os.path.split(file)[1]))
+                else:
+                    shutil.copy2(file, os.path.join(options['root_subject_dir'], os.path.split(file)[1]))
+
+            archive_format = options.get('archive_format', 'zip')
+            archive_workers = options.get('archive_workers')
             if options['archive_censored_only']:
-                shutil.copyfile(file, os.path.join(censor_target_dir, os.path.split(file)[1]))
+                zip_target_directory(options['archive_output_dir'], options['archive_filename'],
+                                     censor_target_dir, archive_format, archive_workers
+                )
             else:
-                shutil.copyfile(file, os.path.join(options['root_subject_dir'], os.path.split(file)[1]))
-
-        if options['archive_censored_only']:
-            zip_target_directory(options['archive_output_dir'], options['archive_filename'],
-                                 censor_target_dir
-            )
-        else:
-            zip_target_directory(options['archive_output_dir'], options['archive_filename'],
-                                 options['root_subject_dir'],
-            )
-        print('made censored files and zipped them!')
+                zip_target_directory(options['archive_output_dir'], options['archive_filename'],
+                                     options['root_subject_dir'], archive_format, archive_workers
+                )
+            print('made censored files and zipped them!')
 
 
 if __name__=='__main__':
@@ -4,17 +4,26 @@ currently recommended to keep at =True, since event type is placed in filename
 of created objects
 """
 
-import csv
 import os
+import io
+import collections
+import multiprocessing
+import shutil
+import warnings
 #to install fitparse, run 
 #sudo pip3 install -e git+https://github.com/dtcooper/python-fitparse#egg=python-fitparse
 import fitparse
 import pytz
 from copy import copy
-from tzwhere import tzwhere
 
-print('Initializing tzwhere')
-tzwhere = tzwhere.tzwhere()
+# replaces tzwhere.tzwhere(); the index is built on first use and memory-mapped afterwards
+import timezone_index
+import fast_fit
+import activity_cache
+import profiling
+from track_columns import (CSV_LINE_TERMINATOR, SIDECAR_SUFFIX, ColumnTable, csv_line,
+                           merge_bounds, output_extension, write_columns, write_sidecar)
+from manifest import CENSOR_STAGE, FIT_STAGE, Manifest, content_hash, file_fingerprint
 
 tz_fields = ['timestamp_utc', 'timezone']
 
@@ -49,91 +58,429 @@ start_fields += tz_fields
 
 #
 all_allowed_fields = set(allowed_fields + lap_fields + start_fields)
+# fields the fast decoder has to produce; 'sport' names the output files
+decoded_fields = all_allowed_fields | {'sport'}
 
 UTC = pytz.UTC
 CST = pytz.timezone('US/Central')
 
 
-#files beyond the main file are assumed to be created, as the log will be updated only after they are created
+#files beyond the main file are assumed to be created, as the manifest will be updated only after they are created
 ALT_FILENAME = True
+# processed files used to be listed here; an existing log is migrated into the manifest
 ALT_LOG_ = 'file_log.log'
 
-def read_log(log_path):
-    with open(os.path.join(log_path, ALT_LOG_), 'r') as f:
-        lines = f.read().split()
-    return lines
+# timezone lookups go through this cache when it is set (see main); it lives next to the manifest
+TZ_CACHE = None
 
-def append_log(filename, log_path):
-    with open(os.path.join(log_path, ALT_LOG_), 'a') as f:
-        f.write(filename)
-        f.write('\n')
-    return None 
+# censoring applied to the outputs as they are written (censor_and_package.FusedCensor), if any
+FUSED_CENSOR = None
+
+# decoded files are read from and stored in this activity_cache.ActivityCache, if any
+ACTIVITY_CACHE = None
+
+# jobs handed to each worker process ahead of the one whose result is awaited
+PENDING_JOBS_PER_WORKER = 2
+
+def lookup_timezone(latitude, longitude):
+    if TZ_CACHE is not None:
+        return TZ_CACHE.tzNameAt(latitude, longitude)
+    return timezone_index.get_timezone_index().tzNameAt(latitude, longitude)
+
+def init_worker(tz_cache_path, fused_censor=None, fit_cache=None, profile_settings=None):
+    global TZ_CACHE, FUSED_CENSOR, ACTIVITY_CACHE
+    profiling.init_worker(profile_settings)
+    timezone_index.get_timezone_index()
+    TZ_CACHE = timezone_index.TimezoneCache(tz_cache_path)
+    FUSED_CENSOR = fused_censor
+    ACTIVITY_CACHE = fit_cache
+
+def decoder_version(fit_decoder):
+    if fit_decoder == 'fast':
+        return 'fast_fit %d' % fast_fit.DECODER_VERSION
+    return 'fitparse %s' % fitparse.__version__
+
+def cache_version(fit_decoder):
+    # the fast decoder reads fitparse's profile and falls back to fitparse, so what it
+    # decodes also depends on the fitparse version
+    if fit_decoder == 'fast':
+        return '%s %s' % (decoder_version('fast'), decoder_version('fitparse'))
+    return decoder_version(fit_decoder)
+
+def accepted_decoders(fit_decoder):
+    # versions a file converted with fit_decoder may have been recorded with; the fast
+    # decoder falls back to fitparse, so a file it could not read is not converted again
+    if fit_decoder == 'fast':
+        return [decoder_version('fast'), decoder_version('fitparse')]
+    return [decoder_version(fit_decoder)]
+
+def conversion_options(fit_ignore_splits_and_laps, fit_compact_numeric, fit_output_format):
+    # settings that change the outputs; a file converted with other settings is converted again
+    return {
+        'ignore_splits_and_laps': bool(fit_ignore_splits_and_laps),
+        'compact_numeric': bool(fit_compact_numeric),
+        'output_format': fit_output_format,
+    }
+
+def remove_outputs(fit_processed_csv_dir, outputs):
+    for output in outputs:
+        for path in [os.path.join(fit_processed_csv_dir, output),
+                     os.path.join(fit_processed_csv_dir, output) + SIDECAR_SUFFIX]:
+            if os.path.exists(path):
+                os.remove(path)
 
 def main(
         fit_target_dir,
         fit_processed_csv_dir,
         fit_overwrite,
         fit_ignore_splits_and_laps,
+        fit_workers=1,
+        fit_decoder='fitparse',
+        fit_compact_numeric=False,
+        fit_output_format='csv',
+        fit_censor=None,
+        fit_files=None,
+        fit_cache=None,
 ):
+    """
+    fit_censor, a censor_and_package.FusedCensor, censors the outputs as they are written
+
+    fit_files names the FIT files in fit_target_dir to convert, in order; it can be an
+    iterator that waits for files while they are being imported (see
+    import_and_process_garmin_fit.iter_imported), and each file is converted as soon as
+    it comes out. By default it is every FIT file in fit_target_dir
+
+    fit_cache, an activity_cache.ActivityCache, keeps decoded files, so they are not
+    decoded again when converted again
+    """
+
+    if fit_files is None:
+        files = os.listdir(fit_target_dir)
+        # sorted so that the manifest (and which file keeps a colliding output name) come out
+        # the same on every run
+        fit_files = sorted(file for file in files if file[-4:].lower()=='.fit')
+
+    manifest = Manifest(fit_processed_csv_dir)
+    manifest.migrate_log(os.path.join(fit_processed_csv_dir, ALT_LOG_), FIT_STAGE)
+    options = conversion_options(fit_ignore_splits_and_laps, fit_compact_numeric, fit_output_format)
+    decoder_versions = accepted_decoders(fit_decoder)
 
-    ALT_LOG = os.path.join(fit_processed_csv_dir, ALT_LOG_)
-    files = os.listdir(fit_target_dir)
-    fit_files = [file for file in files if file[-4:].lower()=='.fit']
-    overwritten_files = []
-    
-    if not os.path.exists(ALT_LOG):
-        os.system('touch %s' % ALT_LOG)
-        file_list = []
+    global TZ_CACHE, FUSED_CENSOR, ACTIVITY_CACHE
+    FUSED_CENSOR = fit_censor
+    ACTIVITY_CACHE = fit_cache
+    if fit_cache is not None:
+        fit_cache.count()
+    censor_manifest = None
+    if fit_censor is not None:
+        os.makedirs(fit_censor.censor_target_dir, exist_ok=True)
+        censor_manifest = Manifest(fit_censor.censor_target_dir)
+    tz_cache_path = os.path.join(fit_processed_csv_dir, timezone_index.CACHE_FILENAME)
+    TZ_CACHE = timezone_index.TimezoneCache(tz_cache_path)
+
+    # manifest entry and fingerprint of every file to convert
+    sources = {}
+
+    def iter_jobs():
+        for file in fit_files:
+            entry = manifest.lookup(FIT_STAGE, file)
+            fingerprint = file_fingerprint(os.path.join(fit_target_dir, file), entry)
+            if not fit_overwrite and manifest.is_current(entry, fingerprint, options, fit_processed_csv_dir,
+                                                         decoder_versions):
+                manifest.update_fingerprint(entry, fingerprint)
+                continue
+            sources[file] = (entry, fingerprint)
+            yield (
+                file,
+                fit_target_dir,
+                fit_processed_csv_dir,
+                fit_ignore_splits_and_laps,
+                fit_decoder,
+                fit_compact_numeric,
+                fit_output_format,
+                fingerprint['hash'],
+            )
+
+    # output name -> the file it was last converted from in this run
+    placed = {}
+
+    def record(result):
+        file, outputs, placements, used_decoder, tz_cache_changes, activity_cache_changes = result
+        TZ_CACHE.merge(tz_cache_changes)
+        if fit_cache is not None:
+            fit_cache.merge(activity_cache_changes)
+        # outputs are named after the start of the activity, so two files can share a name;
+        # they are moved into place here, in job order, so the later file's are kept
+        # whether or not workers finished in that order
+        for other in sorted(set(placed[output] for output in outputs if output in placed)):
+            print('%s and %s both convert to %s; keeping the one from %s' % (
+                other, file, outputs[0], file))
+        placed.update((output, file) for output in outputs)
+        place_outputs(placements, fit_processed_csv_dir, fit_censor)
+        if fit_censor is not None:
+            for source, fingerprint in fit_censor.pop_entries():
+                censor_manifest.record(CENSOR_STAGE, source, fingerprint, [source],
+                                       options=fit_censor.options)
+        entry, fingerprint = sources[file]
+        if entry is not None and entry['outputs']:
+            # the start of the activity may have changed with the file
+            remove_outputs(fit_processed_csv_dir, [output for output in entry['outputs']
+                                                   if output not in placed])
+        manifest.record(FIT_STAGE, file, fingerprint, outputs, decoder_version=used_decoder,
+                        options=options)
+
+    jobs = iter_jobs()
+    workers = fit_workers
+    if isinstance(fit_files, list):
+        # all files are known up front, so no more workers are started than there are jobs
+        jobs = list(jobs)
+        workers = min(fit_workers, len(jobs))
+    if workers > 1:
+        # load (or build) the index before forking so that workers share the mapping
+        timezone_index.get_timezone_index()
+        # workers never touch the manifest; this process records results in job order as they
+        # come in, with at most PENDING_JOBS_PER_WORKER jobs per worker handed out ahead
+        with multiprocessing.Pool(workers, initializer=init_worker,
+                                  initargs=(tz_cache_path, fit_censor, fit_cache,
+                                            profiling.settings())) as pool:
+            pending = collections.deque()
+            for job in jobs:
+                pending.append(pool.apply_async(convert_job, (job,)))
+                while pending and (pending[0].ready()
+                                   or len(pending) >= workers * PENDING_JOBS_PER_WORKER):
+                    record(pending.popleft().get())
+            while pending:
+                record(pending.popleft().get())
     else:
-        file_list = read_log(fit_processed_csv_dir)
-        
-    for file in fit_files:
-        is_overwritten=False
-        if file in file_list and not fit_overwrite:
-            continue
-        elif file in file_list:
-            is_overwritten=True
-            
-        new_filename = file[:-4] + '.csv'
-        
-        fitfile = fitparse.FitFile(
-            os.path.join(fit_target_dir, file),  
-            data_processor=fitparse.StandardUnitsDataProcessor()
-        )
-        
-        print('converting %s' % os.path.join(fit_target_dir, file))
-        write_fitfile_to_csv(
+        for job in jobs:
+            record(convert_job(job))
+    manifest.close()
+    if censor_manifest is not None:
+        censor_manifest.close()
+    if sources:
+        TZ_CACHE.save()
+    print('timezone cache: %d hits, %d misses, %d cells' % (
+        TZ_CACHE.hits, TZ_CACHE.misses, len(TZ_CACHE.entries)))
+    if fit_cache is not None:
+        print('activity cache: %d hits, %d misses, %.1f MB' % (
+            fit_cache.hits, fit_cache.misses, fit_cache.size / 1e6))
+    print('finished conversions')
+
+def convert_job(job):
+    """
+    converts a single FIT file; can be run in a worker process
+    returns (filename, output filenames, placements, decoder version, timezone cache
+    changes, activity cache changes); the outputs are left in temporary files for the
+    caller to place_outputs, so it can update the manifests and the caches too
+    """
+    (file, fit_target_dir, fit_processed_csv_dir, fit_ignore_splits_and_laps, fit_decoder,
+     fit_compact_numeric, fit_output_format, content_hash) = job
+    new_filename = file[:-4] + '.csv'
+    path = os.path.join(fit_target_dir, file)
+    placements = []
+
+    def convert(fitfile):
+        return write_fitfile_to_csv(
             fitfile,
             new_filename,
             file,
             fit_target_dir,
             fit_processed_csv_dir,
-            is_overwritten,
-            fit_ignore_splits_and_laps,
+            fit_ignore_splits_and_laps=fit_ignore_splits_and_laps,
+            update_manifest=False,
+            compact_numeric=fit_compact_numeric,
+            output_format=fit_output_format,
+            censor=FUSED_CENSOR,
+            placements=placements,
         )
-    print('finished conversions')
+
+    with profiling.measure_file('fit', file, path) as measurement:
+        print('converting %s' % path)
+        outputs = None
+        used_decoder = decoder_version(fit_decoder)
+        caching = ACTIVITY_CACHE is not None
+        if caching:
+            cached = ACTIVITY_CACHE.load(content_hash, cache_version(fit_decoder))
+            if cached is not None:
+                outputs = convert(cached)
+                used_decoder = cached.decoder_version
+                caching = False
+        recording = None
+        if outputs is None and fit_decoder == 'fast':
+            try:
+                # everything is decoded for the cache, so other fields can be exported from it later
+                fitfile = fast_fit.FastFitFile(path, fast_fit.ALL_FIELDS if caching else decoded_fields)
+                if caching:
+                    fitfile = recording = activity_cache.RecordingFitFile(iter_message_fields(fitfile))
+                outputs = convert(fitfile)
+            except fast_fit.FastFitUnsupported as e:
+                print('fast decoder could not read %s (%s); using fitparse' % (file, e))
+                used_decoder = decoder_version('fitparse')
+
+        if outputs is None:
+            fitfile = fitparse.FitFile(
+                path,
+                data_processor=fitparse.StandardUnitsDataProcessor()
+            )
+            if caching:
+                fitfile = recording = activity_cache.RecordingFitFile(iter_message_fields(fitfile))
+            outputs = convert(fitfile)
+        if caching:
+            ACTIVITY_CACHE.store(content_hash, cache_version(fit_decoder), recording, used_decoder)
+        measurement.add_outputs(placement[0] for placement in placements)
+    tz_cache_changes = TZ_CACHE.pop_changes() if TZ_CACHE is not None else ([], 0, 0)
+    activity_cache_changes = ACTIVITY_CACHE.pop_changes() if ACTIVITY_CACHE is not None else None
+    return file, outputs, placements, used_decoder, tz_cache_changes, activity_cache_changes
 
 def lap_filename(output_filename):
-    return output_filename[:-4] + '_laps.csv'
+    root, extension = os.path.splitext(output_filename)
+    return root + '_laps' + extension
 
 def start_filename(output_filename):
-    return output_filename[:-4] + '_starts.csv'
-
-def get_timestamp(messages):
-    for m in messages:
-        fields = m.fields
-        for f in fields:
-            if f.name == 'timestamp':
-                return f.value
-    return None
-
-def get_event_type(messages):
-    for m in messages:
-        fields = m.fields
-        for f in fields:
-            if f.name == 'sport':
-                return f.value
-    return None
+    root, extension = os.path.splitext(output_filename)
+    return root + '_starts' + extension
+
+# message types that can end up in the CSVs; anything else is only scanned for the
+# timestamp/sport/position used to name and localize the files
+RECORD_MESSAGES = {'record'}
+LAP_MESSAGES = {'lap'}
+START_MESSAGES = {'event'}
+
+def iter_message_fields(fitfile):
+    """
+    yields (message name, [(field name, value), ...]) for each data message, in file order
+    """
+    if isinstance(fitfile, (fast_fit.FastFitFile, activity_cache.RecordingFitFile,
+                            activity_cache.CachedActivity)):
+        for message in fitfile.iter_message_fields():
+            yield message
+        return
+    # fitparse (1.2) keeps every message it has parsed, and has no way to stream them; the
+    # list is emptied so memory stays flat, if it is there (it is not public)
+    parsed = getattr(fitfile, '_messages', None)
+    if not isinstance(parsed, list):
+        parsed = None
+    for m in fitfile.get_messages():
+        yield m.name, [(field.name, field.value) for field in m.fields]
+        if parsed is not None:
+            del parsed[:]
+
+# once the timezone is known, rows are localized and written in chunks of this many
+CHUNK_ROWS = 4096
+
+def new_output(fields, required_fields, message_types):
+    return {
+        'fields': fields,
+        'required_fields': required_fields,
+        'message_types': message_types,
+        # rows not written yet, including those waiting for the timezone
+        'table': ColumnTable(fields),
+        'file': None,
+        # totals of what has been written, for the sidecar
+        'rows': 0,
+        'bounds': None,
+        # with fused censoring: the censored copy, only opened once a row needs censoring
+        'censor_plan': None,
+        'censored_file': None,
+        'hash': None,
+    }
+
+def count_rows(output):
+    table = output['table']
+    output['rows'] += len(table)
+    output['bounds'] = merge_bounds(output['bounds'], table.bounds())
+
+def write_table(output, local_tz, tz_name, compact_numeric=False, censor=None):
+    table = output['table']
+    # outputs without a file are in a typed format, written in one go by write_typed_table
+    if output['file'] is None or not len(table):
+        return
+    table.localize(local_tz, tz_name)
+    if censor is None:
+        table.write_csv(output['file'], output['fields'], compact_numeric)
+    else:
+        write_censored_table(output, censor, compact_numeric)
+    count_rows(output)
+    table.clear()
+
+def write_censored_table(output, censor, compact_numeric):
+    """
+    writes the rows of the table to the output and, censored, to its censored copy
+    """
+    table = output['table']
+    columns = [table.text_column(name, compact_numeric) for name in output['fields']]
+    lines = list(map(','.join, zip(*columns)))
+    text = CSV_LINE_TERMINATOR.join(lines) + CSV_LINE_TERMINATOR
+    censored_lines = censor.censor_chunk(output['censor_plan'], lines, columns,
+                                         lambda name: table.parsed_column(name, compact_numeric))
+    if censored_lines is not None and output['censored_file'] is None:
+        # up to here both files are the same
+        output['file'].flush()
+        shutil.copyfile(output['file'].name, censored_filename(output['file'].name))
+        output['censored_file'] = open(censored_filename(output['file'].name), 'a')
+    write_hashed(output, text)
+    if output['censored_file'] is not None:
+        if censored_lines is None:
+            output['censored_file'].write(text)
+        elif censored_lines:
+            output['censored_file'].write(
+                CSV_LINE_TERMINATOR.join(censored_lines) + CSV_LINE_TERMINATOR)
+
+def write_hashed(output, text):
+    output['file'].write(text)
+    if output['hash'] is not None:
+        output['hash'].update(text.encode(output['file'].encoding))
+
+def write_typed_table(output, filename, local_tz, tz_name, output_format, censor=None):
+    table = output['table']
+    table.localize(local_tz, tz_name)
+    columns, timezones = table.typed_columns(output['fields'])
+    count_rows(output)
+    if censor is None:
+        with open(filename, 'wb') as f:
+            write_columns(f, columns, output_format, timezones)
+        return
+    data = io.BytesIO()
+    write_columns(data, columns, output_format, timezones)
+    output['hash'].update(data.getbuffer())
+    with open(filename, 'wb') as f:
+        f.write(data.getbuffer())
+    if censor.may_censor(output['bounds']):
+        with open(censored_filename(filename), 'wb') as f:
+            write_columns(f, censor.censor_columns(columns), output_format, timezones)
+
+def censored_filename(temporary_file):
+    return temporary_file + '.censored'
+
+def finish_censored(temporary_file, directory, filename, censor, output_hash):
+    """
+    moves the censored copy of an output into place, or links the output there if
+    nothing in it needed censoring, and notes it for the censor stage's manifest
+    """
+    output_path = os.path.join(directory, filename)
+    source, target = censor.target(directory, filename)
+    if os.path.exists(censored_filename(temporary_file)):
+        os.replace(censored_filename(temporary_file), target)
+    else:
+        censor.copy_uncensored(output_path, target)
+    stat = os.stat(output_path)
+    censor.record(source, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                           'hash': output_hash})
+
+def place_outputs(placements, fit_processed_csv_dir, censor=None):
+    """
+    moves finished outputs into place with their sidecars (and censored copies);
+    placements are (temporary file, filename, rows, bounds, content hash) from
+    write_fitfile_to_csv
+    """
+    for temporary_file, filename, rows, bounds, output_hash in placements:
+        os.replace(temporary_file, os.path.join(fit_processed_csv_dir, filename))
+        write_sidecar(os.path.join(fit_processed_csv_dir, filename), rows, bounds)
+        if censor is not None:
+            finish_censored(temporary_file, fit_processed_csv_dir, filename, censor, output_hash)
+
+def temporary_filename(output_filename):
+    directory, filename = os.path.split(output_filename)
+    return os.path.join(directory, '.%s.%d.tmp' % (filename, os.getpid()))
 
 def write_fitfile_to_csv(
         fitfile,
@@ -141,132 +488,194 @@ def write_fitfile_to_csv(
         original_filename=None,
         fit_target_dir=None, #raises errors if not defined
         fit_processed_csv_dir=None, #raises errors if not defined
-        is_overwritten=False,
-        fit_ignore_splits_and_laps=False
+        is_overwritten=None,
+        fit_ignore_splits_and_laps=False,
+        *,
+        update_manifest=True,
+        compact_numeric=False,
+        output_format='csv',
+        censor=None,
+        placements=None,
 ):
+    """
+    converts the messages of fitfile to CSVs (or parquet/npz files) in a single pass
+
+    the output names depend on the first timestamp and sport in the file, which may
+    only show up late, so rows are streamed to temporary files that are renamed at the end;
+    rows are buffered by column and written in chunks, and rows seen before the
+    timezone is known are held back until it is; typed formats are written once at the end
+
+    with censor (a censor_and_package.FusedCensor), censored copies are written from the
+    same rows, so the censor stage does not have to read the outputs again
+
+    with placements (a list), the finished temporary files are added to it rather than
+    moved into place, for place_outputs to do in the caller's order
+
+    is_overwritten is deprecated and ignored: the manifest entry is replaced whether or not
+    the file was converted before (update_manifest=False leaves it alone)
+
+    returns the names of the files written
+    """
+    if is_overwritten is not None:
+        warnings.warn('is_overwritten is ignored; use update_manifest', DeprecationWarning,
+                      stacklevel=2)
     tz_name = ''
     local_tz = CST
     changed_tz = False
     position_long = None
     position_lat = None
-    messages = fitfile.messages
-    data = []
-    lap_data = []
-    start_data = []
     #this should probably work, but it's possibly 
     #based on a certain version of the file/device
-    timestamp = get_timestamp(messages)
-    event_type = get_event_type(messages)
-    if event_type is None:
-        event_type = 'other'
-    output_file = event_type + '_' + timestamp.strftime('%Y-%m-%d_%H-%M-%S.csv')
-    
-    for m in messages:
-        skip=False
-        skip_lap = False 
-        skip_start = False 
-        if not hasattr(m, 'fields'):
-            continue
-        fields = m.fields
-        #check for important data types
-        mdata = {}
-        for field in fields:
-            if not changed_tz and field.name in ['position_lat','position_long', 'start_position_lat','start_position_long']:
-                if 'lat' in field.name:
-                    try:
-                        position_lat = float(field.value)
-                    except TypeError:
-                        pass
-                else:
-                    try:
-                        position_long = float(field.value)
-                    except TypeError:
-                        pass
-                if position_lat is not None and position_long is not None:
-                    changed_tz = True
-                    tz_name = tzwhere.tzNameAt(position_lat, position_long)
-                    if tz_name is None:
-                        for latoff in [-0.1, 0, 0.1]:
-                            for longoff in [-0.1, 0, 0.1]:
-                                tz_name = tzwhere.tzNameAt(
-                                    position_lat + latoff,
-                                    position_long + longoff
-                                )
-                                if tz_name is not None:
-                                    break
-                                
-                    try:
-                        local_tz = pytz.timezone(tz_name)
-                    except Exception as e:
-                        print('TZ NAME: %s' % tz_name)
-                        print('lat/lon: (%s/%s)' % (position_lat, position_long))
-                        print('outfile name: %s' % output_file)
-                        raise e
-                    if tz_name != 'US/Central':
-                        print('Using timezone %s' % tz_name)
-                    
-                
-            if field.name in all_allowed_fields:
-                # currently saving timezone conversion to end, but keeping this here for now
-                if field.name=='timestamp' and False:
-                    mdata[field.name] = UTC.localize(field.value).astimezone(local_tz)
-                else:
-                    mdata[field.name] = field.value
-        # this is sort of a janky way of determining field type, but it works for now
-        for rf in required_fields:
-            if rf not in mdata:
-                skip=True
-        for lrf in lap_required_fields:
-            if lrf not in mdata:
-                skip_lap = True 
-        for srf in start_required_fields:
-            if srf not in mdata:
-                skip_start = True
-        if not skip:
-            data.append(mdata)
-        elif not skip_lap:
-            lap_data.append(mdata)
-        elif not skip_start:
-            start_data.append(mdata)
-
-    # localize timezone
-    for row in data + lap_data + start_data:
-        if 'timestamp' in row:
-            row['timestamp_utc'] = row['timestamp']
-            row['timestamp'] = UTC.localize(row['timestamp']).astimezone(local_tz)
-            row['timezone'] = tz_name
-            
-    #write to csv
-    #general track info
-    with open(os.path.join(fit_processed_csv_dir, output_file), 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(allowed_fields)
-        for entry in data:
-            writer.writerow([ str(entry.get(k, '')) for k in allowed_fields])
+    timestamp = None
+    event_type = None
 
+    outputs = [new_output(allowed_fields, required_fields, RECORD_MESSAGES)]
     if not fit_ignore_splits_and_laps:
-        #lap info
-        with open(os.path.join(fit_processed_csv_dir, lap_filename(output_file)), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(lap_fields)
-            for entry in lap_data:
-                writer.writerow([ str(entry.get(k, '')) for k in lap_fields])
-        #start/stop info
-        with open(os.path.join(fit_processed_csv_dir, start_filename(output_file)), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerow(start_fields)
-            for entry in start_data:
-                writer.writerow([ str(entry.get(k, '')) for k in start_fields])
+        outputs.append(new_output(lap_fields, lap_required_fields, LAP_MESSAGES))
+        outputs.append(new_output(start_fields, start_required_fields, START_MESSAGES))
+    output_types = {}
+    for output in outputs:
+        for message_type in output['message_types']:
+            output_types[message_type] = output
+    temporary_files = [temporary_filename(os.path.join(fit_processed_csv_dir, output_file + str(i)))
+                       for i in range(len(outputs))]
+
+    try:
+        for output in outputs:
+            if censor is not None:
+                output['hash'] = content_hash()
+                output['censor_plan'] = censor.plan(output['fields'])
+        if output_format == 'csv':
+            for output, temporary_file in zip(outputs, temporary_files):
+                output['file'] = open(temporary_file, 'w')
+                write_hashed(output, csv_line(output['fields']))
+
+        messages = 0
+        for messages, (message_type, fields) in enumerate(iter_message_fields(fitfile), 1):
+            if timestamp is None or event_type is None or not changed_tz:
+                for name, value in fields:
+                    if timestamp is None and name == 'timestamp':
+                        timestamp = value
+                    elif event_type is None and name == 'sport':
+                        event_type = value
+                    elif not changed_tz and name in ['position_lat','position_long', 'start_position_lat','start_position_long']:
+                        if 'lat' in name:
+                            try:
+                                position_lat = float(value)
+                            except TypeError:
+                                pass
+                        else:
+                            try:
+                                position_long = float(value)
+                            except TypeError:
+                                pass
+                        if position_lat is not None and position_long is not None:
+                            changed_tz = True
+                            tz_name = lookup_timezone(position_lat, position_long)
+                            if tz_name is None:
+                                for latoff in [-0.1, 0, 0.1]:
+                                    for longoff in [-0.1, 0, 0.1]:
+                                        tz_name = lookup_timezone(
+                                            position_lat + latoff,
+                                            position_long + longoff
+                                        )
+                                        if tz_name is not None:
+                                            break
+
+                            try:
+                                local_tz = pytz.timezone(tz_name)
+                            except Exception as e:
+                                print('TZ NAME: %s' % tz_name)
+                                print('lat/lon: (%s/%s)' % (position_lat, position_long))
+                                print('source file: %s' % original_filename)
+                                raise e
+                            if tz_name != 'US/Central':
+                                print('Using timezone %s' % tz_name)
+                            # everything held back can be written now
+                            for output in outputs:
+                                write_table(output, local_tz, tz_name, compact_numeric, censor)
+
+            output = output_types.get(message_type)
+            if output is None:
+                continue
+            mdata = {}
+            for name, value in fields:
+                if name in all_allowed_fields:
+                    mdata[name] = value
+            skip = False
+            for rf in output['required_fields']:
+                if rf not in mdata:
+                    skip = True
+                    break
+            if skip:
+                continue
+            output['table'].append(mdata)
+            if changed_tz and len(output['table']) >= CHUNK_ROWS:
+                write_table(output, local_tz, tz_name, compact_numeric, censor)
+
+        # if the timezone never showed up, the default is used
+        for output, temporary_file in zip(outputs, temporary_files):
+            if output['file'] is not None:
+                write_table(output, local_tz, tz_name, compact_numeric, censor)
+                output['file'].close()
+            else:
+                write_typed_table(output, temporary_file, local_tz, tz_name, output_format, censor)
+
+        if event_type is None:
+            event_type = 'other'
+        output_file = (event_type + '_' + timestamp.strftime('%Y-%m-%d_%H-%M-%S')
+                       + output_extension(output_format))
+        output_files = [output_file, lap_filename(output_file), start_filename(output_file)]
+        finished = []
+        for output, temporary_file, filename in zip(outputs, temporary_files, output_files):
+            if output['censored_file'] is not None:
+                output['censored_file'].close()
+            finished.append((temporary_file, filename, output['rows'], output['bounds'],
+                             output['hash'].hexdigest() if output['hash'] is not None else None))
+        if placements is None:
+            place_outputs(finished, fit_processed_csv_dir, censor)
+        else:
+            placements.extend(finished)
+    except BaseException:
+        for output, temporary_file in zip(outputs, temporary_files):
+            for file in [output['file'], output['censored_file']]:
+                if file is not None:
+                    file.close()
+            for path in [temporary_file, censored_filename(temporary_file)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        raise
+
+    profiling.current().add(rows_in=messages, rows_out=sum(output['rows'] for output in outputs))
     print('wrote %s' % output_file)
     if not fit_ignore_splits_and_laps:
         print('wrote %s' % lap_filename(output_file))
         print('wrote %s' % start_filename(output_file))
 
-    if not is_overwritten:
-        append_log(original_filename, fit_processed_csv_dir)
+    written = output_files[:len(outputs)]
+    if update_manifest:
+        if isinstance(fitfile, fast_fit.FastFitFile):
+            used_decoder = decoder_version('fast')
+        else:
+            used_decoder = decoder_version('fitparse')
+        with Manifest(fit_processed_csv_dir) as manifest:
+            manifest.record(
+                FIT_STAGE,
+                original_filename,
+                file_fingerprint(os.path.join(fit_target_dir, original_filename)),
+                written,
+                decoder_version=used_decoder,
+                options=conversion_options(fit_ignore_splits_and_laps, compact_numeric, output_format),
+            )
+        if censor is not None:
+            with Manifest(censor.censor_target_dir) as censor_manifest:
+                for source, fingerprint in censor.pop_entries():
+                    censor_manifest.record(CENSOR_STAGE, source, fingerprint, [source],
+                                           options=censor.options)
 
     if not changed_tz:
         print('TZ IS NOT CHANGED!')
+    return written
 
 if __name__=='__main__':
     raise NotImplementedError('There is no way to currently run this as a command-line script. It must be imported. Run process_all.py instead.')
@@ -0,0 +1,473 @@
+"""
+pure-Python FIT decoder for the conversion path
+
+fitparse builds a FieldData object (and runs three processor lookups) for every
+field of every message. This decoder compiles one struct.Struct per definition
+message instead, unpacks each data message in a single call and only converts the
+fields whose names are asked for. Field names, scales, enums, subfields and
+components come from fitparse's own profile, and values get the same unit
+conversions as fitparse.StandardUnitsDataProcessor, so the (name, value) pairs
+match what fitparse produces.
+
+anything it does not handle (corrupt files, developer fields with one of the
+requested names, ...) raises FastFitUnsupported; callers fall back to fitparse
+"""
+
+import datetime
+import io
+import mmap
+import os
+import struct
+
+from fitparse.profile import FIELD_TYPE_TIMESTAMP, MESSAGE_TYPES
+from fitparse.records import BASE_TYPES, BASE_TYPE_BYTE
+from fitparse.processors import UTC_REFERENCE
+
+DECODER_VERSION = 1
+
+FIT_EPOCH = datetime.datetime.utcfromtimestamp(UTC_REFERENCE)
+
+SPEED_FACTOR = 60.0 * 60.0 / 1000.0
+SEMICIRCLES_TO_DEGREES = 180.0 / (2 ** 31)
+
+FIELD_DESCRIPTION_MESG_NUM = 206
+
+# files at least this large are memory-mapped rather than read into memory; smaller ones
+# are read in one go, since indexing a mapping is slower than indexing bytes
+MAP_MIN_SIZE = 32 << 20
+
+_CRC_TABLE = (
+    0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+    0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400,
+)
+# two 4-bit steps of the FIT CRC folded into one table lookup per byte
+_CRC_BYTE_TABLE = []
+for _byte in range(256):
+    _crc = 0
+    for _nibble in (_byte & 0xF, _byte >> 4):
+        _tmp = _CRC_TABLE[_crc & 0xF]
+        _crc = (_crc >> 4) & 0x0FFF
+        _crc = _crc ^ _tmp ^ _CRC_TABLE[_nibble]
+    _CRC_BYTE_TABLE.append(_crc)
+del _byte, _crc, _nibble, _tmp
+
+
+class FastFitUnsupported(Exception):
+    pass
+
+
+class _AllFields(object):
+    """
+    field_names that asks for every field in the profile (see ALL_FIELDS)
+    """
+
+    def __contains__(self, name):
+        return True
+
+
+# reports every field the profile knows; fields it does not know are still skipped,
+# where fitparse reports them as unknown_<number>
+ALL_FIELDS = _AllFields()
+
+
+def open_mapped(path):
+    """
+    the file at path mapped read-only into memory; it reads like a file (which is what
+    fitparse.FitFile wants) and messages can be unpacked from it without copying. An
+    empty file, which cannot be mapped, comes back as an empty BytesIO
+    """
+    with open(path, 'rb') as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return io.BytesIO()
+
+
+def crc16(data, crc=0):
+    table = _CRC_BYTE_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _scale_offset(value, scale, offset):
+    # same as fitparse.FitFile._apply_scale_offset
+    if isinstance(value, tuple):
+        return tuple(_scale_offset(x, scale, offset) for x in value)
+    elif isinstance(value, (int, float)):
+        if scale:
+            value = float(value) / scale
+        if offset:
+            value = value - offset
+    return value
+
+
+class _Converter(object):
+    """
+    turns the parsed raw value of a profile field (or subfield) into the value
+    fitparse + StandardUnitsDataProcessor would report
+    """
+    __slots__ = ('name', 'values', 'scale', 'offset', 'type_name', 'units', 'is_speed',
+                 'is_distance')
+
+    def __init__(self, field, is_component=False):
+        self.name = field.name
+        self.values = field.type.values
+        # component values arrive with the component's scale/offset already applied
+        self.scale = None if is_component else field.scale
+        self.offset = None if is_component else field.offset
+        self.type_name = field.type.name
+        self.units = field.units
+        self.is_speed = field.name == 'speed' or field.name.endswith('_speed')
+        self.is_distance = field.name == 'distance'
+
+    def __call__(self, raw_value):
+        value = raw_value
+        if self.values and value in self.values:
+            value = self.values[value]
+        if self.scale or self.offset:
+            value = _scale_offset(value, self.scale, self.offset)
+        if value is None:
+            return None
+        units = self.units
+        # type processors
+        if self.type_name == 'date_time':
+            if value >= 0x10000000:
+                value = FIT_EPOCH + datetime.timedelta(seconds=value)
+                units = None
+        elif self.type_name == 'local_date_time':
+            value = FIT_EPOCH + datetime.timedelta(seconds=value)
+            units = None
+        elif self.type_name == 'bool':
+            value = bool(value)
+        elif self.type_name == 'localtime_into_day':
+            m, s = divmod(value, 60)
+            h, m = divmod(m, 60)
+            value = datetime.time(h, m, s)
+            units = None
+        # field processors
+        if self.is_speed:
+            if isinstance(value, tuple):
+                value = tuple(x * SPEED_FACTOR for x in value)
+            else:
+                value *= SPEED_FACTOR
+            units = 'km/h'
+        elif self.is_distance:
+            value /= 1000.0
+            units = 'km'
+        # unit processors
+        if units == 'semicircles':
+            value *= SEMICIRCLES_TO_DEGREES
+        return value
+
+
+_CONVERTERS = {}
+
+
+def _converter(field, is_component=False):
+    key = (id(field), is_component)
+    converter = _CONVERTERS.get(key)
+    if converter is None:
+        converter = _CONVERTERS[key] = _Converter(field, is_component)
+    return converter
+
+
+def _expand(field, mesg_type):
+    """
+    every (sub)field a profile field can show up as: itself, its subfields and the
+    fields its components expand to (with their subfields)
+    """
+    fields = []
+    for f in [field] + list(field.subfields or []):
+        fields.append(f)
+        for component in f.components or []:
+            target = mesg_type.fields.get(component.def_num)
+            if target is not None:
+                fields.append(target)
+                fields.extend(target.subfields or [])
+    return fields
+
+
+class _Definition(object):
+    """
+    compiled definition message: one struct for the whole data message, with the
+    fields nobody asked for turned into padding
+    """
+
+    def __init__(self, mesg_num, endian, field_defs, dev_field_defs, field_names, dev_field_names):
+        self.mesg_num = mesg_num
+        self.mesg_type = mesg_type = MESSAGE_TYPES.get(mesg_num)
+        self.name = mesg_type.name if mesg_type else 'unknown_%d' % mesg_num
+        self.accumulated = set()
+        fmt = [endian]
+        # (position in unpacked values, count, is tuple, parse, field or None, def_num)
+        self.steps = []
+        self.ref_def_nums = set()
+        position = 0
+        needed = []
+        for def_num, size, base_type_num in field_defs:
+            field = mesg_type.fields.get(def_num) if mesg_type else None
+            if field is not None and field.components:
+                for component in field.components:
+                    if component.accumulate:
+                        self.accumulated.add(component.def_num)
+            wanted = False
+            if field is not None:
+                expanded = _expand(field, mesg_type)
+                wanted = any(f.name in field_names for f in expanded)
+            if wanted:
+                # subfields are picked by the raw value of other fields in the message
+                for f in expanded:
+                    for ref_field in getattr(f, 'ref_fields', None) or []:
+                        self.ref_def_nums.add(ref_field.def_num)
+            needed.append(wanted)
+        if mesg_num == FIELD_DESCRIPTION_MESG_NUM:
+            needed = [True] * len(field_defs)
+        for (def_num, size, base_type_num), wanted in zip(field_defs, needed):
+            base_type = BASE_TYPES.get(base_type_num, BASE_TYPE_BYTE)
+            base_size = struct.calcsize(base_type.fmt)
+            if size % base_size != 0:
+                raise FastFitUnsupported('invalid field size %d for %s' % (size, base_type.name))
+            # the timestamp is always read, it drives compressed timestamp headers
+            if not (wanted or def_num in self.ref_def_nums or def_num == FIELD_TYPE_TIMESTAMP.def_num):
+                fmt.append('%dx' % size)
+                continue
+            field = self.mesg_type.fields.get(def_num) if self.mesg_type else None
+            count = size // base_size
+            if base_type.fmt == 's':
+                fmt.append('%ds' % size)
+                self.steps.append((position, 1, False, base_type.parse, field if wanted else None, def_num))
+                position += 1
+            else:
+                is_byte = base_type.name == 'byte'
+                fmt.append('%d%s' % (count, base_type.fmt))
+                self.steps.append((position, count, is_byte or count > 1, base_type.parse,
+                                   field if wanted else None, def_num))
+                position += count
+        for dev_data_index, def_num, size in dev_field_defs:
+            name = dev_field_names.get((dev_data_index, def_num))
+            if name is None or name in field_names:
+                raise FastFitUnsupported('developer field %s:%s' % (dev_data_index, def_num))
+            fmt.append('%dx' % size)
+        self.struct = struct.Struct(''.join(fmt))
+        self.size = self.struct.size
+
+
+class FastFitFile(object):
+    """
+    decodes a FIT file; only fields named in field_names are reported
+
+    fileish is a path, bytes or a mapping (see open_mapped). A file of at least
+    MAP_MIN_SIZE is mapped, so it is never read into memory as a whole; messages are
+    unpacked straight from the mapping, which is unmapped when the FastFitFile is gone
+    """
+
+    def __init__(self, fileish, field_names, check_crc=True):
+        if isinstance(fileish, str):
+            if os.path.getsize(fileish) >= MAP_MIN_SIZE:
+                self.data = open_mapped(fileish)
+            else:
+                with open(fileish, 'rb') as f:
+                    self.data = f.read()
+        else:
+            self.data = fileish
+        self.field_names = field_names if field_names is ALL_FIELDS else frozenset(field_names)
+        self.check_crc = check_crc
+
+    def iter_message_fields(self):
+        """
+        yields (message name, [(field name, value), ...]) for each data message, in file order
+        """
+        data = self.data
+        file_size = len(data)
+        position = 0
+        while position < file_size:
+            if file_size - position < 12 or data[position + 8:position + 12] != b'.FIT':
+                raise FastFitUnsupported('invalid FIT header')
+            header_size = data[position]
+            data_size = struct.unpack_from('<I', data, position + 4)[0]
+            if header_size > 12:
+                if header_size < 14:
+                    raise FastFitUnsupported('irregular file header size')
+                header_crc = struct.unpack_from('<H', data, position + 12)[0]
+                if self.check_crc and header_crc not in (0, crc16(data[position:position + 12])):
+                    raise FastFitUnsupported('header CRC mismatch')
+            end = position + header_size + data_size
+            if end + 2 > file_size:
+                raise FastFitUnsupported('truncated file')
+            for message in self._iter_chunk(position + header_size, end):
+                yield message
+            if self.check_crc:
+                crc = struct.unpack_from('<H', data, end)[0]
+                if crc != crc16(memoryview(data)[position:end]):
+                    raise FastFitUnsupported('CRC mismatch')
+            position = end + 2
+
+    def _iter_chunk(self, position, end):
+        data = self.data
+        field_names = self.field_names
+        want_timestamp = FIELD_TYPE_TIMESTAMP.name in field_names
+        timestamp_converter = _converter(FIELD_TYPE_TIMESTAMP)
+        timestamp_def_num = FIELD_TYPE_TIMESTAMP.def_num
+        unpack_header = struct.Struct('<BBHB').unpack_from
+        definitions = {}
+        accumulators = {}
+        dev_field_names = {}
+        compressed_timestamp = 0
+        while position < end:
+            header = data[position]
+            position += 1
+            if header & 0x80:
+                local_mesg_num = (header >> 5) & 0x3
+                time_offset = header & 0x1F
+            elif header & 0x40:
+                # definition message
+                _, architecture, mesg_num, num_fields = unpack_header(data, position)
+                endian = '>' if architecture else '<'
+                if endian == '>':
+                    mesg_num = struct.unpack_from('>H', data, position + 2)[0]
+                position += 5
+                field_defs = [tuple(data[position + 3 * i:position + 3 * i + 3]) for i in range(num_fields)]
+                position += 3 * num_fields
+                dev_field_defs = []
+                if header & 0x20:
+                    num_dev_fields = data[position]
+                    position += 1
+                    for i in range(num_dev_fields):
+                        def_num, size, dev_data_index = data[position:position + 3]
+                        dev_field_defs.append((dev_data_index, def_num, size))
+                        position += 3
+                definition = _Definition(mesg_num, endian, field_defs, dev_field_defs,
+                                         field_names, dev_field_names)
+                accumulator = accumulators.setdefault(mesg_num, {})
+                for def_num in definition.accumulated:
+                    accumulator[def_num] = 0
+                definitions[header & 0xF] = definition
+                continue
+            else:
+                local_mesg_num = header & 0xF
+                time_offset = None
+
+            definition = definitions.get(local_mesg_num)
+            if definition is None:
+                raise FastFitUnsupported('data message with undefined local type %d' % local_mesg_num)
+            if position + definition.size > end:
+                raise FastFitUnsupported('truncated message')
+            values = definition.struct.unpack_from(data, position)
+            position += definition.size
+
+            raw_values = []
+            for value_position, count, is_tuple, parse, field, def_num in definition.steps:
+                if is_tuple:
+                    raw_value = values[value_position:value_position + count]
+                    if parse is BASE_TYPE_BYTE.parse:
+                        raw_value = parse(raw_value)
+                    else:
+                        raw_value = tuple(parse(x) for x in raw_value)
+                else:
+                    raw_value = parse(values[value_position])
+                raw_values.append(raw_value)
+                if def_num == timestamp_def_num and raw_value is not None:
+                    compressed_timestamp = raw_value
+
+            if definition.mesg_num == FIELD_DESCRIPTION_MESG_NUM:
+                self._add_dev_field(definition, raw_values, dev_field_names)
+
+            fields = []
+            for (value_position, count, is_tuple, parse, field, def_num), raw_value in zip(
+                    definition.steps, raw_values):
+                if field is None:
+                    continue
+                if field.subfields:
+                    field = self._resolve_subfield(field, definition, raw_values)
+                if field.components:
+                    for component in field.components:
+                        try:
+                            cmp_raw_value = component.render(raw_value)
+                        except ValueError:
+                            continue
+                        if component.accumulate and cmp_raw_value is not None:
+                            accumulator = accumulators[definition.mesg_num]
+                            cmp_raw_value = _apply_compressed_accumulation(
+                                cmp_raw_value, accumulator[component.def_num], component.bits,
+                            )
+                            accumulator[component.def_num] = cmp_raw_value
+                        cmp_raw_value = _scale_offset(cmp_raw_value, component.scale, component.offset)
+                        cmp_field = definition.mesg_type.fields[component.def_num]
+                        if cmp_field.subfields:
+                            cmp_field = self._resolve_subfield(cmp_field, definition, raw_values)
+                        if cmp_field.name in field_names:
+                            fields.append((cmp_field.name, _converter(cmp_field, True)(cmp_raw_value)))
+                if field.name in field_names:
+                    fields.append((field.name, _converter(field)(raw_value)))
+
+            if time_offset is not None:
+                compressed_timestamp = _apply_compressed_accumulation(time_offset, compressed_timestamp, 5)
+                if want_timestamp:
+                    fields.append((FIELD_TYPE_TIMESTAMP.name, timestamp_converter(compressed_timestamp)))
+
+            yield definition.name, fields
+
+    @staticmethod
+    def _resolve_subfield(field, definition, raw_values):
+        for sub_field in field.subfields:
+            for ref_field in sub_field.ref_fields:
+                for step, raw_value in zip(definition.steps, raw_values):
+                    if step[5] == ref_field.def_num and ref_field.raw_value == raw_value:
+                        return sub_field
+        return field
+
+    @staticmethod
+    def _add_dev_field(definition, raw_values, dev_field_names):
+        by_def_num = dict((step[5], raw_value) for step, raw_value in zip(definition.steps, raw_values))
+        field_name = by_def_num.get(3) or 'unnamed_dev_field_%s' % by_def_num.get(1)
+        dev_field_names[(by_def_num.get(0), by_def_num.get(1))] = field_name
+
+
+def _apply_compressed_accumulation(raw_value, accumulation, num_bits):
+    max_value = (1 << num_bits)
+    max_mask = max_value - 1
+    base_value = raw_value + (accumulation & ~max_mask)
+    if raw_value < (accumulation & max_mask):
+        base_value += max_value
+    return base_value
+
+
+def compare_decoders(paths, field_names):
+    """
+    differential check against fitparse: returns a list of (path, message number,
+    fitparse message, fast message) for every message that differs; files the fast
+    decoder refuses are skipped
+    """
+    import fitparse
+
+    mismatches = []
+    for path in paths:
+        fitfile = fitparse.FitFile(path, data_processor=fitparse.StandardUnitsDataProcessor())
+        expected = [
+            (m.name, [(f.name, f.value) for f in m.fields if f.name in field_names])
+            for m in fitfile.get_messages()
+        ]
+        try:
+            actual = list(FastFitFile(path, field_names).iter_message_fields())
+        except FastFitUnsupported as e:
+            # converted by fitparse anyway
+            print('%s: skipped (%s)' % (path, e))
+            continue
+        for i in range(max(len(expected), len(actual))):
+            e = expected[i] if i < len(expected) else None
+            a = actual[i] if i < len(actual) else None
+            if e != a:
+                mismatches.append((path, i, e, a))
+    return mismatches
+
+
+if __name__ == '__main__':
+    import sys
+    from convert_fit_to_csv import decoded_fields
+
+    mismatches = compare_decoders(sys.argv[1:], decoded_fields)
+    for path, i, expected, actual in mismatches:
+        print('%s: message %d differs\n  fitparse: %r\n  fast:     %r' % (path, i, expected, actual))
+    print('%d files compared, %d mismatched messages' % (len(sys.argv) - 1, len(mismatches)))
+    sys.exit(1 if mismatches else 0)
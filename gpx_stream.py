@@ -0,0 +1,286 @@
+"""
+streaming GPX parsing and censoring
+
+a file is fed to expat a block at a time, so memory stays flat however large it is:
+track points come out in chunks of arrays, and a censored copy is written while the
+source is read, with everything but the censored points copied through byte for byte
+"""
+
+import codecs
+import re
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+READ_BLOCK_SIZE = 1 << 20
+
+# points per chunk yielded by iter_trackpoints
+CHUNK_POINTS = 4096
+
+START_TAG_REGEX = re.compile(
+    rb'<[^\s/>]+(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*/?>')
+
+UTF16_BOMS = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+_ATTRIBUTE_REGEX_TEMPLATE = rb'(\s%s\s*=\s*)(["\'])(.*?)\2'
+
+
+class _Point(object):
+    __slots__ = ['start', 'end', 'attributes', 'depth', 'children', 'text']
+
+    def __init__(self, start, attributes, depth):
+        self.start = start
+        # where expat saw the end tag (see element_end)
+        self.end = None
+        self.attributes = attributes
+        self.depth = depth
+        # [name, start, end] of the direct child elements
+        self.children = []
+        # {name: [text]} of the first descendant with each name in the scanner's fields
+        self.text = {}
+
+
+class TrackpointScanner(object):
+    """
+    expat handlers collecting the <trkpt> elements of the bytes fed in; byte offsets
+    count from the start of the file
+
+    with first_segment, only the points of the first <trkseg> of the first <trk> are
+    collected, and done is set once that segment is over
+    """
+
+    def __init__(self, fields=(), first_segment=False):
+        self.fields = set(fields)
+        self.first_segment = first_segment
+        self.encoding = 'utf-8'
+        self.point = None
+        self.done = False
+        self._finished = []
+        self._depth = 0
+        self._capturing = []
+        self._captures = []
+        self._track_depth = None
+        self._tracks = 0
+        self._segment_depth = None
+        self._segments = 0
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+        self.parser.XmlDeclHandler = self._declaration
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
+
+    def take(self):
+        """
+        the points finished since the last call
+        """
+        finished = self._finished
+        self._finished = []
+        return finished
+
+    def _declaration(self, version, encoding, standalone):
+        if encoding:
+            self.encoding = encoding
+
+    def _start(self, name, attributes):
+        self._depth += 1
+        point = self.point
+        if point is not None:
+            if self._depth == point.depth + 1:
+                point.children.append([name, self.parser.CurrentByteIndex, None])
+            captured = name in self.fields and name not in point.text
+            if captured:
+                point.text[name] = []
+                self._capturing.append(name)
+            self._captures.append(captured)
+        elif name == 'trkpt':
+            if not self.first_segment or self._segment_depth is not None:
+                self.point = _Point(self.parser.CurrentByteIndex, attributes, self._depth)
+        elif name == 'trk':
+            self._tracks += 1
+            if self._tracks == 1:
+                self._track_depth = self._depth
+        elif name == 'trkseg' and self._track_depth is not None and not self._segments:
+            self._segments += 1
+            self._segment_depth = self._depth
+
+    def _end(self, name):
+        point = self.point
+        if point is not None:
+            if self._depth == point.depth:
+                point.end = self.parser.CurrentByteIndex
+                self._finished.append(point)
+                self.point = None
+            else:
+                if self._depth == point.depth + 1:
+                    point.children[-1][2] = self.parser.CurrentByteIndex
+                if self._captures.pop():
+                    self._capturing.pop()
+        elif self._depth == self._segment_depth:
+            self._segment_depth = None
+            self.done = self.first_segment
+        elif self._depth == self._track_depth:
+            self._track_depth = None
+        self._depth -= 1
+
+    def _text(self, data):
+        for name in self._capturing:
+            self.point.text[name].append(data)
+
+
+def _coordinate(point, name):
+    try:
+        return float(point.attributes[name])
+    except (KeyError, ValueError):
+        raise ValueError('track point at byte %d has no readable %s' % (point.start, name))
+
+
+def coordinates(points):
+    """
+    (latitudes, longitudes) of points as float64 arrays
+    """
+    latitudes = np.array([_coordinate(point, 'lat') for point in points], dtype=np.float64)
+    longitudes = np.array([_coordinate(point, 'lon') for point in points], dtype=np.float64)
+    return latitudes, longitudes
+
+
+def _chunk(points):
+    latitudes, longitudes = coordinates(points)
+    elevations = np.array([float(''.join(point.text['ele'])) if 'ele' in point.text else np.nan
+                           for point in points], dtype=np.float64)
+    times = np.array([''.join(point.text.get('time', ())) for point in points], dtype=str)
+    return {'latitude': latitudes, 'longitude': longitudes, 'elevation': elevations,
+            'time': times}
+
+
+def iter_trackpoints(path, chunk_points=CHUNK_POINTS, first_segment=False):
+    """
+    yields the track points of the GPX file at path in chunks of up to chunk_points, as
+    {'latitude', 'longitude', 'elevation', 'time'} arrays; a missing elevation is NaN and
+    a missing time ''. Elevation and time are the text of the first <ele> and <time>
+    inside each point
+    """
+    scanner = TrackpointScanner(['ele', 'time'], first_segment)
+    pending = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            scanner.feed(block)
+            pending.extend(scanner.take())
+            while len(pending) >= chunk_points:
+                yield _chunk(pending[:chunk_points])
+                del pending[:chunk_points]
+            if scanner.done:
+                break
+        else:
+            scanner.feed(b'', True)
+            pending.extend(scanner.take())
+    if pending:
+        yield _chunk(pending)
+
+
+def read_track(path, first_segment=False):
+    """
+    all of iter_trackpoints' chunks joined together
+    """
+    chunks = list(iter_trackpoints(path, first_segment=first_segment))
+    if not chunks:
+        return {'latitude': np.zeros(0), 'longitude': np.zeros(0), 'elevation': np.zeros(0),
+                'time': np.zeros(0, dtype=str)}
+    return dict((name, np.concatenate([chunk[name] for chunk in chunks]))
+                for name in chunks[0])
+
+
+def element_end(data, offset, start, end):
+    """
+    the offset just past an element, given the offsets expat reported for its start and
+    end tags; data holds the file's bytes from offset on
+    """
+    tag = START_TAG_REGEX.match(data, start - offset)
+    if tag.group().endswith(b'/>'):
+        return tag.end() + offset
+    return data.index(b'>', end - offset) + 1 + offset
+
+
+def censor_point(data, offset, point, removed_children, censored_attributes, censor_value):
+    """
+    the bytes of point with its direct children named in removed_children taken out and
+    the values of its censored_attributes replaced by censor_value (already encoded)
+    """
+    start = point.start - offset
+    pieces = []
+    position = START_TAG_REGEX.match(data, start).end()
+    for name, child_start, child_end in point.children:
+        if name in removed_children:
+            pieces.append(data[position:child_start - offset])
+            position = element_end(data, offset, child_start, child_end) - offset
+    pieces.append(data[position:element_end(data, offset, point.start, point.end) - offset])
+    start_tag = data[start:START_TAG_REGEX.match(data, start).end()]
+    for name in censored_attributes:
+        if name in point.attributes:
+            pattern = re.compile(_ATTRIBUTE_REGEX_TEMPLATE % re.escape(name.encode('ascii')))
+            start_tag = pattern.sub(lambda match: match.group(1) + match.group(2) + censor_value
+                                    + match.group(2), start_tag, count=1)
+    return bytes(start_tag + b''.join(pieces))
+
+
+def censor_gpx(source, target, censor_mask, censor_string, drop_points=False,
+               removed_children=(), censored_attributes=()):
+    """
+    copies the GPX file source to target, censoring the track points for which
+    censor_mask(longitudes, latitudes) is True: they are left out with drop_points, and
+    otherwise lose their direct children named in removed_children and have the values of
+    censored_attributes replaced by censor_string. Everything else is copied as it is.
+    returns the number of points censored
+    """
+    scanner = TrackpointScanner()
+    removed_children = set(removed_children)
+    censored = 0
+    # the source's bytes from offset on, up to what has been read
+    data = bytearray()
+    offset = 0
+    with open(source, 'rb') as f, open(target, 'wb') as out:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), None):
+            final = not block
+            if not offset and not data and block.startswith(UTF16_BOMS):
+                # the markup is patched as ASCII bytes
+                raise ValueError('cannot censor %s: it is not in an ASCII-compatible encoding'
+                                 % source)
+            scanner.feed(block, final)
+            data += block
+            points = scanner.take()
+            if points:
+                latitudes, longitudes = coordinates(points)
+                censor_value = escape(censor_string, {'"': '&quot;', "'": '&apos;'}).encode(
+                    scanner.encoding, 'xmlcharrefreplace')
+                for index in np.flatnonzero(censor_mask(longitudes, latitudes)):
+                    point = points[index]
+                    out.write(data[:point.start - offset])
+                    if not drop_points:
+                        out.write(censor_point(data, offset, point, removed_children,
+                                               censored_attributes, censor_value))
+                    end = element_end(data, offset, point.start, point.end)
+                    del data[:end - offset]
+                    offset = end
+                    censored += 1
+            # an unfinished point is kept until it can be censored whole, and so is a tag cut
+            # off by the end of the block, which expat has not reported yet and may start
+            # one (attribute values cannot hold a '<', so it starts at the last one)
+            if scanner.point is not None:
+                written = scanner.point.start - offset
+            elif final:
+                written = len(data)
+            else:
+                written = data.rfind(b'<')
+                if written < 0:
+                    written = len(data)
+            out.write(data[:written])
+            del data[:written]
+            offset += written
+            if final:
+                break
+    return censored
+
@@ -1,8 +1,13 @@
 import os
+import queue
 import shutil
 import re
+import threading
 
 import convert_fit_to_csv
+import profiling
+from file_copies import reflink
+from manifest import IMPORT_SOURCE_STAGE, IMPORT_STAGE, Manifest, file_fingerprint
 
 #ACTIVITY_DIRECTORY = '/media/max/GARMIN/Garmin/ACTIVITY/'
 
@@ -10,6 +15,168 @@ import convert_fit_to_csv
 
 FNAME_REGEX = re.compile(r'\.[Ff][Ii][Tt]')
 
+# imported files are placed with the first of these that works; they are never hard-linked,
+# since a link shares the source's inode, so writing to either would change the other
+PLACE_METHODS = ['reflink', 'copy']
+
+# imported files waiting to be converted before the import waits for the conversions
+IMPORT_QUEUE_SIZE = 8
+
+def place_file(source, target):
+    """
+    puts a copy of source at target without copying its bytes if the filesystem allows;
+    returns the method used, one of PLACE_METHODS
+    """
+    # built next to the target and renamed over it, so a target is never half written
+    temporary = target + '.tmp'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    for method in PLACE_METHODS:
+        try:
+            if method == 'reflink':
+                reflink(source, temporary)
+            else:
+                shutil.copyfile(source, temporary)
+            break
+        except OSError:
+            if method == PLACE_METHODS[-1]:
+                raise
+    os.replace(temporary, target)
+    return method
+
+def import_files(fit_source_dir, fit_target_dir, imported=None):
+    """
+    copies the FIT files in fit_source_dir that are not in fit_target_dir yet, under any
+    name, into it; a source that changed since it was imported replaces its copy.
+    imported, if given, is called with the name of each file as soon as it is in place.
+    returns {method or 'duplicate' or 'imported': (files, bytes)}
+    """
+    stats = dict((key, [0, 0]) for key in PLACE_METHODS + ['duplicate', 'imported'])
+    activity_files = sorted(os.listdir(fit_source_dir))
+    with Manifest(fit_target_dir) as manifest:
+        # content hashes of what is already there, however it got there
+        for name in sorted(os.listdir(fit_target_dir)):
+            if name[-4:].lower() != '.fit':
+                continue
+            entry = manifest.lookup(IMPORT_STAGE, name)
+            fingerprint = file_fingerprint(os.path.join(fit_target_dir, name), entry)
+            if entry is None or entry['hash'] != fingerprint['hash']:
+                manifest.record(IMPORT_STAGE, name, fingerprint, commit=False)
+            else:
+                manifest.update_fingerprint(entry, fingerprint)
+        for name in manifest.sources(IMPORT_STAGE):
+            if not os.path.exists(os.path.join(fit_target_dir, name)):
+                manifest.remove(IMPORT_STAGE, name)
+        manifest.commit()
+
+        for src_file in activity_files:
+            source = os.path.abspath(os.path.join(fit_source_dir, src_file))
+            if not os.path.isfile(source):
+                continue
+            tgt_file = FNAME_REGEX.sub('.fit', src_file)
+            # the source's hash is kept, so an unchanged file on a slow device is not read again
+            source_entry = manifest.lookup(IMPORT_SOURCE_STAGE, source)
+            fingerprint = file_fingerprint(source, source_entry)
+            existing = manifest.find_hash(IMPORT_STAGE, fingerprint['hash'])
+            if existing is not None:
+                if source_entry is None or source_entry['outputs'] != [existing['source']]:
+                    print('%s is already imported as %s' % (source, existing['source']))
+                manifest.record(IMPORT_SOURCE_STAGE, source, fingerprint, [existing['source']])
+                stats['duplicate'][0] += 1
+                stats['duplicate'][1] += fingerprint['size']
+                continue
+            target = os.path.join(fit_target_dir, tgt_file)
+            if os.path.exists(target):
+                if source_entry is None or source_entry['outputs'] != [tgt_file]:
+                    # a different file by the same name, from somewhere else
+                    print('%s already exists...' % tgt_file)
+                    manifest.record(IMPORT_SOURCE_STAGE, source, fingerprint, [])
+                    continue
+                print('%s has changed; replacing %s' % (source, target))
+            with profiling.measure_file('import', tgt_file, source, profile=False) as measurement:
+                method = place_file(source, target)
+                measurement.add_outputs([target])
+            print('%s %s to %s' % ({'copy': 'copied', 'reflink': 'reflinked'}[method],
+                                   source, target))
+            stat = os.stat(target)
+            target_fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                  'hash': fingerprint['hash']}
+            manifest.record(IMPORT_STAGE, tgt_file, target_fingerprint, commit=False)
+            manifest.record(IMPORT_SOURCE_STAGE, source, fingerprint, [tgt_file])
+            stats[method][0] += 1
+            stats[method][1] += fingerprint['size']
+            stats['imported'][0] += 1
+            stats['imported'][1] += fingerprint['size']
+            if imported is not None:
+                imported(tgt_file)
+    return dict((key, tuple(value)) for key, value in stats.items())
+
+class ImportCancelled(Exception):
+    pass
+
+def iter_imported(fit_source_dir, fit_target_dir, queue_size=IMPORT_QUEUE_SIZE):
+    """
+    runs import_files on a thread and yields the name of each file it imports as soon as
+    it is in place, then those of the other FIT files in fit_target_dir (sorted), so they
+    can be converted while the rest is still being copied
+
+    at most queue_size imported files wait to be taken before the import waits too.
+    Closing the generator stops the import once the file being copied is in place; an
+    error in the import is raised here
+    """
+    ready = queue.Queue(queue_size)
+    stop = threading.Event()
+    outcome = {}
+
+    def put(item):
+        # gives up if the files are no longer wanted, rather than waiting forever
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def imported(name):
+        # everything in fit_source_dir is imported, but only FIT files are converted
+        if name[-4:].lower() == '.fit' and not put(name):
+            raise ImportCancelled()
+
+    def run():
+        try:
+            outcome['stats'] = import_files(fit_source_dir, fit_target_dir, imported)
+        except ImportCancelled:
+            pass
+        except BaseException as e:
+            outcome['error'] = e
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=run, name='fit-import', daemon=True)
+    thread.start()
+    taken = set()
+    try:
+        for name in iter(ready.get, None):
+            taken.add(name)
+            yield name
+    finally:
+        stop.set()
+        thread.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    print_import_summary(outcome['stats'])
+    for name in sorted(os.listdir(fit_target_dir)):
+        if name[-4:].lower() == '.fit' and name not in taken:
+            yield name
+
+def print_import_summary(stats):
+    avoided = stats['duplicate'][1] + stats['reflink'][1]
+    print('imported %d files (%d copied, %d reflinked), skipped %d already imported; '
+          '%.1f MB not copied' % (
+              stats['imported'][0], stats['copy'][0], stats['reflink'][0],
+              stats['duplicate'][0], avoided / 1e6))
+
 
 
 def main(
@@ -18,37 +185,33 @@ def main(
         fit_processed_csv_dir,
         fit_overwrite,
         fit_ignore_splits_and_laps,
+        fit_workers=1,
+        fit_decoder='fitparse',
+        fit_compact_numeric=False,
+        fit_output_format='csv',
+        fit_censor=None,
+        fit_cache=None,
 ):
     os.makedirs(fit_target_dir, exist_ok=True)
     os.makedirs(fit_processed_csv_dir, exist_ok=True)
-    activity_files = os.listdir(fit_source_dir)
-    print('activity files: ', activity_files)
-    new_names = [FNAME_REGEX.sub('.fit', file) for file in activity_files]
-    print('new names: ', new_names)
-    current_files = set(os.listdir(fit_target_dir))
-    print('current_files: ', current_files)
-    for src_file, tgt_file in zip(activity_files, new_names):
-        if FNAME_REGEX.sub('.fit', tgt_file) in current_files:
-            print('%s already exists...' % tgt_file)
-            continue
-        else:
-            pass
-        shutil.copyfile(
-            os.path.join(fit_source_dir, src_file),
-            os.path.join(fit_target_dir, tgt_file)
-        )
-        print("copied %s to %s" % (
-            os.path.join(fit_source_dir, src_file),
-            os.path.join(fit_target_dir, tgt_file)
-        )
+    # files are converted as they are copied, rather than after all of them are
+    fit_files = iter_imported(fit_source_dir, fit_target_dir)
+    try:
+        convert_fit_to_csv.main(
+            fit_target_dir,
+            fit_processed_csv_dir,
+            fit_overwrite,
+            fit_ignore_splits_and_laps,
+            fit_workers,
+            fit_decoder,
+            fit_compact_numeric,
+            fit_output_format,
+            fit_censor,
+            fit_files,
+            fit_cache,
         )
-
-    convert_fit_to_csv.main(
-        fit_target_dir,
-        fit_processed_csv_dir,
-        fit_overwrite,
-        fit_ignore_splits_and_laps,
-    )
+    finally:
+        fit_files.close()
     
     #os.chdir(fit_target_dir)
     #os.system('python3 convert_fit_to_csv.py')
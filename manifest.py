@@ -0,0 +1,232 @@
+"""
+SQLite manifest of processed source files
+
+one row per (stage, source file) with the source's size, mtime and content hash, the
+decoder and options it was processed with, its outputs and a status; it replaces
+file_log.log, which is migrated the first time a manifest is opened next to one
+
+archives (see archive.py) also list their members here, so they can be updated in place
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+MANIFEST_FILENAME = 'manifest.sqlite'
+
+# stages that record their sources
+FIT_STAGE = 'fit'
+GPX_STAGE = 'gpx'
+CENSOR_STAGE = 'censor'
+# files imported into the FIT target directory, and the source files they came from
+IMPORT_STAGE = 'import'
+IMPORT_SOURCE_STAGE = 'import_source'
+
+DONE = 'done'
+# came from file_log.log; the source's fingerprint is filled in the next time it is seen
+MIGRATED = 'migrated'
+
+HASH_BLOCK_SIZE = 1 << 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    stage TEXT NOT NULL,
+    source TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    hash TEXT,
+    decoder_version TEXT,
+    options TEXT,
+    outputs TEXT,
+    status TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (stage, source)
+);
+CREATE INDEX IF NOT EXISTS sources_hash ON sources (stage, hash);
+CREATE TABLE IF NOT EXISTS archive_members (
+    archive TEXT NOT NULL,
+    member TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (archive, member)
+)
+"""
+
+_COLUMNS = ['stage', 'source', 'size', 'mtime_ns', 'hash', 'decoder_version',
+            'options', 'outputs', 'status', 'updated']
+
+
+def content_hash():
+    """
+    a new hash object of the kind file_hash uses, for data hashed as it is written
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+def file_hash(path):
+    digest = content_hash()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, entry=None):
+    """
+    returns {'size', 'mtime_ns', 'hash'} of the file at path
+
+    the hash is only computed if size or mtime differ from those of the manifest entry
+    """
+    stat = os.stat(path)
+    if (entry is not None and entry['hash'] is not None and entry['size'] == stat.st_size
+            and entry['mtime_ns'] == stat.st_mtime_ns):
+        content_hash = entry['hash']
+    else:
+        content_hash = file_hash(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash}
+
+
+class Manifest(object):
+    """
+    the manifest in a directory; lookups are primary key queries
+    """
+
+    def __init__(self, directory, filename=MANIFEST_FILENAME):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, stage, source):
+        row = self.connection.execute(
+            'SELECT %s FROM sources WHERE stage = ? AND source = ?' % ', '.join(_COLUMNS),
+            (stage, source),
+        ).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(_COLUMNS, row))
+        entry['options'] = json.loads(entry['options']) if entry['options'] is not None else None
+        entry['outputs'] = json.loads(entry['outputs']) if entry['outputs'] is not None else None
+        return entry
+
+    def find_hash(self, stage, content_hash):
+        """
+        the first (by name) entry of stage whose source has content_hash, or None
+        """
+        row = self.connection.execute(
+            'SELECT source FROM sources WHERE stage = ? AND hash = ? ORDER BY source LIMIT 1',
+            (stage, content_hash),
+        ).fetchone()
+        return self.lookup(stage, row[0]) if row is not None else None
+
+    def sources(self, stage):
+        return [row[0] for row in self.connection.execute(
+            'SELECT source FROM sources WHERE stage = ? ORDER BY source', (stage,))]
+
+    def is_current(self, entry, fingerprint, options=None, output_dir=None, decoder_versions=None):
+        """
+        True if entry says the source was processed as it is now, with the same options
+        and one of decoder_versions (if given), and its outputs (relative to output_dir)
+        are still there
+        """
+        if entry is None or entry['status'] not in (DONE, MIGRATED):
+            return False
+        if entry['hash'] is not None and entry['hash'] != fingerprint['hash']:
+            return False
+        if entry['options'] is not None and options is not None and entry['options'] != options:
+            return False
+        if (entry['decoder_version'] is not None and decoder_versions is not None
+                and entry['decoder_version'] not in decoder_versions):
+            return False
+        if entry['outputs'] is not None and output_dir is not None:
+            for output in entry['outputs']:
+                if not os.path.exists(os.path.join(output_dir, output)):
+                    return False
+        return True
+
+    def record(self, stage, source, fingerprint, outputs=None, status=DONE,
+               decoder_version=None, options=None, commit=True):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO sources (%s) VALUES (%s)' % (
+                ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+            (stage, source, fingerprint['size'], fingerprint['mtime_ns'], fingerprint['hash'],
+             decoder_version, json.dumps(options) if options is not None else None,
+             json.dumps(outputs) if outputs is not None else None, status, time.time()),
+        )
+        if commit:
+            self.connection.commit()
+
+    def update_fingerprint(self, entry, fingerprint):
+        """
+        stores a new fingerprint for an entry that is still current (e.g. touched, or migrated)
+        """
+        if all(entry[key] == fingerprint[key] for key in ('size', 'mtime_ns', 'hash')):
+            return
+        self.connection.execute(
+            'UPDATE sources SET size = ?, mtime_ns = ?, hash = ?, updated = ? '
+            'WHERE stage = ? AND source = ?',
+            (fingerprint['size'], fingerprint['mtime_ns'], fingerprint['hash'], time.time(),
+             entry['stage'], entry['source']),
+        )
+        self.connection.commit()
+
+    def remove(self, stage, source):
+        self.connection.execute('DELETE FROM sources WHERE stage = ? AND source = ?',
+                                (stage, source))
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def archive_members(self, archive):
+        """
+        {member: (size, mtime_ns)} of the files archive was last built from
+        """
+        return {row[0]: (row[1], row[2]) for row in self.connection.execute(
+            'SELECT member, size, mtime_ns FROM archive_members WHERE archive = ?', (archive,))}
+
+    def record_archive(self, archive, members):
+        """
+        replaces the member list of archive with members, {member: (size, mtime_ns)}
+        """
+        now = time.time()
+        self.connection.execute('DELETE FROM archive_members WHERE archive = ?', (archive,))
+        self.connection.executemany(
+            'INSERT INTO archive_members (archive, member, size, mtime_ns, updated) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [(archive, member, size, mtime_ns, now)
+             for member, (size, mtime_ns) in members.items()],
+        )
+        self.connection.commit()
+
+    def migrate_log(self, log_path, stage):
+        """
+        imports the names in an old file_log.log as processed sources, then renames the log
+        so it is only imported once
+        """
+        if not os.path.exists(log_path):
+            return 0
+        with open(log_path, 'r') as f:
+            names = f.read().split()
+        now = time.time()
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO sources (stage, source, status, updated) VALUES (?, ?, ?, ?)',
+            [(stage, name, MIGRATED, now) for name in names],
+        )
+        self.connection.commit()
+        os.replace(log_path, log_path + '.migrated')
+        print('migrated %d entries from %s to %s' % (len(names), log_path, self.path))
+        return len(names)
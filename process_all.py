@@ -6,37 +6,68 @@ import import_and_process_garmin_fit
 #import gpx_to_csv
 import calculate_workout_variables
 import censor_and_package
+from track_columns import OUTPUT_FORMATS
+from archive import ARCHIVE_FORMATS
+import geometry
+import activity_cache
+import profiling
+import smoothing
 
 def main():
     options = parse_options()
+    if options['profile'] != '':
+        profiling.start(options['profile'], options['profile_slowest'],
+                        options['profile_tracemalloc'])
     censor_search_directories = []
+    censor_target_dir = os.path.join(options['subject_dir'], options['name'], 'censored')
+    fit_censor = None
+    if options['fused_censor'] and options['censorfile'] != '':
+        # FIT outputs are censored as they are converted; the censor stage below skips them
+        fit_censor = censor_and_package.fused_censor(options['censorfile'], censor_target_dir,
+                                                     options['censor_string'])
     
+    fit_cache = None
+    if options['fit_cache_size'] > 0:
+        fit_cache = activity_cache.ActivityCache(options['fit_cache_dir'],
+                                                 int(options['fit_cache_size'] * 1e6))
+
     if options['gpx_source_dir'] != '':
         if not options['skip_gpx_conversion']:
             print('doing GPX conversions')
-            calculate_workout_variables.main(
-                options['gpx_source_dir'],
-                options['gpx_target_dir'],
-                options['gpx_summary_filename'],
-
-            )
+            with profiling.stage('gpx'):
+                calculate_workout_variables.main(
+                    options['gpx_source_dir'],
+                    options['gpx_target_dir'],
+                    options['gpx_summary_filename'],
+                    options['output_format'],
+                    options['gpx_dtype'],
+                    options['gpx_workers'],
+                    options['gpx_smoothing_bandwidths'],
+                    options['gpx_write_summary'],
+                )
         censor_search_directories.append(options['gpx_target_dir'])
 
     if options['fit_source_dir'] != '':
         if not options['skip_fit_conversion']:
             print('doing FIT conversions')
-            import_and_process_garmin_fit.main(
-                options['fit_source_dir'],
-                options['fit_target_dir'],
-                options['fit_processed_csv_dir'],
-                options['fit_overwrite'],
-                options['fit_ignore_splits_and_laps'],
-            )
+            with profiling.stage('fit'):
+                import_and_process_garmin_fit.main(
+                    options['fit_source_dir'],
+                    options['fit_target_dir'],
+                    options['fit_processed_csv_dir'],
+                    options['fit_overwrite'],
+                    options['fit_ignore_splits_and_laps'],
+                    options['fit_workers'],
+                    options['fit_decoder'],
+                    options['fit_compact_numeric'],
+                    options['output_format'],
+                    fit_censor,
+                    fit_cache,
+                )
         censor_search_directories.append(options['fit_processed_csv_dir'])
 
     # even if no censoring is done, archiving can still be done here
     if True: #options['censorfile'] != '' and len(censor_search_directories) > 0:
-        censor_target_dir = os.path.join(options['subject_dir'], options['name'], 'censored')
         censor_and_package.main(
             censor_search_directories,
             censor_target_dir,
@@ -45,8 +76,16 @@ def main():
             # will be used to control archiving
             options
         )
+    profiling.finish(options['profile_slowest'] or 5)
+
 
 
+def smoothing_bandwidth(text):
+    # argparse type of --gpx-smoothing-bandwidths
+    try:
+        return smoothing.check_bandwidths([text])[0]
+    except ValueError:
+        raise argparse.ArgumentTypeError('%s is not a positive number of seconds' % text)
 
 def parse_options():
     parser = argparse.ArgumentParser(description='Run FIT/GPX Pipeline')
@@ -94,6 +133,30 @@ def parse_options():
                         help='the summary filename for gpx data'
     )
 
+    parser.add_argument('--gpx-write-summary', dest='gpx_write_summary', action='store_true',
+                        default=False,
+                        help='write the summary variables of every GPX file to the summary file '
+                        'in the GPX target directory'
+    )
+
+    parser.add_argument('--gpx-smoothing-bandwidths', dest='gpx_smoothing_bandwidths',
+                        type=smoothing_bandwidth,
+                        nargs='+', default=[],
+                        help='also summarize speed and elevation smoothed with gaussian kernels '
+                        'of these standard deviations (seconds)'
+    )
+
+    parser.add_argument('--gpx-dtype', dest='gpx_dtype', choices=sorted(geometry.DTYPES),
+                        default='float64',
+                        help='precision of the GPX distance and speed calculations; float32 is '
+                        'faster, with distances good to 3e-7 (relative)'
+    )
+
+    parser.add_argument('--gpx-workers', dest='gpx_workers', type=int, default=1,
+                        help='Number of processes used to process GPX files; output is the same '
+                        'as with a single process'
+    )
+
     parser.add_argument('--fit-overwrite', dest='fit_overwrite',
                         action='store_true', default=False, required=False,
                         help='Will overwrite any previously created CSVs from fit data'
@@ -104,6 +167,41 @@ def parse_options():
                         help='Will not write split/lap data if specified'
     )
 
+    parser.add_argument('--workers', '--fit-workers', dest='fit_workers', type=int,
+                        default=1, required=False,
+                        help='Number of processes used to convert FIT files; output is the same '
+                        'as with a single process'
+    )
+
+    parser.add_argument('--fit-decoder', dest='fit_decoder', choices=['fast', 'fitparse'],
+                        default='fitparse', required=False,
+                        help='fast uses a built-in decoder for the exported message types and falls '
+                        'back to fitparse for files it cannot read; output is the same either way'
+    )
+
+    parser.add_argument('--fit-cache-dir', dest='fit_cache_dir', default=activity_cache.CACHE_DIR,
+                        help='directory of decoded FIT files, which are converted again from there '
+                        'instead of being decoded again'
+    )
+
+    parser.add_argument('--fit-cache-size', dest='fit_cache_size', type=float,
+                        default=activity_cache.DEFAULT_MAX_MB,
+                        help='size limit of the decoded FIT file cache in MB; the least recently '
+                        'used files are removed first, and 0 turns the cache off'
+    )
+
+    parser.add_argument('--compact-numeric', dest='fit_compact_numeric',
+                        action='store_true', default=False, required=False,
+                        help='Rounds floats in FIT CSVs to 6 decimals for smaller files; by default '
+                        'values are written at full precision'
+    )
+
+    parser.add_argument('--output-format', dest='output_format', choices=OUTPUT_FORMATS,
+                        default='csv', required=False,
+                        help='File format for converted FIT and GPX tracks; parquet (needs pyarrow) '
+                        'and npz are typed and compressed, and censoring reads and writes them too'
+    )
+
     # censorship arguments
 
     parser.add_argument('--censorfile', dest='censorfile', required=False,
@@ -112,6 +210,12 @@ def parse_options():
                         'with censored locations around different latitude/longitude/radii'
     )
 
+    parser.add_argument('--fused-censor', dest='fused_censor', action='store_true',
+                        default=False, required=False,
+                        help='Censors converted FIT data while it is still in memory instead of '
+                        'reading the converted files back; the censored files are the same'
+    )
+
     parser.add_argument('--censor-string', dest='censor_string', required=False,
                         default='[CENSORED]',
                         help='This is what censored fields are replaced with in censored data'
@@ -144,7 +248,35 @@ def parse_options():
                         help='archive filename; will use name for default if none specified'
     )
 
+    parser.add_argument('--archive-format', dest='archive_format', choices=ARCHIVE_FORMATS,
+                        default='zip', required=False,
+                        help='zip archives are updated in place; tar.zst (needs zstandard) is '
+                        'smaller but rebuilt every time'
+    )
 
+    parser.add_argument('--archive-workers', dest='archive_workers', type=int,
+                        default=None, required=False,
+                        help='Number of threads used to compress archives; defaults to the number '
+                        'of CPUs'
+    )
+
+
+
+    parser.add_argument('--profile', dest='profile', default='',
+                        help='Directory to write the wall time, CPU time, peak memory, rows and '
+                        'bytes of every stage and file to (report.json, stages.csv, files.csv)'
+    )
+
+    parser.add_argument('--profile-slowest', dest='profile_slowest', type=int, default=0,
+                        help='With --profile, also run files under cProfile and keep the dumps '
+                        'of this many of the slowest in the profiles subdirectory'
+    )
+
+    parser.add_argument('--profile-tracemalloc', dest='profile_tracemalloc', action='store_true',
+                        default=False,
+                        help='With --profile, also trace the peak of Python allocations, which '
+                        'slows everything down'
+    )
 
     # skip steps to allow archiving/censoring without other processing
 
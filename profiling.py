@@ -0,0 +1,333 @@
+"""
+per-stage and per-file instrumentation (process_all --profile)
+
+once start() is called, stage() and measure_file() measure what runs inside them: wall
+time, CPU time, peak memory, and the rows and bytes that go in and out. Every
+measurement is appended to a records file of its process in the report directory; worker
+processes do the same once they are set up with init_worker(settings()). finish() puts
+all of it together into report.json, stages.csv and files.csv
+
+with dumps, every file is also run under cProfile and the dumps of the slowest are kept
+in profiles/. Peak memory is the resident set size, and the peak of tracemalloc when it
+is tracing (trace_memory); the resident peak is reset before each measurement where
+Linux allows it, and is the peak since the process started elsewhere
+
+without start(), stage() and measure_file() return NULL, which does nothing
+"""
+
+from collections import OrderedDict
+import cProfile
+import csv
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not on Windows; peak memory comes from /proc or is unknown
+    resource = None
+
+REPORT_FILENAME = 'report.json'
+STAGES_FILENAME = 'stages.csv'
+FILES_FILENAME = 'files.csv'
+PROFILES_SUBDIR = 'profiles'
+RECORDS_PREFIX = '.records.'
+
+FIELDS = ['stage', 'name', 'wall_seconds', 'cpu_seconds', 'peak_rss', 'peak_traced',
+          'rows_in', 'rows_out', 'bytes_in', 'bytes_out']
+STAGE_FIELDS = FIELDS[:4] + ['worker_cpu_seconds'] + FIELDS[4:] + ['peak_rss_workers', 'files']
+FILE_FIELDS = FIELDS + ['pid', 'profile']
+
+# (report directory, number of cProfile dumps to keep, whether to trace memory), or None
+_SETTINGS = None
+# measurements open in this process, in any thread, which share its peak memory
+_OPEN = []
+# the file measurement open in each thread, for current()
+_LOCAL = threading.local()
+# (pid, file) records are appended to
+_RECORDS = None
+# (wall seconds, path) of the dumps this process kept
+_DUMPS = []
+_LOCK = threading.Lock()
+
+
+class _Null(object):
+    """
+    stands in for a measurement when profiling is off
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def add(self, **counts):
+        pass
+
+    def add_outputs(self, paths):
+        pass
+
+
+NULL = _Null()
+
+
+def start(directory, dumps=0, trace_memory=False):
+    """
+    turns profiling on in this process, with the report going to directory
+    """
+    global _SETTINGS
+    os.makedirs(os.path.join(directory, PROFILES_SUBDIR), exist_ok=True)
+    # whatever an earlier run left
+    for path in (glob.glob(os.path.join(directory, RECORDS_PREFIX + '*'))
+                 + glob.glob(os.path.join(directory, PROFILES_SUBDIR, '*.prof'))):
+        os.remove(path)
+    init_worker((os.path.abspath(directory), dumps, trace_memory))
+
+
+def settings():
+    return _SETTINGS
+
+
+def init_worker(profile_settings):
+    """
+    profiles a worker process as start() did the process that started it
+    """
+    global _SETTINGS, _OPEN, _RECORDS, _DUMPS
+    _SETTINGS = profile_settings
+    # a forked process starts out with copies of its parent's
+    _OPEN = []
+    _RECORDS = None
+    _DUMPS = []
+    if _SETTINGS is not None and _SETTINGS[2] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stage(name):
+    """
+    measures a stage of the run; the CPU time includes that of worker processes that
+    finish during it
+    """
+    if _SETTINGS is None:
+        return NULL
+    return Measurement('stage', name)
+
+
+def measure_file(stage_name, name, source=None, profile=True):
+    """
+    measures the processing of one file, source if it is given; the CPU time is that of
+    the calling thread. With profile, it is run under cProfile if dumps are kept
+    """
+    if _SETTINGS is None:
+        return NULL
+    return Measurement('file', stage_name, name, source, profile and _SETTINGS[1] > 0)
+
+
+def current():
+    """
+    the file measurement open in this thread, or NULL, so rows can be counted where they
+    are known
+    """
+    return getattr(_LOCAL, 'current', None) or NULL
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    if resource is None:
+        return None
+    # kilobytes, except on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _take_peaks():
+    # the peaks since the last call go to every open measurement, and are reset
+    rss = _peak_rss()
+    traced = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    for measurement in _OPEN:
+        if rss is not None:
+            measurement.record['peak_rss'] = max(measurement.record['peak_rss'] or 0, rss)
+        if traced is not None:
+            measurement.record['peak_traced'] = max(measurement.record['peak_traced'] or 0, traced)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+    if traced is not None:
+        tracemalloc.reset_peak()
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _write(record):
+    global _RECORDS
+    if _RECORDS is None or _RECORDS[0] != os.getpid():
+        path = os.path.join(_SETTINGS[0], '%s%d.jsonl' % (RECORDS_PREFIX, os.getpid()))
+        _RECORDS = (os.getpid(), open(path, 'a'))
+    # flushed right away, since pool workers are terminated rather than shut down
+    _RECORDS[1].write(json.dumps(record) + '\n')
+    _RECORDS[1].flush()
+
+
+def _keep_dump(profiler, record):
+    # only the slowest dumps of this process are kept; finish() picks the slowest of all
+    wall = record['wall_seconds']
+    if len(_DUMPS) >= _SETTINGS[1] and wall <= _DUMPS[0][0]:
+        return None
+    path = os.path.join(_SETTINGS[0], PROFILES_SUBDIR, '%s-%s-%d.prof' % (
+        record['stage'], re.sub(r'[^0-9A-Za-z._-]+', '_', record['name']), os.getpid()))
+    profiler.dump_stats(path)
+    _DUMPS.append((wall, path))
+    _DUMPS.sort()
+    if len(_DUMPS) > _SETTINGS[1]:
+        os.remove(_DUMPS.pop(0)[1])
+    return path
+
+
+class Measurement(object):
+
+    def __init__(self, kind, stage_name, name=None, source=None, profile=False):
+        self.kind = kind
+        self.record = OrderedDict((field, None) for field in FIELDS)
+        self.record.update(kind=kind, stage=stage_name, name=name, pid=os.getpid())
+        self.source = source
+        self.profiler = cProfile.Profile() if profile else None
+
+    def add(self, **counts):
+        """
+        adds to rows_in, rows_out, bytes_in or bytes_out
+        """
+        for key, value in counts.items():
+            self.record[key] = (self.record[key] or 0) + value
+
+    def add_outputs(self, paths):
+        self.add(bytes_out=sum(os.path.getsize(path) for path in paths if os.path.exists(path)))
+
+    def __enter__(self):
+        with _LOCK:
+            _take_peaks()
+            _OPEN.append(self)
+        if self.source is not None and os.path.exists(self.source):
+            self.add(bytes_in=os.path.getsize(self.source))
+        if self.kind == 'file':
+            self._previous = getattr(_LOCAL, 'current', None)
+            _LOCAL.current = self
+            self._cpu = time.thread_time()
+        else:
+            self._cpu = time.process_time()
+            self._children_cpu = _children_cpu()
+        self._wall = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler is not None:
+            self.profiler.disable()
+        record = self.record
+        record['wall_seconds'] = time.perf_counter() - self._wall
+        if self.kind == 'file':
+            record['cpu_seconds'] = time.thread_time() - self._cpu
+            _LOCAL.current = self._previous
+        else:
+            record['cpu_seconds'] = time.process_time() - self._cpu
+            record['worker_cpu_seconds'] = _children_cpu() - self._children_cpu
+        with _LOCK:
+            _take_peaks()
+            _OPEN.remove(self)
+            if self.profiler is not None and exc_info[0] is None:
+                record['profile'] = _keep_dump(self.profiler, record)
+            _write(record)
+
+
+def _read_records(directory):
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, RECORDS_PREFIX + '*'))):
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.endswith('\n'))
+        os.remove(path)
+    return records
+
+
+def _write_csv(path, fields, records):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for record in records:
+            writer.writerow(['' if record.get(field) is None else record[field] for field in fields])
+
+
+def finish(slowest=5):
+    """
+    writes the report of everything measured since start() and prints the stages and
+    the slowest files
+    """
+    global _RECORDS
+    if _SETTINGS is None:
+        return
+    directory, dumps, _ = _SETTINGS
+    if _RECORDS is not None:
+        _RECORDS[1].close()
+        _RECORDS = None
+    records = _read_records(directory)
+    files = sorted((record for record in records if record['kind'] == 'file'),
+                   key=lambda record: -record['wall_seconds'])
+    stages = [record for record in records if record['kind'] == 'stage']
+    # stages measured only by their files, such as the import that runs alongside the
+    # FIT conversions, get the sums of their files
+    for stage_name in OrderedDict((file['stage'], None) for file in reversed(files)):
+        if not any(record['stage'] == stage_name for record in stages):
+            record = OrderedDict((field, None) for field in FIELDS)
+            record.update(kind='stage', stage=stage_name, pid=None)
+            record['worker_cpu_seconds'] = None
+            for field in ['wall_seconds', 'cpu_seconds']:
+                record[field] = sum(file[field] for file in files if file['stage'] == stage_name)
+            peaks = [file['peak_rss'] for file in files
+                     if file['stage'] == stage_name and file['peak_rss'] is not None]
+            record['peak_rss'] = max(peaks) if peaks else None
+            stages.append(record)
+    for record in stages:
+        stage_files = [file for file in files if file['stage'] == record['stage']]
+        record['files'] = len(stage_files)
+        for field in ['rows_in', 'rows_out', 'bytes_in', 'bytes_out']:
+            values = [file[field] for file in stage_files if file[field] is not None]
+            record[field] = sum(values) if values else None
+        peaks = [file['peak_rss'] for file in stage_files if record['pid'] is not None
+                 and file['pid'] != record['pid'] and file['peak_rss'] is not None]
+        record['peak_rss_workers'] = max(peaks) if peaks else None
+    # the slowest files of every process kept their dumps; only the slowest of all stay
+    profiled = [file for file in files if file.get('profile')]
+    for file in profiled[dumps:]:
+        if os.path.exists(file['profile']):
+            os.remove(file['profile'])
+        file['profile'] = None
+
+    with open(os.path.join(directory, REPORT_FILENAME), 'w') as f:
+        json.dump({'stages': stages, 'files': files}, f, indent=1)
+    _write_csv(os.path.join(directory, STAGES_FILENAME), STAGE_FIELDS, stages)
+    _write_csv(os.path.join(directory, FILES_FILENAME), FILE_FIELDS, files)
+
+    print('profile (%s):' % directory)
+    for record in stages:
+        print('  %-10s %8.2fs wall %8.2fs cpu (%.2fs in workers), %d files' % (
+            record['stage'], record['wall_seconds'], record['cpu_seconds'],
+            record['worker_cpu_seconds'] or 0., record['files']))
+    for file in files[:slowest]:
+        print('  %-10s %8.2fs  %s' % (file['stage'], file['wall_seconds'], file['name']))
@@ -0,0 +1,219 @@
+"""
+gaussian kernel smoothing of track series, for several bandwidths at once
+
+values sampled at (possibly irregular) times are binned onto a grid of GRID_SECONDS.
+The binned sums and sample counts are transformed once, multiplied by the transforms of
+the gaussians of every bandwidth, and transformed back together, which gives
+the kernel-weighted mean sum(K(t - t_i) y_i) / sum(K(t - t_i)) at every sample for all
+bandwidths in one pass, in O(k n log n) instead of O(k n^2). Missing samples are simply
+not counted, so short gaps in the timestamps are bridged by their neighbours; pauses
+longer than GAP_SECONDS are shortened to GAP_SIGMAS of the widest bandwidth, so the
+parts of a track on either side of one are not smoothed into each other
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
+from geometry import MIPS_TO_MPH
+
+GRID_SECONDS = 1.
+
+# a longer stretch without points is a pause, which is not smoothed across
+GAP_SECONDS = 60.
+# room left between the parts of a track, in widest bandwidths; exp(-GAP_SIGMAS**2 / 2)
+# is what one part still weighs in the other
+GAP_SIGMAS = 8
+
+#if velocity > MAX_SPEED, then it indicates discontinuity (as in process_file)
+MAX_SPEED = 50#mph
+
+
+_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+_SEPARATORS = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':'}
+
+
+def _parse_plain_times(times):
+    """
+    seconds since the epoch of times that are all YYYY-MM-DDTHH:MM:SS, with or without
+    a Z, read straight from their characters; None if they are not all like that
+    """
+    if times.dtype.itemsize // 4 < 19:
+        return None
+    characters = times.view(np.uint32).reshape(len(times), -1)
+    for column, separator in _SEPARATORS.items():
+        if not (characters[:, column] == ord(separator)).all():
+            return None
+    # shorter strings are padded with zeros
+    if characters.shape[1] > 19 and not (((characters[:, 19] == ord('Z')) | (characters[:, 19] == 0)).all()
+                                         and (characters[:, 20:] == 0).all()):
+        return None
+    digits = characters[:, _DIGITS].astype(np.int64) - ord('0')
+    if not ((digits >= 0) & (digits <= 9)).all():
+        return None
+    digits = digits.reshape(len(times), 7, 2)
+    numbers = digits[:, :, 0] * 10 + digits[:, :, 1]
+    years = numbers[:, 0] * 100 + numbers[:, 1]
+    months, days, hours, minutes, seconds = numbers[:, 2:].T
+    if not ((months >= 1) & (months <= 12) & (days >= 1) & (hours < 24) & (minutes < 60)
+            & (seconds < 61)).all():
+        return None
+    dates = ((years - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (months - 1)
+             ).astype('datetime64[D]')
+    # a day past the end of its month would move into the next one
+    if not np.array_equal((dates + (days - 1)).astype('datetime64[M]'),
+                          dates.astype('datetime64[M]')):
+        return None
+    return ((dates.view(np.int64) + (days - 1)) * 86400. + hours * 3600. + minutes * 60.
+            + seconds)
+
+
+def parse_times(times):
+    """
+    seconds since the epoch of ISO 8601 time strings, or None if some cannot be read
+    """
+    times = np.asarray(times, dtype=str)
+    if not len(times):
+        return np.zeros(0)
+    plain = _parse_plain_times(times)
+    if plain is not None:
+        return plain
+    clock = np.char.partition(np.char.rstrip(times, 'Z'), 'T')[:, 2]
+    if not (np.char.find(clock, '+') >= 0).any() and not (np.char.find(clock, '-') >= 0).any():
+        # the fast path for UTC (or local) times; numpy does not read time zone offsets
+        try:
+            stripped = np.char.rstrip(times, 'Z')
+            return ((stripped.astype('datetime64[us]') - np.datetime64(0, 'us'))
+                    / np.timedelta64(1, 's'))
+        except ValueError:
+            pass
+    try:
+        return np.array([datetime.fromisoformat(time.replace('Z', '+00:00')).timestamp()
+                         for time in times])
+    except ValueError:
+        return None
+
+
+def track_positions(seconds, gap_seconds=GAP_SECONDS, padding=0.):
+    """
+    positions of the samples on a time line where every gap longer than gap_seconds is
+    shortened to padding; returns (positions, True where a gap precedes a sample)
+    """
+    steps = np.diff(seconds)
+    gaps = np.concatenate([[False], steps > gap_seconds])
+    steps = np.where(gaps[1:], padding, steps)
+    return np.concatenate([[0.], np.cumsum(steps)]), gaps
+
+
+def check_bandwidths(bandwidths):
+    """
+    bandwidths as floats; raises ValueError unless they are all positive and finite
+    """
+    bandwidths = [float(bandwidth) for bandwidth in bandwidths]
+    for bandwidth in bandwidths:
+        if not (0 < bandwidth < np.inf):
+            raise ValueError('a smoothing bandwidth must be a positive number of seconds, not %r'
+                             % bandwidth)
+    return bandwidths
+
+
+@lru_cache(maxsize=64)
+def _kernel_transforms(bandwidths, radius, length, grid_seconds):
+    # the kernels sampled on the grid (around its start, wrapping around to its end),
+    # rather than the analytic transform of a gaussian, which aliases on narrow ones
+    bandwidths = np.array(bandwidths)
+    offsets = np.arange(radius + 1) * grid_seconds
+    kernels = np.zeros((len(bandwidths), length))
+    kernels[:, :radius + 1] = np.exp(-0.5 * (offsets[None, :] / bandwidths[:, None])**2)
+    kernels[:, length - radius:] = kernels[:, radius:0:-1]
+    return np.fft.rfft(kernels, axis=1)
+
+
+def gaussian_smooth(positions, values, bandwidths, grid_seconds=GRID_SECONDS):
+    """
+    (bandwidths x samples) kernel-weighted means of values (NaN where missing) at
+    positions (seconds, nondecreasing) for gaussians with standard deviation bandwidths
+    (seconds); NaN where no sample is within reach. values can also be several series
+    (series x samples), which gives (series x bandwidths x samples)
+
+    the means are those of a direct convolution to about 1e-15 of the largest value,
+    divided by the sum of kernel weights where that is below 1 (a sample reached only
+    by the tails of the kernel)
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    series = np.atleast_2d(np.asarray(values, dtype=np.float64))
+    bandwidths = np.array(check_bandwidths(np.ravel(bandwidths)), dtype=np.float64)
+    smoothed = np.full((len(series), len(bandwidths), len(positions)), np.nan)
+    if len(positions) and len(bandwidths):
+        index = np.rint((positions - positions[0]) / grid_seconds).astype(np.int64)
+        # room for the widest kernel after the last sample, so nothing wraps around
+        radius = int(np.ceil(GAP_SIGMAS * bandwidths.max() / grid_seconds))
+        length = 1 << int(index[-1] + radius + 1).bit_length()
+        transfer = _kernel_transforms(tuple(bandwidths), radius, length, grid_seconds)
+        valid = np.isfinite(series)
+        # the sums and counts of every series on the grid, all transformed together
+        binned = np.zeros((2 * len(series), length))
+        for i, (samples, counted) in enumerate(zip(series, valid)):
+            binned[2 * i] = np.bincount(index[counted], weights=samples[counted], minlength=length)
+            binned[2 * i + 1] = np.bincount(index[counted], minlength=length)
+        convolved = np.fft.irfft(np.fft.rfft(binned, axis=1)[:, None, :] * transfer[None, :, :],
+                                 length, axis=2)[:, :, index]
+        for i in range(len(series)):
+            numerators = convolved[2 * i]
+            denominators = convolved[2 * i + 1]
+            # what is left of the transform's rounding where no sample is within reach
+            reachable = denominators > 1e-9 * max(binned[2 * i + 1].max(), 1.)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                smoothed[i] = np.where(reachable, numerators / denominators, np.nan)
+    return smoothed if np.ndim(values) > 1 else smoothed[0]
+
+
+def feature_names(bandwidths):
+    names = []
+    for bandwidth in bandwidths:
+        names.extend(['%s_smooth_%g' % (name, bandwidth)
+                      for name in ['sum_v', 'sum_v2', 'sum_v3', 'abs_elevation']])
+    return names
+
+
+def smoothed_features(times, distances, elevations, bandwidths):
+    """
+    sum_v, sum_v2 and sum_v3 of the smoothed speed and abs_elevation of the smoothed
+    elevation of a track, for each bandwidth (seconds), in feature_names' order
+
+    distances (miles) are between consecutive points. Speeds are integrated over time,
+    which for points 1 second apart is process_file's sum over points. Without readable,
+    increasing times the points are taken to be 1 second apart, as process_file does
+    """
+    bandwidths = check_bandwidths(bandwidths)
+    if len(elevations) < 2:
+        return OrderedDict((name, 0.) for name in feature_names(bandwidths))
+    seconds = parse_times(times)
+    if seconds is None or not np.all(np.diff(seconds) >= 0):
+        seconds = np.arange(len(elevations), dtype=np.float64)
+    padding = GAP_SIGMAS * max(bandwidths) if bandwidths else 0.
+    positions, gaps = track_positions(seconds, GAP_SECONDS, padding)
+    intervals = np.diff(seconds)
+
+    # the speed over each interval between points, at its end
+    with np.errstate(invalid='ignore', divide='ignore'):
+        velocities = distances / intervals * MIPS_TO_MPH
+    velocities = np.where((intervals > 0) & ~gaps[1:], velocities, np.nan)
+    velocities = velocities * (velocities < MAX_SPEED)
+    counted = np.isfinite(velocities)
+    # speeds and elevations go through one transform, with no speed at the first point
+    speeds, smoothed_elevations = gaussian_smooth(
+        positions, [np.concatenate([[np.nan], velocities]), elevations], bandwidths)
+    speeds = speeds[:, 1:]
+    elevation_changes = np.diff(smoothed_elevations, axis=1)[:, ~gaps[1:]]
+
+    features = OrderedDict()
+    for i, bandwidth in enumerate(bandwidths):
+        weights = np.where(counted, intervals, 0.)
+        speed = np.where(counted, speeds[i], 0.)
+        values = [np.sum(speed * weights), np.sum(speed**2 * weights),
+                  np.sum(speed**3 * weights), np.nansum(np.abs(elevation_changes[i]))/2]
+        features.update(zip(feature_names([bandwidth]), values))
+    return features
@@ -0,0 +1,74 @@
+import datetime
+import json
+import os
+
+import pytest
+
+import activity_cache
+import convert_fit_to_csv
+from manifest import MANIFEST_FILENAME
+from track_columns import SIDECAR_SUFFIX
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def output_files(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name != MANIFEST_FILENAME:
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[name] = f.read()
+            if name.endswith(SIDECAR_SUFFIX):
+                # everything but when its output was written
+                files[name] = dict(json.loads(files[name].decode('utf8')), mtime_ns=None)
+    return files
+
+
+def convert(csv_dir, fit_decoder, fit_cache=None):
+    csv_dir.mkdir()
+    convert_fit_to_csv.main(DATA_DIR, str(csv_dir), False, False, fit_decoder=fit_decoder,
+                            fit_cache=fit_cache)
+    return output_files(str(csv_dir))
+
+
+@pytest.mark.parametrize('fit_decoder', ['fitparse', 'fast'])
+def test_cache_hits_convert_like_a_fresh_decode(tmp_path, fit_decoder):
+    fit_files = [name for name in os.listdir(DATA_DIR) if name.endswith('.fit')]
+    expected = convert(tmp_path / 'decoded', fit_decoder)
+
+    cache = activity_cache.ActivityCache(str(tmp_path / 'cache'))
+    assert convert(tmp_path / 'stored', fit_decoder, cache) == expected
+    assert (cache.hits, cache.misses) == (0, len(fit_files))
+
+    cache = activity_cache.ActivityCache(str(tmp_path / 'cache'))
+    assert convert(tmp_path / 'loaded', fit_decoder, cache) == expected
+    assert (cache.hits, cache.misses) == (len(fit_files), 0)
+
+
+def round_trip(values):
+    recording = activity_cache.RecordingFitFile([('record', [('value', value)]) for value in values])
+    messages = list(recording.iter_message_fields())
+    cached = activity_cache.CachedActivity(activity_cache.serialize(recording, 'test'))
+    assert list(cached.iter_message_fields()) == messages
+    # the kind the column was stored as, and its values
+    return cached.columns[0][0][0], [fields[0][1] for name, fields in cached.iter_message_fields()]
+
+
+@pytest.mark.parametrize('values', [
+    [(1, 2, None), None, (0.5, float('inf'))],
+    [1, 2.5, 'three', None, True],
+    [[1, (2, 'b')], b'\x00\xff', datetime.datetime(2019, 6, 2, 12, 0, 0, 250000)],
+    [2 ** 64, -2 ** 70, None],
+])
+def test_other_values_are_cached_as_json(values):
+    kind, decoded = round_trip(values)
+    assert kind == 'json'
+    assert [type(value) for value in decoded] == [type(value) for value in values]
+
+
+def test_files_with_values_json_cannot_hold_are_not_cached(tmp_path):
+    cache = activity_cache.ActivityCache(str(tmp_path))
+    recording = activity_cache.RecordingFitFile([('record', [('value', object())])])
+    list(recording.iter_message_fields())
+    cache.store('hash', 'test', recording, 'test')
+    assert cache.load('hash', 'test') is None
@@ -0,0 +1,128 @@
+import os
+import random
+import shutil
+import zipfile
+
+import pytest
+
+import archive
+
+
+def write_tree(root, files):
+    for name, data in files.items():
+        path = os.path.join(str(root), name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def zip_contents(path):
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.testzip() is None
+        return dict((name, zip_file.read(name)) for name in zip_file.namelist())
+
+
+def reference_contents(tmp_path, source):
+    return zip_contents(shutil.make_archive(str(tmp_path / 'reference'), 'zip', root_dir=str(source)))
+
+
+def build(tmp_path, source):
+    output_dir = tmp_path / 'archives'
+    output_dir.mkdir(exist_ok=True)
+    path = archive.build_archive(str(output_dir), 'data', str(source), workers=2)
+    return zip_contents(path)
+
+
+def sample_files():
+    r = random.Random(0)
+    return {
+        'track.csv': b'timestamp,distance\r\n' + b''.join(b'%d,%f\r\n' % (i, i * 3.2) for i in range(5000)),
+        'noise.bin': bytes(r.getrandbits(8) for _ in range(20000)),
+        'empty.csv': b'',
+        'sub/laps.csv': b'lap,distance\r\n1,1000.0\r\n',
+        'sub/deeper/starts.csv': b'event\r\nstart\r\n',
+    }
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / 'source'
+    write_tree(source, sample_files())
+    return source
+
+
+def test_zip_matches_make_archive(tmp_path, source):
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+
+
+def test_zip_without_raw_writes(tmp_path, source, monkeypatch):
+    # what happens on a Python whose zipfile internals are not the expected ones
+    monkeypatch.setattr(archive, '_can_write_raw', lambda zip_file: False)
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    write_tree(source, {'new.csv': b'a,b\r\n1,2\r\n'})
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+
+
+def test_zip64_members(tmp_path, source, monkeypatch):
+    # members over the limit need ZIP64 extensions, both when written and when copied
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 1000)
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    write_tree(source, {'new.csv': b'a,b\r\n1,2\r\n'})
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    with zipfile.ZipFile(str(tmp_path / 'archives' / 'data.zip')) as zip_file:
+        with zip_file.open('noise.bin') as member:
+            # read back through the local header, which has to carry the ZIP64 extra
+            assert len(member.read()) == 20000
+        assert zip_file.getinfo('noise.bin').extra.startswith(b'\x01\x00')
+
+
+@pytest.fixture
+def deflated(monkeypatch):
+    # the names of the members compressed by each build
+    names = []
+    original = archive._deflate
+
+    def recording_deflate(path):
+        names.append(os.path.basename(path))
+        return original(path)
+
+    monkeypatch.setattr(archive, '_deflate', recording_deflate)
+    return names
+
+
+def test_update_adds_modifies_and_deletes(tmp_path, source, deflated):
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    assert sorted(deflated) == sorted(os.path.basename(name) for name in sample_files())
+
+    del deflated[:]
+    write_tree(source, {'sub/added.csv': b'a,b\r\n1,2\r\n'})
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    assert deflated == ['added.csv']
+
+    del deflated[:]
+    laps = str(source / 'sub' / 'laps.csv')
+    write_tree(source, {'sub/laps.csv': b'lap,distance\r\n1,1001.0\r\n'})
+    # same size, so only the mtime tells the manifest it changed
+    os.utime(laps, (os.path.getmtime(laps) + 10,) * 2)
+    assert build(tmp_path, source) == reference_contents(tmp_path, source)
+    assert deflated == ['laps.csv']
+
+    del deflated[:]
+    os.remove(str(source / 'noise.bin'))
+    contents = build(tmp_path, source)
+    assert contents == reference_contents(tmp_path, source)
+    assert 'noise.bin' not in contents
+    assert deflated == []
+
+    archive_path = str(tmp_path / 'archives' / 'data.zip')
+    mtime = os.path.getmtime(archive_path)
+    assert build(tmp_path, source) == contents
+    assert deflated == []
+    assert os.path.getmtime(archive_path) == mtime
+
+
+def test_bookkeeping_files_are_excluded(tmp_path, source):
+    write_tree(source, {'manifest.sqlite': b'', 'tz_cache.json': b'{}',
+                        'sub/laps.csv.bbox.json': b'{}'})
+    assert set(build(tmp_path, source)) == set(reference_contents(tmp_path, source)) - set(
+        ['manifest.sqlite', 'tz_cache.json', 'sub/laps.csv.bbox.json'])
@@ -0,0 +1,28 @@
+import csv
+
+import calculate_workout_variables
+from track_columns import read_sidecar
+
+
+def write_gpx(path, n_points):
+    points = ''.join(
+        '<trkpt lat="%.6f" lon="%.6f"><ele>%.1f</ele><time>2020-01-01T00:%02d:%02dZ</time></trkpt>\n'
+        % (51.5 + i * 1e-4, -0.12 + i * 1e-4, 20. + i % 7, i // 60, i % 60)
+        for i in range(n_points))
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.1"><trk><trkseg>\n'
+                + points + '</trkseg></trk></gpx>\n')
+
+
+def test_gpx_csv_has_a_row_per_point_after_the_first(tmp_path):
+    (tmp_path / 'target' / calculate_workout_variables.OUTPUT_SUBDIR).mkdir(parents=True)
+    write_gpx(str(tmp_path / 'ride.gpx'), 250)
+    summary = calculate_workout_variables.process_file('ride.gpx', str(tmp_path),
+                                                       str(tmp_path / 'target'))
+    assert summary is not None
+    output = str(tmp_path / 'target' / calculate_workout_variables.output_filename('ride.gpx'))
+    with open(output, 'r') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['time', 'distance', 'elevation_change']
+    assert len(rows) - 1 == read_sidecar(output)['rows'] == 249
+    assert rows[-1][0] == '2020-01-01T00:04:09Z'
@@ -0,0 +1,501 @@
+import codecs
+import csv
+import os
+import random
+
+import numpy as np
+import pytest
+
+import censor_and_package
+from censor_and_package import CensorRegions, distcalc
+from track_columns import read_sidecar, write_sidecar
+
+
+def baseline_is_censorable(regions, longitude, latitude):
+    # the check as it was made before rows were censored in chunks, one row at a time
+    for cc in regions:
+        if distcalc({'lat': cc['latitude'], 'lon': cc['longitude']},
+                    {'lat': latitude, 'lon': longitude}) <= cc['radius']:
+            return True
+    return False
+
+
+def baseline_transfer_csv(source, target, regions):
+    with open(source, 'r') as f:
+        reader = csv.reader(f)
+        with codecs.open(target, 'w', encoding='utf8') as of:
+            writer = csv.writer(of)
+            header = next(reader)
+            writer.writerow(header)
+            pairs, use_alternate_censoring, should_censor = censor_and_package.censor_plan(header)
+            for line in reader:
+                if not use_alternate_censoring:
+                    latitude_index, longitude_index = [header.index(name) for name in pairs[0]]
+                    try:
+                        longitude, latitude = float(line[longitude_index]), float(line[latitude_index])
+                    except ValueError:
+                        writer.writerow(line)
+                        continue
+                    will_censor = baseline_is_censorable(regions, longitude, latitude)
+                else:
+                    will_censor = False
+                    for latitude_name, longitude_name in pairs:
+                        try:
+                            latitude = float(line[header.index(latitude_name)])
+                            longitude = float(line[header.index(longitude_name)])
+                        except ValueError:
+                            continue
+                        if baseline_is_censorable(regions, longitude, latitude):
+                            will_censor = True
+                            break
+                if not will_censor:
+                    writer.writerow(line)
+                elif not censor_and_package.CENSOR_PARAMS['timestamp']:
+                    writer.writerow(censor_and_package.censor_line(line, should_censor))
+
+
+def edge_points(region, bearing):
+    """
+    the last point inside region and the first one outside it along a bearing from its
+    center, found by bisection on distcalc itself
+    """
+    latitude_step, longitude_step = bearing
+    center = {'lat': region['latitude'], 'lon': region['longitude']}
+
+    def point(t):
+        return region['latitude'] + t * latitude_step, region['longitude'] + t * longitude_step
+
+    def distance(t):
+        latitude, longitude = point(t)
+        return distcalc(center, {'lat': latitude, 'lon': longitude})
+
+    inside, outside = 0., 1.
+    while distance(outside) <= region['radius']:
+        outside *= 2
+    for _ in range(200):
+        middle = (inside + outside) / 2
+        if middle in (inside, outside):
+            break
+        if distance(middle) <= region['radius']:
+            inside = middle
+        else:
+            outside = middle
+    return point(inside), point(outside)
+
+
+def make_regions_and_points(seed):
+    r = random.Random(seed)
+    regions = [
+        {'latitude': 42.3601, 'longitude': -71.0589, 'radius': 500.},
+        {'latitude': 42.3650, 'longitude': -71.0540, 'radius': 250.},
+        {'latitude': 51.5074, 'longitude': -0.1278, 'radius': 1000.},
+        {'latitude': -33.8688, 'longitude': 151.2093, 'radius': 50.},
+    ]
+    points = []
+    for region in regions:
+        for _ in range(20):
+            bearing = (r.uniform(-1e-3, 1e-3), r.uniform(-1e-3, 1e-3))
+            points.extend(edge_points(region, bearing))
+        for _ in range(20):
+            # well inside and well outside
+            points.append((region['latitude'] + r.uniform(-1e-3, 1e-3),
+                           region['longitude'] + r.uniform(-1e-3, 1e-3)))
+            points.append((region['latitude'] + r.uniform(-0.1, 0.1),
+                           region['longitude'] + r.uniform(-0.1, 0.1)))
+    # a region whose edge passes exactly through a point
+    latitude, longitude = 42.3700, -71.0500
+    regions.append({'latitude': 42.3690, 'longitude': -71.0510,
+                    'radius': distcalc({'lat': 42.3690, 'lon': -71.0510},
+                                       {'lat': latitude, 'lon': longitude})})
+    points.extend([(latitude, longitude)] * 5)
+    r.shuffle(points)
+    return regions, points
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def track_rows(points, r):
+    rows = []
+    for i, (latitude, longitude) in enumerate(points):
+        latitude, longitude = repr(latitude), repr(longitude)
+        kind = r.random()
+        if kind < 0.03:
+            latitude = ''
+        elif kind < 0.06:
+            longitude = 'None'
+        elif kind < 0.07:
+            latitude = longitude = 'nan'
+        rows.append([str(1530000000 + i), latitude, longitude, '%.1f' % (i * 1.5), str(120 + i % 40)])
+    return rows
+
+
+def lap_rows(points, r):
+    rows = []
+    for i in range(0, len(points) - 1, 2):
+        start = [repr(value) for value in points[i]]
+        end = [repr(value) for value in points[i + 1]]
+        if r.random() < 0.2:
+            start = ['None', 'None']
+        if r.random() < 0.2:
+            end = ['None', '']
+        rows.append([str(1530000000 + i)] + start + end + ['%.2f' % (i * 10.)])
+    return rows
+
+
+# the files have a few hundred rows, so all but the default size span several chunks
+@pytest.mark.parametrize('chunk_rows', [1, 7, 64, censor_and_package.CSV_CHUNK_ROWS])
+def test_chunked_csv_censoring_matches_baseline(tmp_path, monkeypatch, chunk_rows):
+    monkeypatch.setattr(censor_and_package, 'CSV_CHUNK_ROWS', chunk_rows)
+    r = random.Random(chunk_rows)
+    regions, points = make_regions_and_points(1)
+    source_dir = tmp_path / 'source'
+    source_dir.mkdir()
+    target_dir = tmp_path / 'censored'
+    (target_dir / 'source').mkdir(parents=True)
+    baseline_dir = tmp_path / 'baseline'
+    baseline_dir.mkdir()
+    files = {
+        'track.csv': (['timestamp', 'position_lat', 'position_long', 'distance', 'heart_rate'],
+                      track_rows(points, r)),
+        'gpx_track.csv': (['time', 'latitude', 'longitude', 'elevation', 'heart_rate'],
+                          track_rows(points, r)),
+        'laps.csv': (['timestamp', 'start_position_lat', 'start_position_long',
+                      'end_position_lat', 'end_position_long', 'total_distance'],
+                     lap_rows(points, r)),
+    }
+    censor_regions = CensorRegions(regions)
+    censored_rows = 0
+    for filename, (header, rows) in files.items():
+        write_csv(str(source_dir / filename), header, rows)
+        censor_and_package.transfer_csv(filename, str(source_dir), str(target_dir), censor_regions)
+        baseline_transfer_csv(str(source_dir / filename), str(baseline_dir / filename), regions)
+        with open(str(baseline_dir / filename), 'rb') as f:
+            expected = f.read()
+        with open(str(target_dir / 'source' / filename), 'rb') as f:
+            assert f.read() == expected
+        censored_rows += expected.count(censor_and_package.CENSOR_STRING.encode())
+    assert censored_rows > 0
+
+
+LAP_HEADER = ['timestamp', 'start_position_lat', 'start_position_long', 'end_position_lat',
+              'end_position_long', 'total_distance']
+# a lap starting inside the region, one ending inside it, and one far away; mirrored, as
+# (latitude, longitude) read as (longitude, latitude), none of them is anywhere near it
+LAP_ROWS = [
+    ['1', '42.3601', '-71.0589', '42.5', '-71.5', '1000.0'],
+    ['2', '42.5', '-71.5', '42.3605', '-71.0590', '2000.0'],
+    ['3', '42.5', '-71.5', '42.6', '-71.6', '3000.0'],
+]
+
+
+def test_lap_positions_inside_a_region_are_censored(tmp_path):
+    censor_regions = CensorRegions([{'latitude': 42.3601, 'longitude': -71.0589, 'radius': 200.}])
+    (tmp_path / 'source').mkdir()
+    (tmp_path / 'censored' / 'source').mkdir(parents=True)
+    write_csv(str(tmp_path / 'source' / 'laps.csv'), LAP_HEADER, LAP_ROWS)
+    censor_and_package.transfer_csv('laps.csv', str(tmp_path / 'source'),
+                                    str(tmp_path / 'censored'), censor_regions)
+    with open(str(tmp_path / 'censored' / 'source' / 'laps.csv'), 'r') as f:
+        rows = list(csv.reader(f))
+    censored = censor_and_package.CENSOR_STRING
+    assert rows[0] == LAP_HEADER
+    assert rows[1] == ['1', censored, censored, censored, censored, '1000.0']
+    assert rows[2] == ['2', censored, censored, censored, censored, '2000.0']
+    assert rows[3] == LAP_ROWS[2]
+
+    columns = dict((name, (np.array([float(row[i]) for row in LAP_ROWS]), np.ones(3, dtype=bool)))
+                   for i, name in enumerate(LAP_HEADER))
+    censored_columns = censor_and_package.censor_columns(columns, censor_regions)
+    assert censored_columns['start_position_lat'][1].tolist() == [False, False, True]
+    assert censored_columns['total_distance'][1].tolist() == [True, True, True]
+
+
+def random_regions(r, n):
+    regions = []
+    for _ in range(n):
+        kind = r.random()
+        if kind < 0.2:
+            latitude = r.choice([-1, 1]) * r.uniform(88.5, 90.)
+        else:
+            latitude = r.uniform(-80., 80.)
+        if kind > 0.8:
+            longitude = r.choice([-180., 180.]) + r.uniform(-0.5, 0.5)
+            longitude = max(min(longitude, 180.), -180.)
+        else:
+            longitude = r.uniform(-180., 180.)
+        radius = r.choice([r.uniform(10., 1000.), r.uniform(1000., 50000.), r.uniform(1e5, 5e5)])
+        regions.append({'latitude': latitude, 'longitude': longitude, 'radius': radius})
+    return regions
+
+
+def random_points(r, regions, n):
+    latitudes, longitudes = [], []
+    for _ in range(n):
+        region = r.choice(regions)
+        # up to a few radii away, in degrees
+        spread = 3 * np.degrees(region['radius'] / censor_and_package.C_R)
+        kind = r.random()
+        if kind < 0.1:
+            latitude, longitude = r.uniform(-90., 90.), r.uniform(-180., 180.)
+        elif kind < 0.2:
+            latitude = r.choice([-90., 90., r.uniform(-90., 90.)])
+            longitude = r.choice([-180., 180., -179.9999, 179.9999])
+        else:
+            latitude = min(max(region['latitude'] + r.uniform(-spread, spread), -90.), 90.)
+            longitude = region['longitude'] + r.uniform(-spread, spread) / max(
+                np.cos(np.radians(latitude)), 1e-3)
+            # as a GPS would report it
+            longitude = (longitude + 180.) % 360. - 180.
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+    for region in regions:
+        bearing = (r.uniform(-1e-2, 1e-2), r.uniform(-1e-2, 1e-2))
+        for latitude, longitude in edge_points(region, bearing):
+            if abs(latitude) <= 90:
+                latitudes.append(latitude)
+                longitudes.append(longitude)
+    return np.array(longitudes), np.array(latitudes)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_censor_regions_match_brute_force(seed):
+    r = random.Random(seed)
+    regions = random_regions(r, 30)
+    longitudes, latitudes = random_points(r, regions, 2000)
+    expected = [baseline_is_censorable(regions, longitude, latitude)
+                for longitude, latitude in zip(longitudes.tolist(), latitudes.tolist())]
+    for cell_degrees in [None, 0.01, 1., 45.]:
+        censor_regions = CensorRegions(regions, cell_degrees)
+        assert censor_regions.mask(longitudes, latitudes).tolist() == expected
+        for i in range(0, len(expected), 97):
+            assert censor_regions.contains(longitudes[i], latitudes[i]) == expected[i]
+    # both outcomes are covered
+    assert 0 < sum(expected) < len(expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_may_intersect_never_skips_a_box_touching_a_region(seed):
+    r = random.Random(seed)
+    regions = random_regions(r, 30)
+    longitudes, latitudes = random_points(r, regions, 2000)
+    censor_regions = CensorRegions(regions)
+    inside = np.flatnonzero(censor_regions.mask(longitudes, latitudes))
+    assert len(inside)
+    for i in inside.tolist():
+        latitude, longitude = float(latitudes[i]), float(longitudes[i])
+        # boxes from a single point up to a few degrees, some with the point on an edge
+        below, left, above, right = [r.choice([0., 1e-9, r.uniform(0., 0.01), r.uniform(0., 3.)])
+                                     for _ in range(4)]
+        bounds = (max(latitude - below, -90.), max(longitude - left, -180.),
+                  min(latitude + above, 90.), min(longitude + right, 180.))
+        assert censor_regions.may_intersect(bounds), (regions, bounds)
+    # while a box on the other side of the globe from a region is skipped
+    for region in regions:
+        latitude = -region['latitude']
+        longitude = (region['longitude'] + 360.) % 360. - 180.
+        assert not CensorRegions([region]).may_intersect(
+            (latitude - 1e-3, max(longitude - 1e-3, -180.), latitude + 1e-3, min(longitude + 1e-3, 180.)))
+
+
+def test_stale_sidecar_is_ignored(tmp_path):
+    censor_regions = CensorRegions([{'latitude': 42.3601, 'longitude': -71.0589, 'radius': 200.}])
+    (tmp_path / 'source').mkdir()
+    (tmp_path / 'censored' / 'source').mkdir(parents=True)
+    path = str(tmp_path / 'source' / 'track.csv')
+    write_csv(path, ['timestamp', 'position_lat', 'position_long'], [['1', '51.5', '-0.12']])
+    write_sidecar(path, 1, (51.5, -0.12, 51.5, -0.12))
+    assert censor_and_package.can_copy_uncensored(path, censor_regions)
+
+    # same size, so only the mtime shows the change
+    write_csv(path, ['timestamp', 'position_lat', 'position_long'], [['1', '42.36', '-71.06']])
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+    assert read_sidecar(path) is None
+    assert not censor_and_package.can_copy_uncensored(path, censor_regions)
+    censor_and_package.transfer_csv('track.csv', str(tmp_path / 'source'),
+                                    str(tmp_path / 'censored'), censor_regions)
+    with open(str(tmp_path / 'censored' / 'source' / 'track.csv'), 'r') as f:
+        assert list(csv.reader(f))[1] == ['1'] + [censor_and_package.CENSOR_STRING] * 2
+
+    write_sidecar(path, 1, (42.36, -71.06, 42.36, -71.06))
+    with open(path, 'a') as f:
+        f.write('2,42.36,-71.06\r\n')
+    assert read_sidecar(path) is None
+
+
+REGION_CSV = 'latitude,longitude,radius\n42.3601,-71.0589,%s\n'
+
+
+class CensorRun(object):
+    """
+    runs the censor stage over two source directories, recording which files it censored
+    """
+
+    def __init__(self, tmp_path, monkeypatch):
+        self.sources = [str(tmp_path / 'fit_csv'), str(tmp_path / 'gpx')]
+        self.target = str(tmp_path / 'censored')
+        self.censorfile = str(tmp_path / 'censor.csv')
+        for directory in self.sources:
+            os.makedirs(directory)
+        self.write('fit_csv/inside.csv', [['1', '42.3601', '-71.0589']])
+        self.write('fit_csv/outside.csv', [['1', '51.5', '-0.12']])
+        self.write('gpx/track.csv', [['1', '42.3602', '-71.0588'], ['2', '51.5', '-0.12']])
+        with open(os.path.join(str(tmp_path), 'gpx', 'route.gpx'), 'w') as f:
+            f.write('<gpx><trk><trkseg><trkpt lat="42.3601" lon="-71.0589"></trkpt>'
+                    '</trkseg></trk></gpx>')
+        self.set_radius(200.)
+        self.censored = []
+        monkeypatch.setattr(censor_and_package, 'CENSOR_STRING', censor_and_package.CENSOR_STRING)
+        for name in ['transfer_csv', 'transfer_gpx']:
+            monkeypatch.setattr(censor_and_package, name, self.recording(getattr(censor_and_package, name)))
+
+    def recording(self, transfer):
+        def recorded(filename, directory, *args):
+            self.censored.append(os.path.join(os.path.split(directory)[1], filename))
+            return transfer(filename, directory, *args)
+        return recorded
+
+    def write(self, name, rows):
+        write_csv(os.path.join(os.path.dirname(self.sources[0]), name),
+                  ['timestamp', 'position_lat', 'position_long'], rows)
+
+    def set_radius(self, radius):
+        with open(self.censorfile, 'w') as f:
+            f.write(REGION_CSV % radius)
+
+    def __call__(self, sources=None, censor_string='[CENSORED]'):
+        self.censored = []
+        censor_and_package.main(sources or self.sources, self.target, self.censorfile,
+                                censor_string, {'archive_results': False})
+        return sorted(self.censored)
+
+    def output(self, name):
+        with open(os.path.join(self.target, name), 'r') as f:
+            return f.read()
+
+
+ALL_SOURCES = ['fit_csv/inside.csv', 'fit_csv/outside.csv', 'gpx/route.gpx', 'gpx/track.csv']
+
+
+def test_censor_stage_only_censors_what_changed(tmp_path, monkeypatch):
+    run = CensorRun(tmp_path, monkeypatch)
+    assert run() == ALL_SOURCES
+    assert censor_and_package.CENSOR_STRING in run.output('fit_csv/inside.csv')
+    assert run() == []
+
+    # the same content with a new mtime is not censored again
+    path = str(tmp_path / 'fit_csv' / 'outside.csv')
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+    assert run() == []
+
+    run.write('fit_csv/outside.csv', [['1', '42.3601', '-71.0589'], ['2', '51.5', '-0.12']])
+    assert run() == ['fit_csv/outside.csv']
+    assert censor_and_package.CENSOR_STRING in run.output('fit_csv/outside.csv')
+
+    # so is a censored file that was deleted
+    os.remove(os.path.join(run.target, 'gpx', 'track.csv'))
+    assert run() == ['gpx/track.csv']
+    assert run() == []
+
+
+def test_censor_configuration_changes_censor_everything(tmp_path, monkeypatch):
+    run = CensorRun(tmp_path, monkeypatch)
+    assert run() == ALL_SOURCES
+    monkeypatch.setitem(censor_and_package.CENSOR_PARAMS, 'timestamp', True)
+    assert run() == ALL_SOURCES
+    # the row inside the region is gone altogether now
+    assert run.output('gpx/track.csv').splitlines()[1:] == ['2,51.5,-0.12']
+    assert run() == []
+    monkeypatch.setitem(censor_and_package.CENSOR_PARAMS, 'timestamp', False)
+    assert run() == ALL_SOURCES
+
+    run.set_radius(10.)
+    assert run() == ALL_SOURCES
+    assert run() == []
+
+    assert run(censor_string='***') == ALL_SOURCES
+    assert '***' in run.output('fit_csv/inside.csv')
+
+
+def test_only_censored_files_whose_source_is_gone_are_removed(tmp_path, monkeypatch):
+    run = CensorRun(tmp_path, monkeypatch)
+    run()
+    unrelated = os.path.join(run.target, 'fit_csv', 'notes.txt')
+    with open(unrelated, 'w') as f:
+        f.write('kept')
+    os.remove(str(tmp_path / 'fit_csv' / 'inside.csv'))
+    os.remove(str(tmp_path / 'gpx' / 'route.gpx'))
+
+    # a directory that is not searched this time keeps its censored files
+    assert run(run.sources[:1]) == []
+    assert not os.path.exists(os.path.join(run.target, 'fit_csv', 'inside.csv'))
+    assert os.path.exists(os.path.join(run.target, 'gpx', 'route.gpx'))
+
+    assert run() == []
+    assert not os.path.exists(os.path.join(run.target, 'gpx', 'route.gpx'))
+    for name in ['fit_csv/outside.csv', 'gpx/track.csv', 'fit_csv/notes.txt']:
+        assert os.path.exists(os.path.join(run.target, name))
+    # the source is back, so it is censored again
+    run.write('fit_csv/inside.csv', [['1', '42.3601', '-71.0589']])
+    assert run() == ['fit_csv/inside.csv']
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# crosses the start of the cycling and Sydney running tracks; the Chicago one is far away
+FIXTURE_REGIONS_CSV = 'latitude,longitude,radius\n40.7100,-74.0000,5\n-33.8600,151.2000,3\n'
+
+
+def censored_files(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name != 'manifest.sqlite':
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[name] = f.read()
+    return files
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'npz'])
+def test_fused_censor_matches_the_censor_stage(tmp_path, monkeypatch, output_format):
+    import convert_fit_to_csv
+
+    censorfile = str(tmp_path / 'censor.csv')
+    with open(censorfile, 'w') as f:
+        f.write(FIXTURE_REGIONS_CSV)
+    monkeypatch.setattr(censor_and_package, 'CENSOR_STRING', censor_and_package.CENSOR_STRING)
+    transferred = []
+    for name in ['transfer_csv', 'transfer_columns']:
+        def recording(filename, directory, *args, transfer=getattr(censor_and_package, name)):
+            transferred.append(filename)
+            return transfer(filename, directory, *args)
+        monkeypatch.setattr(censor_and_package, name, recording)
+
+    censored = {}
+    for fused in [False, True]:
+        run_dir = tmp_path / ('fused' if fused else 'separate')
+        (run_dir / 'csv').mkdir(parents=True)
+        censor_target_dir = str(run_dir / 'censored')
+        fit_censor = None
+        if fused:
+            fit_censor = censor_and_package.fused_censor(censorfile, censor_target_dir,
+                                                         censor_and_package.CENSOR_STRING)
+        convert_fit_to_csv.main(DATA_DIR, str(run_dir / 'csv'), False, False,
+                                fit_output_format=output_format, fit_censor=fit_censor)
+        del transferred[:]
+        censor_and_package.main([str(run_dir / 'csv')], censor_target_dir, censorfile,
+                                censor_and_package.CENSOR_STRING, {'archive_results': False})
+        if fused:
+            # everything was censored during conversion already
+            assert transferred == []
+        else:
+            assert transferred
+        censored[fused] = censored_files(os.path.join(censor_target_dir, 'csv'))
+
+    assert censored[True] == censored[False]
+    # and the region did censor something
+    sources = censored_files(str(tmp_path / 'fused' / 'csv'))
+    assert any(data != sources[name] for name, data in censored[True].items())
@@ -0,0 +1,212 @@
+import json
+import os
+import shutil
+import struct
+import tracemalloc
+
+import fitparse
+import pytest
+
+import convert_fit_to_csv
+import fast_fit
+from manifest import FIT_STAGE, MANIFEST_FILENAME, Manifest
+from track_columns import SIDECAR_SUFFIX
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def write_records_fit(path, n_records):
+    """
+    a FIT file of n_records record messages with a timestamp and a heart rate
+    """
+    records = [struct.pack('<BBBHB', 0x40, 0, 0, 20, 2) + bytes([253, 4, 0x86, 3, 1, 0x02])]
+    records += [struct.pack('<BIB', 0, 900000000 + i, 100 + i % 50) for i in range(n_records)]
+    data = b''.join(records)
+    header = struct.pack('<BBHI4s', 14, 0x10, 2093, len(data), b'.FIT')
+    header += struct.pack('<H', fast_fit.crc16(header))
+    with open(path, 'wb') as f:
+        f.write(header + data + struct.pack('<H', fast_fit.crc16(header + data)))
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_iter_message_fields_memory_does_not_grow_with_the_file(tmp_path):
+    path = str(tmp_path / 'records.fit')
+    write_records_fit(path, 2000)
+
+    def open_fitfile():
+        return fitparse.FitFile(path, data_processor=fitparse.StandardUnitsDataProcessor())
+
+    def stream():
+        messages = 0
+        for name, fields in convert_fit_to_csv.iter_message_fields(open_fitfile()):
+            messages += 1
+        return messages
+
+    def fitparse_iteration():
+        # fitparse on its own keeps every message it has parsed until the file is closed
+        messages = 0
+        for message in open_fitfile().get_messages():
+            messages += 1
+        return messages
+
+    messages, peak = peak_memory(stream)
+    assert messages == 2000
+    expected_messages, fitparse_peak = peak_memory(fitparse_iteration)
+    assert expected_messages == messages
+    assert peak < fitparse_peak / 10
+
+
+def test_iter_message_fields_without_fitparse_internals():
+    fitfile = fitparse.FitFile(os.path.join(DATA_DIR, 'cycling.fit'),
+                               data_processor=fitparse.StandardUnitsDataProcessor())
+    expected = [(m.name, [(field.name, field.value) for field in m.fields])
+                for m in fitfile.get_messages()]
+
+    class Messages(object):
+        # only what iter_message_fields is meant to rely on
+        def get_messages(self):
+            return iter(fitfile.get_messages())
+
+    assert list(convert_fit_to_csv.iter_message_fields(Messages())) == expected
+
+
+@pytest.fixture
+def converted(monkeypatch):
+    # the names of the files converted by each run
+    names = []
+    original = convert_fit_to_csv.convert_job
+
+    def recording_convert_job(job):
+        names.append(job[0])
+        return original(job)
+
+    monkeypatch.setattr(convert_fit_to_csv, 'convert_job', recording_convert_job)
+    return names
+
+
+@pytest.fixture
+def fit_dir(tmp_path):
+    fit_dir = tmp_path / 'fit'
+    fit_dir.mkdir()
+    (tmp_path / 'csv').mkdir()
+    for name in ['cycling.fit', 'running_dst.fit']:
+        shutil.copy(os.path.join(DATA_DIR, name), str(fit_dir / name))
+    return fit_dir
+
+
+def convert(fit_dir, converted, **kwargs):
+    del converted[:]
+    convert_fit_to_csv.main(str(fit_dir), str(fit_dir.parent / 'csv'), False, False, **kwargs)
+    return sorted(converted)
+
+
+def csv_outputs(fit_dir):
+    return sorted(name for name in os.listdir(str(fit_dir.parent / 'csv')) if name.endswith('.csv'))
+
+
+def test_file_log_is_migrated(fit_dir, converted):
+    log = fit_dir.parent / 'csv' / convert_fit_to_csv.ALT_LOG_
+    log.write_text('cycling.fit\n')
+    assert convert(fit_dir, converted) == ['running_dst.fit']
+    assert not log.exists()
+    assert (fit_dir.parent / 'csv' / (convert_fit_to_csv.ALT_LOG_ + '.migrated')).exists()
+    assert convert(fit_dir, converted) == []
+    # a migrated file is converted again once it changes
+    shutil.copy(os.path.join(DATA_DIR, 'edge_cases.fit'), str(fit_dir / 'cycling.fit'))
+    assert convert(fit_dir, converted) == ['cycling.fit']
+
+
+def test_only_changed_files_are_converted_again(fit_dir, converted):
+    assert convert(fit_dir, converted) == ['cycling.fit', 'running_dst.fit']
+    first_outputs = csv_outputs(fit_dir)
+    assert convert(fit_dir, converted) == []
+
+    # touched, but the same content
+    path = str(fit_dir / 'cycling.fit')
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 10 ** 9,) * 2)
+    assert convert(fit_dir, converted) == []
+
+    # the same name with other content, which starts at another time
+    shutil.copy(os.path.join(DATA_DIR, 'edge_cases.fit'), path)
+    assert convert(fit_dir, converted) == ['cycling.fit']
+    outputs = csv_outputs(fit_dir)
+    # the outputs cycling.fit no longer produces are gone, sidecars and all
+    removed = set(first_outputs) - set(outputs)
+    assert removed and set(outputs) - set(first_outputs)
+    csv_dir = str(fit_dir.parent / 'csv')
+    for name in removed:
+        assert not os.path.exists(os.path.join(csv_dir, name + SIDECAR_SUFFIX))
+    for name in outputs:
+        assert os.path.exists(os.path.join(csv_dir, name + SIDECAR_SUFFIX))
+    assert convert(fit_dir, converted) == []
+
+
+def test_decoder_version_changes_convert_again(fit_dir, converted, monkeypatch):
+    assert convert(fit_dir, converted, fit_decoder='fast') == ['cycling.fit', 'running_dst.fit']
+    assert convert(fit_dir, converted, fit_decoder='fast') == []
+    monkeypatch.setattr(fast_fit, 'DECODER_VERSION', fast_fit.DECODER_VERSION + 1)
+    assert convert(fit_dir, converted, fit_decoder='fast') == ['cycling.fit', 'running_dst.fit']
+    assert convert(fit_dir, converted, fit_decoder='fast') == []
+
+    assert convert(fit_dir, converted) == ['cycling.fit', 'running_dst.fit']
+    assert convert(fit_dir, converted) == []
+    monkeypatch.setattr(fitparse, '__version__', fitparse.__version__ + '.post1')
+    assert convert(fit_dir, converted) == ['cycling.fit', 'running_dst.fit']
+    # what fitparse converted is current for the fast decoder too, which falls back to it
+    assert convert(fit_dir, converted, fit_decoder='fast') == []
+
+
+def output_files(directory):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name != MANIFEST_FILENAME:
+            with open(os.path.join(directory, name), 'rb') as f:
+                files[name] = f.read()
+            if name.endswith(SIDECAR_SUFFIX):
+                # everything but when its output was written
+                files[name] = dict(json.loads(files[name].decode('utf8')), mtime_ns=None)
+    return files
+
+
+@pytest.mark.parametrize('fit_decoder', ['fitparse', 'fast'])
+def test_workers_convert_like_a_single_process(tmp_path, capsys, fit_decoder):
+    # chained.fit, developer_fields.fit and edge_cases.fit all start at the same time, so
+    # they convert to the same names and the last of them (in name order) is kept
+    results = []
+    for workers in [1, 3]:
+        csv_dir = tmp_path / ('workers_%d' % workers)
+        csv_dir.mkdir()
+        capsys.readouterr()
+        convert_fit_to_csv.main(DATA_DIR, str(csv_dir), False, False, fit_workers=workers,
+                                fit_decoder=fit_decoder)
+        collisions = [line for line in capsys.readouterr().out.splitlines()
+                      if 'both convert to' in line]
+        with Manifest(str(csv_dir)) as manifest:
+            entries = [(source, manifest.lookup(FIT_STAGE, source)['outputs'])
+                       for source in manifest.sources(FIT_STAGE)]
+        results.append((output_files(str(csv_dir)), collisions, entries))
+
+    assert results[0] == results[1]
+    files, collisions, entries = results[0]
+    # each file replaces the one placed before it
+    assert collisions == [
+        'chained.fit and developer_fields.fit both convert to running_2018-07-08_16-00-00.csv; '
+        'keeping the one from developer_fields.fit',
+        'developer_fields.fit and edge_cases.fit both convert to running_2018-07-08_16-00-00.csv; '
+        'keeping the one from edge_cases.fit',
+    ]
+    alone_dir = tmp_path / 'alone'
+    alone_dir.mkdir()
+    convert_fit_to_csv.main(DATA_DIR, str(alone_dir), False, False, fit_decoder=fit_decoder,
+                            fit_files=['edge_cases.fit'])
+    for name, data in output_files(str(alone_dir)).items():
+        if name.startswith('running_2018-07-08_16-00-00'):
+            assert files[name] == data
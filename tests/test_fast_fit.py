@@ -0,0 +1,71 @@
+"""
+differential tests of the fast decoder against fitparse, on the files in data/:
+
+ * cycling.fit and running_dst.fit, small activities as a device writes them
+ * edge_cases.fit: big-endian messages, compressed timestamps, subfields, invalid values
+   and components
+ * chained.fit: the same with a second FIT file chained after it
+ * developer_fields.fit: an exported field comes from a developer field, which the fast
+   decoder leaves to fitparse
+"""
+
+import os
+import shutil
+
+import fitparse
+import pytest
+
+import fast_fit
+from convert_fit_to_csv import decoded_fields
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def fitparse_message_fields(path, field_names):
+    fitfile = fitparse.FitFile(path, data_processor=fitparse.StandardUnitsDataProcessor())
+    return [(message.name, [(field.name, field.value) for field in message.fields
+                            if field.name in field_names])
+            for message in fitfile.get_messages()]
+
+
+def fast_message_fields(path, field_names):
+    return list(fast_fit.FastFitFile(path, field_names).iter_message_fields())
+
+
+@pytest.mark.parametrize('filename', ['cycling.fit', 'running_dst.fit', 'edge_cases.fit',
+                                      'chained.fit'])
+def test_exported_fields_match_fitparse(filename):
+    path = os.path.join(DATA_DIR, filename)
+    expected = fitparse_message_fields(path, decoded_fields)
+    assert expected
+    assert fast_message_fields(path, decoded_fields) == expected
+
+
+@pytest.mark.parametrize('filename', ['cycling.fit', 'running_dst.fit'])
+def test_all_fields_match_fitparse(filename):
+    # what the activity cache keeps
+    path = os.path.join(DATA_DIR, filename)
+    assert (fast_message_fields(path, fast_fit.ALL_FIELDS)
+            == fitparse_message_fields(path, fast_fit.ALL_FIELDS))
+
+
+def test_developer_fields_fall_back_to_fitparse():
+    path = os.path.join(DATA_DIR, 'developer_fields.fit')
+    with pytest.raises(fast_fit.FastFitUnsupported):
+        fast_message_fields(path, decoded_fields)
+    assert fitparse_message_fields(path, decoded_fields)
+
+
+def test_bad_crc_falls_back_to_fitparse(tmp_path):
+    path = str(tmp_path / 'bad_crc.fit')
+    shutil.copy(os.path.join(DATA_DIR, 'cycling.fit'), path)
+    with open(path, 'r+b') as f:
+        data = bytearray(f.read())
+        # the file's CRC, at its end
+        data[-2] ^= 0xFF
+        f.seek(0)
+        f.write(data)
+    with pytest.raises(fast_fit.FastFitUnsupported):
+        fast_message_fields(path, decoded_fields)
+    with pytest.raises(fitparse.FitParseError):
+        fitparse_message_fields(path, decoded_fields)
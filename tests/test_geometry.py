@@ -0,0 +1,137 @@
+import random
+
+import numpy as np
+import pytest
+
+import geometry
+from geometry import FPS_TO_MPH, G_FPS
+
+PI = np.pi
+C_R = 6371/1.60934
+
+
+def baseline_distcalc(c1, c2):
+    # calculate_workout_variables.distcalc before distances were computed on whole arrays
+    lat1 = float(c1['lat'])*PI/180.
+    lon1 = float(c1['lon'])*PI/180.
+
+    lat2 = float(c2['lat'])*PI/180.
+    lon2 = float(c2['lon'])*PI/180.
+
+    dlat = lat2-lat1
+    dlon = lon2-lon1
+
+    a = np.sin(dlat/2.)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    d = C_R * c
+    return d
+
+
+def baseline_distances(latitudes, longitudes):
+    points = [{'lat': lat, 'lon': lon} for lat, lon in zip(latitudes, longitudes)]
+    return np.asarray([baseline_distcalc(c2, c1) for c1, c2 in zip(points[1:], points[:-1])])
+
+
+def baseline_energy_increases(velocities, elevation_changes):
+    # as process_file computed them, one point at a time
+    increases = []
+    for i in range(1, len(velocities)):
+        increase = (3600 * velocities[i])**2 - (3600 * velocities[i - 1])**2
+        if elevation_changes[i] < 0:
+            increase -= FPS_TO_MPH**2 * G_FPS * elevation_changes[i]
+        increases.append(increase)
+    return np.array(increases)
+
+
+def random_track(seed, n_points):
+    """
+    a 1 Hz track of latitudes and longitudes (degrees) and elevations, with stops, gps
+    jumps, and stretches across the date line and near the poles
+    """
+    r = random.Random(seed)
+    latitude = r.uniform(-89, 89)
+    longitude = r.uniform(-180, 180)
+    elevation = r.uniform(0, 3000)
+    latitudes, longitudes, elevations = [], [], []
+    for _ in range(n_points):
+        latitudes.append(latitude)
+        longitudes.append(longitude)
+        elevations.append(elevation)
+        kind = r.random()
+        if kind < 0.05:
+            # standing still
+            continue
+        elif kind < 0.06:
+            # a jump anywhere
+            latitude = r.uniform(-90, 90)
+            longitude = r.uniform(-180, 180)
+            continue
+        # up to about 15 m/s
+        latitude = max(-90., min(90., latitude + r.gauss(0, 5e-5)))
+        longitude = (longitude + r.gauss(0, 5e-5) + 180) % 360 - 180
+        elevation += r.gauss(0, 0.5)
+    return np.array(latitudes), np.array(longitudes), np.array(elevations)
+
+
+TRACKS = [random_track(seed, 2000) for seed in range(5)] + [
+    # across the date line, up to a pole and over it, and back and forth along the equator
+    (np.array([10., 10., 10., 10.]), np.array([179.9999, 180., -179.9999, 179.9999]),
+     np.zeros(4)),
+    (np.array([89.9999, 90., 89.9999, -90., -89.9999]), np.array([0., 0., 180., 0., 90.]),
+     np.zeros(5)),
+    (np.array([0., 0., 0., 0.]), np.array([0., 1e-6, 180., 0.]), np.zeros(4)),
+    # nearly opposite points
+    (np.array([45., -44.99, 45., -45.]), np.array([10., -170.01, 10., -169.9999]), np.zeros(4)),
+]
+
+
+@pytest.mark.parametrize('track', range(len(TRACKS)))
+def test_distances_match_distcalc(track):
+    latitudes, longitudes, elevations = TRACKS[track]
+    expected = baseline_distances(latitudes, longitudes)
+    # distcalc's squares went through pow(), which is off by a unit in the last place now
+    # and then, and arctan2 can make that two
+    np.testing.assert_array_max_ulp(geometry.distances(latitudes, longitudes), expected, 2)
+    assert geometry.distances(latitudes, longitudes).dtype == np.float64
+
+    float32 = geometry.distances(latitudes, longitudes, dtype=np.float32)
+    assert float32.dtype == np.float32
+    np.testing.assert_allclose(float32, expected, rtol=3e-7, atol=0)
+
+
+def test_haversine_matches_distcalc_between_any_points():
+    r = random.Random(0)
+    points = [{'lat': r.uniform(-90, 90), 'lon': r.uniform(-180, 180)} for _ in range(1000)]
+    pairs = list(zip(points[:-1], points[1:]))
+    expected = np.array([baseline_distcalc(c1, c2) for c1, c2 in pairs])
+    lat1, lon1, lat2, lon2 = [geometry.radians([pair[i][name] for pair in pairs])
+                              for i in range(2) for name in ['lat', 'lon']]
+    np.testing.assert_array_max_ulp(geometry.haversine(lat1, lon1, lat2, lon2, C_R), expected, 2)
+    assert np.array_equal(geometry.haversine(lat1, lon1, lat2, lon2, C_R, np.cos(lat1)),
+                          geometry.haversine(lat1, lon1, lat2, lon2, C_R))
+    # and one pair at a time, as distcalc is called
+    for (c1, c2), distance in zip(pairs[:20], expected):
+        np.testing.assert_array_max_ulp(geometry.haversine(
+            *[value*PI/180. for value in [c1['lat'], c1['lon'], c2['lat'], c2['lon']]],
+            radius=C_R), distance, 2)
+
+
+@pytest.mark.parametrize('track', range(len(TRACKS)))
+def test_velocities_and_energy_match_the_scalar_formulas(track):
+    latitudes, longitudes, elevations = TRACKS[track]
+    distances = baseline_distances(latitudes, longitudes)
+    elevation_changes = np.diff(elevations)
+
+    velocities = geometry.velocities(distances)
+    assert np.array_equal(velocities, np.array([distance * 3600 for distance in distances]))
+    expected = baseline_energy_increases(velocities, elevation_changes)
+    increases = geometry.energy_increases(velocities, elevation_changes)
+    # a difference of squares is as accurate as the squares, not as its result
+    scale = np.maximum((3600 * velocities[1:])**2, (3600 * velocities[:-1])**2) + np.abs(
+        FPS_TO_MPH**2 * G_FPS * elevation_changes[1:])
+    assert np.all(np.abs(increases - expected) <= np.spacing(scale))
+
+    float32 = geometry.energy_increases(velocities.astype(np.float32), elevation_changes)
+    assert float32.dtype == np.float32
+    # the velocities and their squares are rounded to float32
+    assert np.all(np.abs(float32 - expected) <= 3e-7 * 2 * scale)
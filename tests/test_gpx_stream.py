@@ -0,0 +1,57 @@
+import random
+from xml.dom import minidom
+
+import pytest
+
+import gpx_stream
+
+
+def write_gpx(path, points=300, seed=0):
+    r = random.Random(seed)
+    lat, lon = 51.5, -0.12
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">\n',
+             ' <!-- not a point: <trkpt lat="0" lon="0"> -->\n',
+             ' <trk>\n  <name>Ride &amp; run</name>\n  <trkseg>\n']
+    for i in range(points):
+        lat += (r.random() - 0.5) * 0.001
+        lon += (r.random() - 0.5) * 0.001
+        time = '2020-01-01T00:%02d:%02dZ' % (i // 60 % 60, i % 60)
+        if i % 7 == 3:
+            lines.append('   <trkpt lat="%.7f" lon=\'%.7f\'/>\n' % (lat, lon))
+        else:
+            lines.append('   <trkpt lat="%.7f" lon="%.7f">\n    <ele>%.1f</ele>\n'
+                         '    <time>%s</time>\n   </trkpt>\n' % (lat, lon, 10 + i % 13, time))
+    lines.append('  </trkseg>\n </trk>\n</gpx>\n')
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+
+
+def censor_mask(longitudes, latitudes):
+    # about every other point, so censored and uncensored points meet all over the file
+    return (latitudes * 1e4).astype(int) % 2 == 0
+
+
+@pytest.mark.parametrize('drop_points', [False, True])
+def test_censor_gpx_does_not_depend_on_block_size(tmp_path, monkeypatch, drop_points):
+    source = str(tmp_path / 'track.gpx')
+    write_gpx(source)
+    with open(source, 'rb') as f:
+        size = len(f.read())
+
+    outputs = set()
+    for block_size in [1, 2, 7, 13, 64, 251, 1000, 4096, size]:
+        monkeypatch.setattr(gpx_stream, 'READ_BLOCK_SIZE', block_size)
+        target = str(tmp_path / ('censored_%d.gpx' % block_size))
+        censored = gpx_stream.censor_gpx(source, target, censor_mask, '[CENSORED]',
+                                         drop_points=drop_points,
+                                         removed_children=['ele', 'time'],
+                                         censored_attributes=['lat', 'lon'])
+        with open(target, 'rb') as f:
+            outputs.add((censored, f.read()))
+
+    assert len(outputs) == 1
+    censored, output = outputs.pop()
+    assert 0 < censored < 300
+    points = minidom.parseString(output).getElementsByTagName('trkpt')
+    assert len(points) == (300 - censored if drop_points else 300)
@@ -0,0 +1,191 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+import import_and_process_garmin_fit as import_fit
+
+
+@pytest.fixture
+def placed(monkeypatch):
+    # the methods tried for each file, in order; reflink works for the names in reflinkable
+    calls = []
+    reflinkable = set()
+    original_copyfile = shutil.copyfile
+
+    def reflink(source, target):
+        calls.append(('reflink', os.path.basename(source)))
+        if os.path.basename(source) not in reflinkable:
+            raise OSError('not supported')
+        original_copyfile(source, target)
+
+    def copyfile(source, target):
+        calls.append(('copy', os.path.basename(source)))
+        return original_copyfile(source, target)
+
+    def link(source, target):
+        raise AssertionError('imported files are not hard-linked')
+
+    monkeypatch.setattr(import_fit, 'reflink', reflink)
+    monkeypatch.setattr(import_fit.shutil, 'copyfile', copyfile)
+    monkeypatch.setattr(import_fit.os, 'link', link)
+    return calls, reflinkable
+
+
+def write(path, data):
+    with open(str(path), 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    source_dir = tmp_path / 'source'
+    target_dir = tmp_path / 'target'
+    source_dir.mkdir()
+    target_dir.mkdir()
+    return source_dir, target_dir
+
+
+def import_names(source_dir, target_dir):
+    names = []
+    stats = import_fit.import_files(str(source_dir), str(target_dir), names.append)
+    return names, stats
+
+
+def test_files_are_deduplicated_by_content(dirs, placed, capsys):
+    source_dir, target_dir = dirs
+    ride, run, swim = os.urandom(600000), os.urandom(400000), os.urandom(300000)
+    write(source_dir / 'A.FIT', ride)
+    write(source_dir / 'B.FIT', ride)
+    write(source_dir / 'C.FIT', run)
+    # already in the target under another name, without a manifest entry
+    write(target_dir / 'swim.fit', swim)
+    write(source_dir / 'D.FIT', swim)
+
+    names, stats = import_names(source_dir, target_dir)
+    assert names == ['A.fit', 'C.fit']
+    assert sorted(os.listdir(str(target_dir))) == ['A.fit', 'C.fit', 'manifest.sqlite', 'swim.fit']
+    assert stats['imported'] == (2, 1000000)
+    assert stats['duplicate'] == (2, 900000)
+    out = capsys.readouterr().out
+    assert '%s is already imported as A.fit' % (source_dir / 'B.FIT') in out
+    assert '%s is already imported as swim.fit' % (source_dir / 'D.FIT') in out
+
+    # nothing new the second time, and the duplicates are not reported again
+    names, stats = import_names(source_dir, target_dir)
+    assert names == []
+    assert stats['imported'] == (0, 0)
+    assert stats['duplicate'] == (4, 1900000)
+    assert 'already imported' not in capsys.readouterr().out
+
+    # a source that changed replaces its copy
+    write(source_dir / 'C.FIT', run[::-1])
+    names, stats = import_names(source_dir, target_dir)
+    assert names == ['C.fit']
+    with open(str(target_dir / 'C.fit'), 'rb') as f:
+        assert f.read() == run[::-1]
+
+
+def test_files_are_reflinked_then_copied(dirs, placed):
+    source_dir, target_dir = dirs
+    calls, reflinkable = placed
+    for name in ['A.FIT', 'B.FIT', 'C.FIT']:
+        write(source_dir / name, os.urandom(1000))
+    reflinkable.add('B.FIT')
+
+    names, stats = import_names(source_dir, target_dir)
+    assert calls == [('reflink', 'A.FIT'), ('copy', 'A.FIT'), ('reflink', 'B.FIT'),
+                     ('reflink', 'C.FIT'), ('copy', 'C.FIT')]
+    assert stats['reflink'] == (1, 1000)
+    assert stats['copy'] == (2, 2000)
+    for name in names:
+        with open(str(source_dir / name.replace('.fit', '.FIT')), 'rb') as f:
+            with open(str(target_dir / name), 'rb') as g:
+                assert f.read() == g.read()
+    assert not [name for name in os.listdir(str(target_dir)) if name.endswith('.tmp')]
+
+
+def test_a_failed_copy_is_raised(dirs, placed, monkeypatch):
+    source_dir, target_dir = dirs
+    write(source_dir / 'A.FIT', os.urandom(1000))
+
+    def copyfile(source, target):
+        raise OSError('no space left')
+
+    monkeypatch.setattr(import_fit.shutil, 'copyfile', copyfile)
+    with pytest.raises(OSError, match='no space left'):
+        import_names(source_dir, target_dir)
+    assert not (target_dir / 'A.fit').exists()
+
+
+def test_summary_counts_the_bytes_not_copied(dirs, placed, capsys):
+    source_dir, target_dir = dirs
+    calls, reflinkable = placed
+    write(source_dir / 'A.FIT', os.urandom(1500000))
+    write(source_dir / 'B.FIT', os.urandom(700000))
+    write(source_dir / 'C.FIT', os.urandom(250000))
+    shutil.copyfile(str(source_dir / 'A.FIT'), str(source_dir / 'D.FIT'))
+    reflinkable.add('B.FIT')
+
+    names, stats = import_names(source_dir, target_dir)
+    capsys.readouterr()
+    import_fit.print_import_summary(stats)
+    # D.FIT is a duplicate of A.FIT, and B.FIT is reflinked
+    assert capsys.readouterr().out == (
+        'imported 3 files (2 copied, 1 reflinked), skipped 1 already imported; '
+        '2.2 MB not copied\n')
+
+
+def import_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'fit-import']
+
+
+def test_closing_iter_imported_stops_the_import(dirs, placed):
+    source_dir, target_dir = dirs
+    for i in range(20):
+        write(source_dir / ('%02d.FIT' % i), os.urandom(1000))
+    write(source_dir / 'notes.txt', b'not a FIT file')
+
+    fit_files = import_fit.iter_imported(str(source_dir), str(target_dir), queue_size=1)
+    assert next(fit_files) == '00.fit'
+    # closed on another thread, so that an import that does not stop fails the test rather
+    # than hanging it
+    closing = threading.Thread(target=fit_files.close, daemon=True)
+    closing.start()
+    closing.join(10)
+    assert not closing.is_alive()
+    assert not import_threads()
+    # the file being imported when it was closed, and at most the one waiting in the queue
+    imported = [name for name in os.listdir(str(target_dir)) if name.endswith('.fit')]
+    assert 2 <= len(imported) <= 3
+
+    # the rest is imported once the files are all taken, and only FIT files come out: the
+    # newly imported ones, then those that were there already
+    fit_files = list(import_fit.iter_imported(str(source_dir), str(target_dir), queue_size=1))
+    assert fit_files == ['%02d.fit' % i for i in range(len(imported), 20)] + sorted(imported)
+    assert (target_dir / 'notes.txt').exists()
+    assert not import_threads()
+
+
+def test_import_errors_are_raised_by_iter_imported(dirs, placed, monkeypatch):
+    source_dir, target_dir = dirs
+    for i in range(5):
+        write(source_dir / ('%02d.FIT' % i), os.urandom(1000))
+    place_file = import_fit.place_file
+
+    def failing_place_file(source, target):
+        if source.endswith('02.FIT'):
+            raise OSError('device removed')
+        return place_file(source, target)
+
+    monkeypatch.setattr(import_fit, 'place_file', failing_place_file)
+    fit_files = import_fit.iter_imported(str(source_dir), str(target_dir), queue_size=1)
+    taken = []
+    with pytest.raises(OSError, match='device removed'):
+        for name in fit_files:
+            taken.append(name)
+            # the main thread is the one that raises
+            assert threading.current_thread() is threading.main_thread()
+    assert taken == ['00.fit', '01.fit']
+    assert not import_threads()
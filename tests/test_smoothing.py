@@ -0,0 +1,81 @@
+import argparse
+
+import numpy as np
+import pytest
+
+import smoothing
+
+
+def direct_smooth(positions, values, bandwidth):
+    """
+    (kernel-weighted means, sums of the kernel weights) at every sample, summed sample
+    by sample
+    """
+    radius = int(np.ceil(smoothing.GAP_SIGMAS * bandwidth))
+    smoothed = np.full(len(positions), np.nan)
+    weight_sums = np.zeros(len(positions))
+    valid = np.isfinite(values)
+    index = np.rint(positions - positions[0]).astype(np.int64)
+    for i in range(len(positions)):
+        offsets = index - index[i]
+        near = valid & (np.abs(offsets) <= radius)
+        weights = np.exp(-0.5 * (offsets[near] / bandwidth)**2)
+        weight_sums[i] = weights.sum()
+        if weight_sums[i] > 0:
+            smoothed[i] = np.sum(weights * values[near]) / weight_sums[i]
+    return smoothed, weight_sums
+
+
+def random_series(seed, n_points):
+    r = np.random.RandomState(seed)
+    # mostly 1 s apart, with repeated times, short gaps and a pause
+    steps = r.choice([0, 1, 1, 1, 1, 2, 5], size=n_points - 1).astype(np.float64)
+    steps[n_points // 2] = 600.
+    seconds = np.concatenate([[0.], np.cumsum(steps)])
+    positions, _ = smoothing.track_positions(seconds, smoothing.GAP_SECONDS,
+                                             smoothing.GAP_SIGMAS * 30.)
+    speeds = 10 + 3 * np.sin(seconds / 50.) + r.normal(0, 1, n_points)
+    elevations = 100 + np.cumsum(r.normal(0, 0.5, n_points))
+    speeds[r.rand(n_points) < 0.05] = np.nan
+    return positions, speeds, elevations
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_gaussian_smooth_matches_direct_convolution(seed):
+    bandwidths = [0.5, 2., 5., 30.]
+    positions, speeds, elevations = random_series(seed, 1500)
+    smoothed = smoothing.gaussian_smooth(positions, [speeds, elevations], bandwidths)
+    assert smoothed.shape == (2, len(bandwidths), len(positions))
+    for series, values in enumerate([speeds, elevations]):
+        scale = np.nanmax(np.abs(values))
+        for i, bandwidth in enumerate(bandwidths):
+            expected, weight_sums = direct_smooth(positions, values, bandwidth)
+            assert np.array_equal(np.isnan(smoothed[series, i]), np.isnan(expected))
+            reached = np.isfinite(expected)
+            # the transforms round to about 1e-15 of the values; where the kernel only reaches
+            # samples in its tails, the mean divides that by a small sum of weights
+            tolerance = 1e-14 * scale / np.minimum(weight_sums[reached], 1.)
+            assert np.all(np.abs(smoothed[series, i][reached] - expected[reached]) <= tolerance)
+    # a single series comes back without the series axis
+    np.testing.assert_array_equal(smoothing.gaussian_smooth(positions, elevations, bandwidths),
+                                  smoothed[1])
+
+
+@pytest.mark.parametrize('bandwidths', [[-2.], [0.], [5., 0.], [float('nan')], [float('inf')]])
+def test_bandwidths_must_be_positive(bandwidths):
+    positions, speeds, elevations = random_series(0, 100)
+    with pytest.raises(ValueError, match='positive number of seconds'):
+        smoothing.gaussian_smooth(positions, elevations, bandwidths)
+    times = np.datetime_as_string(np.datetime64('2020-01-01T00:00:00')
+                                  + np.arange(2) * np.timedelta64(1, 's')) + 'Z'
+    with pytest.raises(ValueError, match='positive number of seconds'):
+        smoothing.smoothed_features(times, np.ones(1), np.ones(2), bandwidths)
+
+
+def test_bandwidth_arguments_must_be_positive():
+    import process_all
+
+    assert process_all.smoothing_bandwidth('2.5') == 2.5
+    for text in ['-2', '0', 'nan', 'inf', 'ten']:
+        with pytest.raises(argparse.ArgumentTypeError, match='positive number of seconds'):
+            process_all.smoothing_bandwidth(text)
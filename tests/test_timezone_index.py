@@ -0,0 +1,201 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+import timezone_index
+from timezone_index import TimezoneCache
+
+
+@pytest.fixture(scope='module')
+def tz_polygons():
+    """
+    the polygons shipped with tzwhere, as (zone names, shapely polygons, an STRtree of them)
+    """
+    tzwhere = pytest.importorskip('tzwhere.tzwhere')
+    shapely = pytest.importorskip('shapely')
+    from shapely.geometry import Polygon
+
+    names = []
+    polygons = []
+    for tzname, (exterior, holes) in tzwhere.feature_collection_polygons(
+            tzwhere.read_tzworld(tzwhere.tzwhere.DEFAULT_POLYGONS)):
+        names.append(tzname)
+        polygons.append(Polygon(exterior, holes))
+    return names, polygons, shapely.STRtree(polygons)
+
+
+@pytest.fixture(scope='module')
+def index(tz_polygons, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tz') / 'tz_index.bin')
+    timezone_index.build_timezone_index(path)
+    return timezone_index.TimezoneIndex(path)
+
+
+def polygon_zones(tz_polygons, latitude, longitude):
+    # every zone whose polygon holds the point; tz_world has a few overlapping polygons
+    from shapely.geometry import Point
+
+    names, polygons, tree = tz_polygons
+    return set(names[i] for i in tree.query(Point(longitude, latitude), predicate='intersects'))
+
+
+def points_near_borders(tz_polygons, n_points, seed):
+    """
+    points within about 1 km of a random polygon vertex, so on either side of a border
+    """
+    names, polygons, tree = tz_polygons
+    r = random.Random(seed)
+    points = []
+    while len(points) < n_points:
+        coordinates = np.asarray(r.choice(polygons).exterior.coords)
+        longitude, latitude = coordinates[r.randrange(len(coordinates))]
+        points.append((latitude + r.uniform(-0.01, 0.01), longitude + r.uniform(-0.01, 0.01)))
+    return points
+
+
+def random_points(n_points, seed):
+    r = random.Random(seed)
+    return [(r.uniform(-90, 90), r.uniform(-180, 180)) for _ in range(n_points)]
+
+
+# (latitude, longitude, zone), a few of them either side of a border
+KNOWN_ZONES = [
+    (40.7128, -74.0060, 'America/New_York'),
+    (51.5074, -0.1278, 'Europe/London'),
+    (-33.8688, 151.2093, 'Australia/Sydney'),
+    (35.6762, 139.6503, 'Asia/Tokyo'),
+    (0., -30., None),
+    # El Paso and across the Rio Grande
+    (31.7619, -106.4850, 'America/Denver'),
+    (31.6900, -106.4200, 'America/Ojinaga'),
+    # Detroit and Windsor, across the Detroit river
+    (42.3314, -83.0458, 'America/Detroit'),
+    (42.3149, -83.0364, 'America/Toronto'),
+    # St. Peter's square and Rome
+    (41.9022, 12.4568, 'Europe/Vatican'),
+    (41.9028, 12.4964, 'Europe/Rome'),
+]
+
+
+def test_index_matches_the_polygons(index, tz_polygons):
+    for latitude, longitude in random_points(3000, 0) + points_near_borders(tz_polygons, 3000, 0):
+        zones = polygon_zones(tz_polygons, latitude, longitude)
+        tzname = index.tzNameAt(latitude, longitude)
+        if zones:
+            assert tzname in zones, (latitude, longitude)
+        else:
+            assert tzname is None, (latitude, longitude)
+
+
+def test_index_resolves_cells_away_from_borders(index, tz_polygons):
+    # cells no polygon edge touches are answered without a polygon test
+    assert (index.cell_zone != timezone_index.MIXED).mean() > 0.5
+    r = random.Random(1)
+    resolved = np.flatnonzero(index.cell_zone != timezone_index.MIXED)
+    for cell in r.sample(resolved.tolist(), 500):
+        row, col = divmod(cell, index.n_cols)
+        latitude = -90. + (row + r.random()) * index.grid_degrees
+        longitude = -180. + (col + r.random()) * index.grid_degrees
+        zones = polygon_zones(tz_polygons, latitude, longitude)
+        assert index.tzNameAt(latitude, longitude) == (zones.pop() if zones else None)
+
+
+@pytest.mark.parametrize('latitude,longitude,zone', KNOWN_ZONES)
+def test_cache_knows_these_zones(index, latitude, longitude, zone):
+    cache = TimezoneCache(None, index)
+    assert cache.tzNameAt(latitude, longitude) == zone
+    # and again, from the cache
+    assert cache.tzNameAt(latitude, longitude) == zone
+
+
+def test_cache_answers_like_the_index_near_borders(index, tz_polygons):
+    points = points_near_borders(tz_polygons, 2000, 1)
+    cache = TimezoneCache(None, index)
+    expected = [index.tzNameAt(latitude, longitude) for latitude, longitude in points]
+    for _ in range(2):
+        assert [cache.tzNameAt(latitude, longitude) for latitude, longitude in points] == expected
+    assert cache.hits > 0
+
+
+def test_box_zone_is_only_uniform_inside_one_zone(index, tz_polygons):
+    r = random.Random(2)
+    results = []
+    for latitude, longitude in points_near_borders(tz_polygons, 1000, 2) + random_points(200, 2):
+        size = r.choice([0.001, 0.01, 0.1])
+        lat0, lon0 = latitude - size / 2, longitude - size / 2
+        uniform, zone = index.box_zone(lat0, lon0, lat0 + size, lon0 + size)
+        results.append(uniform)
+        if uniform:
+            # the corners, the middle and some points in between are all in that zone
+            for u, v in [(0, 0), (0, 1), (1, 0), (1, 1), (0.5, 0.5)] + [
+                    (r.random(), r.random()) for _ in range(20)]:
+                assert index.tzNameAt(lat0 + u * size, lon0 + v * size) == zone
+    # both answers come up, or the test shows nothing
+    assert 0 < sum(results) < len(results)
+
+
+class FakeIndex(object):
+    # every cell is uniform; counts the lookups that reach it
+    def __init__(self):
+        self.box_zones = 0
+
+    def box_zone(self, lat0, lon0, lat1, lon1):
+        self.box_zones += 1
+        return True, 'Zone/%d' % int(round(lon0 * 100))
+
+    def tzNameAt(self, latitude, longitude):
+        raise AssertionError('uniform cells are answered by box_zone')
+
+
+def test_cache_is_bounded_least_recently_used_first():
+    index = FakeIndex()
+    cache = TimezoneCache(None, index, cell_degrees=0.01, max_entries=3)
+    for longitude in [0.005, 0.015, 0.025]:
+        cache.tzNameAt(0.005, longitude)
+    # used again, so it is now the most recent
+    assert cache.tzNameAt(0.005, 0.005) == 'Zone/0'
+    cache.tzNameAt(0.005, 0.035)
+    assert list(cache.entries) == [(0, 2), (0, 0), (0, 3)]
+    assert (cache.hits, cache.misses, index.box_zones) == (1, 4, 4)
+    # an evicted cell is looked up again
+    assert cache.tzNameAt(0.005, 0.015) == 'Zone/1'
+    assert index.box_zones == 5
+    assert len(cache.entries) == 3
+
+
+def test_merging_its_own_changes_leaves_nothing_to_pass_on():
+    # when converting in a single process, the cache merges what it popped itself
+    cache = TimezoneCache(None, FakeIndex())
+    for longitude in [0.005, 0.015, 0.005]:
+        cache.tzNameAt(0.005, longitude)
+    changes = cache.pop_changes()
+    assert [key for key, tzname in changes[0]] == [(0, 0), (0, 1), (0, 0)]
+    assert changes[1:] == (1, 2)
+    cache.merge(changes)
+    assert list(cache.entries) == [(0, 1), (0, 0)]
+
+    # the next file: only its own lookups are passed on, and the counts add up
+    cache.tzNameAt(0.005, 0.015)
+    changes = cache.pop_changes()
+    assert changes[0] == [((0, 1), 'Zone/1')]
+    cache.merge(changes)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_merged_worker_changes_are_saved(tmp_path):
+    path = str(tmp_path / timezone_index.CACHE_FILENAME)
+    worker = TimezoneCache(path, FakeIndex())
+    worker.tzNameAt(0.005, 0.005)
+    worker.tzNameAt(0.005, 0.015)
+    cache = TimezoneCache(path, FakeIndex())
+    cache.merge(worker.pop_changes())
+    assert (cache.hits, cache.misses) == (0, 2)
+    cache.save()
+    with open(path) as f:
+        assert json.load(f)['entries'] == [[0, 0, 'Zone/0'], [0, 1, 'Zone/1']]
+    assert list(TimezoneCache(path, FakeIndex()).entries.items()) == [
+        ((0, 0), 'Zone/0'), ((0, 1), 'Zone/1')]
+    # a cache of other cells starts over
+    assert not TimezoneCache(path, FakeIndex(), cell_degrees=0.1).entries
@@ -0,0 +1,139 @@
+import csv
+import datetime
+import io
+import random
+
+import numpy as np
+import pytest
+import pytz
+
+from track_columns import UTC, ColumnTable
+
+FIELDS = ['timestamp', 'position_lat', 'position_long', 'distance', 'heart_rate', 'event',
+          'start_time', 'timestamp_utc', 'timezone']
+
+ZONES = ['UTC', 'America/New_York', 'Australia/Sydney', 'Asia/Kolkata', 'Pacific/Chatham',
+         'America/St_Johns', 'Europe/Dublin', 'Etc/GMT+5']
+
+TEXT = ['', 'manual', 'a,b', 'say "hi"', 'two\nlines', 'carriage\rreturn', ' spaced ',
+        'caf\xe9', '"', ',']
+
+
+def random_value(r, start):
+    kind = r.randrange(9)
+    if kind == 0:
+        return None
+    elif kind == 1:
+        return r.choice([0, 1, -7, 255, 2 ** 53, 2 ** 53 + 1, -2 ** 60, r.randrange(-10 ** 6, 10 ** 6)])
+    elif kind == 2:
+        return r.choice([0.1 + 0.2, -0.0, 1e-7, 1e16, 1e22, 5e-324, 1.5, float('nan'),
+                         float('inf'), -float('inf'), 40.70999996736646, r.uniform(-180, 180)])
+    elif kind == 3:
+        return r.choice(TEXT)
+    elif kind == 4:
+        return r.choice([(1, 2), ('a', None), True, False])
+    elif kind == 5:
+        return random_datetime(r, start)
+    return r.uniform(-1e4, 1e4)
+
+
+def random_datetime(r, start):
+    value = start + datetime.timedelta(seconds=r.randrange(5 * 365 * 86400))
+    if r.random() < 0.2:
+        value = value.replace(microsecond=r.randrange(1, 10 ** 6))
+    return value
+
+
+def random_rows(seed, n_rows):
+    r = random.Random(seed)
+    start = datetime.datetime(2017, 1, 1)
+    rows = []
+    for _ in range(n_rows):
+        row = {}
+        if r.random() < 0.9:
+            row['timestamp'] = random_datetime(r, start)
+        for name in FIELDS[1:-2]:
+            if r.random() < 0.8:
+                row[name] = random_value(r, start)
+        rows.append(row)
+    return rows
+
+
+def csv_writer_output(rows, fields, local_tz=None, tz_name=None, round_floats=None):
+    """
+    what the converter wrote before rows were kept by column: every row localized with
+    pytz, then str() of each cell through csv.writer
+    """
+    f = io.StringIO()
+    writer = csv.writer(f)
+    for row in rows:
+        row = dict(row)
+        if local_tz is not None and 'timestamp' in row:
+            row['timestamp_utc'] = row['timestamp']
+            row['timestamp'] = UTC.localize(row['timestamp']).astimezone(local_tz)
+            row['timezone'] = tz_name
+        if round_floats is not None:
+            row = dict((name, round_floats(value) if type(value) is float else value)
+                       for name, value in row.items())
+        writer.writerow([str(row.get(name, '')) for name in fields])
+    return f.getvalue()
+
+
+def streamed_output(rows, fields, chunk_rows, local_tz=None, tz_name=None, compact_numeric=False):
+    # as convert_fit_to_csv.write_table writes a table chunk after chunk
+    f = io.StringIO()
+    table = ColumnTable(fields)
+    for start in range(0, len(rows), chunk_rows):
+        for row in rows[start:start + chunk_rows]:
+            table.append(row)
+        if local_tz is not None:
+            table.localize(local_tz, tz_name)
+        table.write_csv(f, compact_numeric=compact_numeric)
+        table.clear()
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 1000])
+def test_streamed_csv_matches_csv_writer(chunk_rows):
+    rows = random_rows(chunk_rows, 1000)
+    fields = FIELDS[:-2]
+    assert streamed_output(rows, fields, chunk_rows) == csv_writer_output(rows, fields)
+
+
+@pytest.mark.parametrize('zone', ZONES)
+def test_localized_csv_matches_pytz(zone):
+    local_tz = pytz.timezone(zone)
+    r = random.Random(zone)
+    rows = random_rows(zone, 2000)
+    for row in rows[:100]:
+        # across the transitions of a year, to the second
+        if 'timestamp' in row:
+            row['timestamp'] = datetime.datetime(2019, 1, 1) + datetime.timedelta(
+                seconds=r.randrange(365 * 86400))
+    # either side of a switch to and from daylight saving time, where there is one
+    for transition in getattr(local_tz, '_utc_transition_times', [])[100:110]:
+        for seconds in [-1, 0, 1]:
+            rows.append({'timestamp': transition + datetime.timedelta(seconds=seconds)})
+            rows.append({'timestamp': transition + datetime.timedelta(seconds=seconds,
+                                                                      microseconds=500)})
+    expected = csv_writer_output(rows, FIELDS, local_tz, zone)
+    for chunk_rows in [1, 64, len(rows)]:
+        assert streamed_output(rows, FIELDS, chunk_rows, local_tz, zone) == expected
+
+
+def test_microsecond_timestamps_are_localized():
+    local_tz = pytz.timezone('America/New_York')
+    rows = [{'timestamp': datetime.datetime(2019, 6, 2, 12, 0, 0, 250000)},
+            {'timestamp': datetime.datetime(2019, 6, 2, 12, 0, 1)}]
+    assert streamed_output(rows, FIELDS, 2, local_tz, 'America/New_York').splitlines() == [
+        '2019-06-02 08:00:00.250000-04:00,,,,,,,2019-06-02 12:00:00.250000,America/New_York',
+        '2019-06-02 08:00:01-04:00,,,,,,,2019-06-02 12:00:01,America/New_York',
+    ]
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 1000])
+def test_compact_numeric_csv_only_rounds_floats(chunk_rows):
+    rows = random_rows(chunk_rows, 1000)
+    fields = FIELDS[:-2]
+    expected = csv_writer_output(rows, fields, round_floats=lambda value: float(np.round(value, 6)) + 0.)
+    assert streamed_output(rows, fields, chunk_rows, compact_numeric=True) == expected
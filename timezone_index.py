@@ -0,0 +1,428 @@
+"""
+compact, memory-mapped replacement for tzwhere.tzwhere()
+
+the tzwhere polygons are converted once into a flat binary file (INDEX_PATH):
+a regular lat/lon grid that lists candidate polygons per cell, plus the polygon
+rings themselves as one float64 vertex array. Grid cells that no polygon edge
+touches are resolved at build time, so most lookups never look at a polygon.
+
+the file is opened with mmap, so it costs almost nothing to load, only the pages
+that are actually read become resident, and worker processes share them
+"""
+
+import json
+import math
+import mmap
+import os
+import struct
+from collections import deque, OrderedDict
+
+import numpy as np
+
+INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'fit_processing', 'tz_index.bin')
+
+GRID_DEGREES = 0.25
+
+_MAGIC = b'TZIX'
+_VERSION = 1
+# magic, version, grid degrees, n_names, n_polys, n_rings, n_vertices, n_cell_entries, names bytes
+_HEADER = struct.Struct('<4sIdIIIIII')
+
+# cell_zone values: MIXED means "test the candidate polygons", 0 means no timezone,
+# anything else is 1 + the index of the zone name
+MIXED = -1
+
+
+def _grid_shape(grid_degrees):
+    return int(round(180 / grid_degrees)), int(round(360 / grid_degrees))
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _layout(header_values):
+    """
+    byte offsets of each array in the file, in the order they are written
+    """
+    _, _, grid_degrees, n_names, n_polys, n_rings, n_vertices, n_cell_entries, names_size = header_values
+    n_rows, n_cols = _grid_shape(grid_degrees)
+    n_cells = n_rows * n_cols
+    sections = [
+        ('names', np.uint8, (names_size,)),
+        ('poly_zone', np.uint16, (n_polys,)),
+        ('poly_bbox', np.float64, (n_polys, 4)),
+        ('poly_rings', np.uint32, (n_polys + 1,)),
+        ('ring_vertices', np.uint32, (n_rings + 1,)),
+        ('vertices', np.float64, (n_vertices, 2)),
+        ('cell_offsets', np.uint32, (n_cells + 1,)),
+        ('cell_polys', np.uint32, (n_cell_entries,)),
+        ('cell_zone', np.int16, (n_cells,)),
+    ]
+    layout = []
+    offset = _align(_HEADER.size)
+    for name, dtype, shape in sections:
+        layout.append((name, dtype, shape, offset))
+        offset = _align(offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return layout, offset
+
+
+class TimezoneIndex(object):
+    """
+    read-only view of an index file; answers the same queries as tzwhere.tzNameAt
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_values = _HEADER.unpack_from(self._mmap, 0)
+        if header_values[0] != _MAGIC or header_values[1] != _VERSION:
+            raise ValueError('%s is not a version %d timezone index' % (path, _VERSION))
+        self.grid_degrees = header_values[2]
+        self.n_rows, self.n_cols = _grid_shape(self.grid_degrees)
+        layout, _ = _layout(header_values)
+        for name, dtype, shape, offset in layout:
+            count = int(np.prod(shape))
+            array = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+            setattr(self, name, array.reshape(shape))
+        self.zone_names = bytes(self.names).decode('utf8').split('\n')
+
+    def cell_of(self, latitude, longitude):
+        """
+        grid cell containing a point, or None if it is off the map
+        """
+        row = int(math.floor((latitude + 90.) / self.grid_degrees))
+        col = int(math.floor((longitude + 180.) / self.grid_degrees))
+        # points on the north pole/antimeridian belong to the last row/column
+        if row == self.n_rows and latitude == 90.:
+            row -= 1
+        if col == self.n_cols and longitude == 180.:
+            col -= 1
+        if not (0 <= row < self.n_rows and 0 <= col < self.n_cols):
+            return None
+        return row * self.n_cols + col
+
+    def tzNameAt(self, latitude, longitude):
+        cell = self.cell_of(latitude, longitude)
+        if cell is None:
+            return None
+        zone = int(self.cell_zone[cell])
+        if zone != MIXED:
+            return self.zone_names[zone - 1] if zone else None
+        for poly in self.cell_polys[self.cell_offsets[cell]:self.cell_offsets[cell + 1]]:
+            if self.polygon_contains(poly, latitude, longitude):
+                return self.zone_names[self.poly_zone[poly]]
+        return None
+
+    def box_zone(self, lat0, lon0, lat1, lon1):
+        """
+        (True, tzname) if the whole box is inside one zone (tzname None for no zone),
+        otherwise (False, None); conservative, so a box near a border may be reported
+        as mixed even if it is not
+        """
+        cell = self.cell_of((lat0 + lat1) / 2., (lon0 + lon1) / 2.)
+        if cell is None:
+            return False, None
+        row, col = divmod(cell, self.n_cols)
+        eps = 1e-9
+        if (lat0 < -90. + row * self.grid_degrees - eps or
+                lat1 > -90. + (row + 1) * self.grid_degrees + eps or
+                lon0 < -180. + col * self.grid_degrees - eps or
+                lon1 > -180. + (col + 1) * self.grid_degrees + eps):
+            # spans several grid cells
+            return False, None
+        zone = int(self.cell_zone[cell])
+        if zone != MIXED:
+            return True, self.zone_names[zone - 1] if zone else None
+        # a box inside a mixed cell is uniform if no edge of a candidate polygon reaches it
+        # (all rings of a polygon are scanned as one run of vertices, which only adds edges)
+        for poly in self.cell_polys[self.cell_offsets[cell]:self.cell_offsets[cell + 1]]:
+            min_lon, min_lat, max_lon, max_lat = self.poly_bbox[poly]
+            if max_lon < lon0 or min_lon > lon1 or max_lat < lat0 or min_lat > lat1:
+                continue
+            polygon_vertices = self.vertices[
+                self.ring_vertices[self.poly_rings[poly]]:self.ring_vertices[self.poly_rings[poly + 1]]
+            ]
+            x0, y0 = polygon_vertices[:-1, 0], polygon_vertices[:-1, 1]
+            x1, y1 = polygon_vertices[1:, 0], polygon_vertices[1:, 1]
+            if np.any(
+                    (np.minimum(x0, x1) <= lon1) & (np.maximum(x0, x1) >= lon0) &
+                    (np.minimum(y0, y1) <= lat1) & (np.maximum(y0, y1) >= lat0)
+            ):
+                return False, None
+        return True, self.tzNameAt((lat0 + lat1) / 2., (lon0 + lon1) / 2.)
+
+    def polygon_contains(self, poly, latitude, longitude):
+        min_lon, min_lat, max_lon, max_lat = self.poly_bbox[poly]
+        if not (min_lon <= longitude <= max_lon and min_lat <= latitude <= max_lat):
+            return False
+        first_ring, end_ring = self.poly_rings[poly], self.poly_rings[poly + 1]
+        # first ring is the exterior, the rest are holes
+        if not self._ring_contains(first_ring, latitude, longitude):
+            return False
+        for ring in range(first_ring + 1, end_ring):
+            if self._ring_contains(ring, latitude, longitude):
+                return False
+        return True
+
+    def _ring_contains(self, ring, latitude, longitude):
+        # even-odd ray casting towards +longitude; rings are closed (first vertex == last)
+        ring_vertices = self.vertices[self.ring_vertices[ring]:self.ring_vertices[ring + 1]]
+        x0 = ring_vertices[:-1, 0]
+        y0 = ring_vertices[:-1, 1]
+        x1 = ring_vertices[1:, 0]
+        y1 = ring_vertices[1:, 1]
+        straddles = (y0 > latitude) != (y1 > latitude)
+        if not straddles.any():
+            return False
+        x0, y0, x1, y1 = x0[straddles], y0[straddles], x1[straddles], y1[straddles]
+        crossings = x0 + (latitude - y0) * (x1 - x0) / (y1 - y0)
+        return bool(np.count_nonzero(longitude < crossings) % 2)
+
+
+def build_timezone_index(path=INDEX_PATH, grid_degrees=GRID_DEGREES):
+    """
+    converts the polygons shipped with tzwhere into an index file at path
+    only needs to run once; takes about as long as constructing tzwhere itself
+    """
+    # only needed to build the index
+    from tzwhere.tzwhere import tzwhere, read_tzworld, feature_collection_polygons
+
+    print('building timezone index at %s' % path)
+    zone_ids = {}
+    poly_zone = []
+    poly_rings = [0]
+    ring_vertices = [0]
+    rings = []
+    for tzname, (exterior, holes) in feature_collection_polygons(read_tzworld(tzwhere.DEFAULT_POLYGONS)):
+        poly_zone.append(zone_ids.setdefault(tzname, len(zone_ids)))
+        for ring in [exterior] + list(holes):
+            ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+            if len(ring) and not (ring[0] == ring[-1]).all():
+                ring = np.vstack([ring, ring[:1]])
+            rings.append(ring)
+            ring_vertices.append(ring_vertices[-1] + len(ring))
+        poly_rings.append(len(rings))
+
+    vertices = np.concatenate(rings)
+    poly_zone = np.asarray(poly_zone, dtype=np.uint16)
+    poly_rings = np.asarray(poly_rings, dtype=np.uint32)
+    ring_vertices = np.asarray(ring_vertices, dtype=np.uint32)
+    exteriors = [rings[start] for start in poly_rings[:-1]]
+    poly_bbox = np.asarray(
+        [[r[:, 0].min(), r[:, 1].min(), r[:, 0].max(), r[:, 1].max()] for r in exteriors],
+        dtype=np.float64
+    )
+    n_rows, n_cols = _grid_shape(grid_degrees)
+
+    def rows_of(lat):
+        return np.clip(np.floor((lat + 90.) / grid_degrees), 0, n_rows - 1).astype(np.int64)
+
+    def cols_of(lon):
+        return np.clip(np.floor((lon + 180.) / grid_degrees), 0, n_cols - 1).astype(np.int64)
+
+    # candidate polygons for each cell, from the polygon bounding boxes
+    cell_ids = []
+    cell_poly_ids = []
+    row0, row1 = rows_of(poly_bbox[:, 1]), rows_of(poly_bbox[:, 3])
+    col0, col1 = cols_of(poly_bbox[:, 0]), cols_of(poly_bbox[:, 2])
+    for poly in range(len(poly_zone)):
+        rows, cols = np.meshgrid(np.arange(row0[poly], row1[poly] + 1),
+                                 np.arange(col0[poly], col1[poly] + 1), indexing='ij')
+        cells = (rows * n_cols + cols).ravel()
+        cell_ids.append(cells)
+        cell_poly_ids.append(np.full(len(cells), poly, dtype=np.uint32))
+    cell_ids = np.concatenate(cell_ids)
+    order = np.argsort(cell_ids, kind='stable')
+    cell_polys = np.concatenate(cell_poly_ids)[order]
+    cell_offsets = np.zeros(n_rows * n_cols + 1, dtype=np.uint32)
+    cell_offsets[1:] = np.cumsum(np.bincount(cell_ids, minlength=n_rows * n_cols))
+
+    # cells touched by any polygon edge (widened slightly so edges on a cell border count)
+    touched = np.zeros((n_rows, n_cols), dtype=bool)
+    eps = 1e-9
+    for ring in rings:
+        x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+        er0 = rows_of(np.minimum(y0, y1) - eps)
+        er1 = rows_of(np.maximum(y0, y1) + eps)
+        ec0 = cols_of(np.minimum(x0, x1) - eps)
+        ec1 = cols_of(np.maximum(x0, x1) + eps)
+        short = ((er1 - er0) <= 1) & ((ec1 - ec0) <= 1)
+        for dr in (0, 1):
+            for dc in (0, 1):
+                r = np.minimum(er0[short] + dr, er1[short])
+                c = np.minimum(ec0[short] + dc, ec1[short])
+                touched[r, c] = True
+        for i in np.nonzero(~short)[0]:
+            touched[er0[i]:er1[i] + 1, ec0[i]:ec1[i] + 1] = True
+
+    header_values = (_MAGIC, _VERSION, grid_degrees, len(zone_ids), len(poly_zone),
+                     len(ring_vertices) - 1, len(vertices), len(cell_polys), 0)
+    names = '\n'.join(sorted(zone_ids, key=zone_ids.get)).encode('utf8')
+    header_values = header_values[:-1] + (len(names),)
+    arrays = {
+        'names': np.frombuffer(names, dtype=np.uint8),
+        'poly_zone': poly_zone,
+        'poly_bbox': poly_bbox,
+        'poly_rings': poly_rings,
+        'ring_vertices': ring_vertices,
+        'vertices': vertices,
+        'cell_offsets': cell_offsets,
+        'cell_polys': cell_polys,
+        # resolved below, once the polygon data can be queried
+        'cell_zone': np.full(n_rows * n_cols, MIXED, dtype=np.int16),
+    }
+    layout, size = _layout(header_values)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(*header_values))
+        for name, dtype, shape, offset in layout:
+            f.seek(offset)
+            f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+        f.truncate(size)
+
+    # every 4-connected group of untouched cells lies inside a single zone (or none),
+    # so one polygon test per group resolves all of them
+    index = TimezoneIndex(tmp_path)
+    zone_lookup = {name: i + 1 for i, name in enumerate(index.zone_names)}
+    cell_zone = np.full((n_rows, n_cols), MIXED, dtype=np.int16)
+    seen = touched.copy()
+    for start_row, start_col in zip(*np.nonzero(~touched)):
+        if seen[start_row, start_col]:
+            continue
+        tzname = index.tzNameAt(-90. + (start_row + 0.5) * grid_degrees,
+                                -180. + (start_col + 0.5) * grid_degrees)
+        zone = zone_lookup[tzname] if tzname is not None else 0
+        seen[start_row, start_col] = True
+        queue = deque([(start_row, start_col)])
+        while queue:
+            row, col = queue.popleft()
+            cell_zone[row, col] = zone
+            for r, c in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                if 0 <= r < n_rows and 0 <= c < n_cols and not seen[r, c]:
+                    seen[r, c] = True
+                    queue.append((r, c))
+    del index
+    with open(tmp_path, 'r+b') as f:
+        f.seek(layout[-1][3])
+        f.write(cell_zone.ravel().tobytes())
+    os.replace(tmp_path, path)
+    print('built timezone index (%d zones, %d polygons)' % (len(zone_ids), len(poly_zone)))
+
+
+_INDEX = None
+
+
+def get_timezone_index(path=INDEX_PATH):
+    """
+    the index for this process, building the file first if it does not exist yet
+    """
+    global _INDEX
+    if _INDEX is None or _INDEX.path != path:
+        if not os.path.exists(path):
+            build_timezone_index(path)
+        _INDEX = TimezoneIndex(path)
+    return _INDEX
+
+
+CACHE_FILENAME = 'tz_cache.json'
+CACHE_CELL_DEGREES = 0.01
+CACHE_MAX_ENTRIES = 20000
+
+# cached value for a cell that straddles a border; those points always go to the index
+_MIXED_CELL = '*'
+
+
+class TimezoneCache(object):
+    """
+    persistent LRU cache of timezone lookups keyed by (lat, lon) cells of
+    cell_degrees; only cells that lie entirely inside one zone are answered from
+    the cache, points in border cells are still looked up exactly
+
+    lookups made in worker processes come back through pop_changes()/merge()
+    so that a single process saves the file
+    """
+
+    def __init__(self, path, index=None, cell_degrees=CACHE_CELL_DEGREES, max_entries=CACHE_MAX_ENTRIES):
+        self.path = path
+        self.index = index
+        self.cell_degrees = cell_degrees
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._changes = []
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('cell_degrees') == cell_degrees:
+                for lat_cell, lon_cell, tzname in data['entries']:
+                    self.entries[(lat_cell, lon_cell)] = tzname
+
+    def _get_index(self):
+        if self.index is None:
+            self.index = get_timezone_index()
+        return self.index
+
+    def tzNameAt(self, latitude, longitude):
+        key = (int(math.floor(latitude / self.cell_degrees)),
+               int(math.floor(longitude / self.cell_degrees)))
+        tzname = self.entries.get(key, _MIXED_CELL)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self._changes.append((key, tzname))
+            if tzname != _MIXED_CELL:
+                self.hits += 1
+                return tzname
+        else:
+            uniform, zone = self._get_index().box_zone(
+                key[0] * self.cell_degrees, key[1] * self.cell_degrees,
+                (key[0] + 1) * self.cell_degrees, (key[1] + 1) * self.cell_degrees,
+            )
+            self._store(key, zone if uniform else _MIXED_CELL)
+            if uniform:
+                self.misses += 1
+                return zone
+        self.misses += 1
+        return self._get_index().tzNameAt(latitude, longitude)
+
+    def _store(self, key, tzname, changed=True):
+        self.entries[key] = tzname
+        self.entries.move_to_end(key)
+        if changed:
+            self._changes.append((key, tzname))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop_changes(self):
+        """
+        entries used since the last call (in use order) and the hit/miss counts
+        """
+        changes = (self._changes, self.hits, self.misses)
+        self._changes = []
+        self.hits = 0
+        self.misses = 0
+        return changes
+
+    def merge(self, changes):
+        """
+        applies changes popped from another cache (or this one); they are not changes of
+        this cache to pass on again, since the process that merges is the one that saves
+        """
+        entries, hits, misses = changes
+        for key, tzname in entries:
+            self._store(tuple(key), tzname, changed=False)
+        self.hits += hits
+        self.misses += misses
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'cell_degrees': self.cell_degrees,
+                'entries': [[k[0], k[1], v] for k, v in self.entries.items()],
+            }, f)
+        os.replace(tmp_path, self.path)
+        self._changes = []
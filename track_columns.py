@@ -0,0 +1,478 @@
+"""
+typed column buffers for converted FIT rows
+
+every column keeps its values in a float64 array plus a one-byte code per row that
+says what the cell holds, so a row costs 9 bytes per field instead of a dict entry,
+and the text written for a cell is exactly str() of the value that was appended
+"""
+
+import array
+import datetime
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pytz
+
+# cell codes
+MISSING = 0   # field not in the message; written as ''
+NONE = 1      # field present but invalid; written as 'None'
+INT = 2
+FLOAT = 3
+DATETIME = 4  # naive UTC datetime, stored as POSIX seconds
+OBJECT = 5    # anything else (strings, tuples...); value is an index into ColumnTable.objects
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# compact numeric output rounds floats to this many decimals (about 0.1 m for coordinates)
+COMPACT_DECIMALS = 6
+# csv.writer's default (excel) dialect
+CSV_LINE_TERMINATOR = '\r\n'
+
+# file formats converted tracks can be written in; parquet needs pyarrow
+OUTPUT_FORMATS = ['csv', 'parquet', 'npz']
+
+# (latitude, longitude) column pairs that censoring looks at
+COORDINATE_COLUMNS = [
+    ('latitude', 'longitude'),
+    ('position_lat', 'position_long'),
+    ('start_position_lat', 'start_position_long'),
+    ('end_position_lat', 'end_position_long'),
+]
+# appended to an output's name for its bounding box sidecar
+SIDECAR_SUFFIX = '.bbox.json'
+# ints are only stored as floats while that is exact
+MAX_EXACT_INT = 2 ** 53
+
+UTC = pytz.UTC
+
+
+class ColumnTable(object):
+    """
+    rows of a single output, stored by column
+
+    objects are shared by all columns, so cells can be copied between columns
+    by copying codes and values
+    """
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self.objects = []
+        self._object_index = {}
+        # timezone that DATETIME cells of a column are written in (see localize)
+        self.timezones = {}
+        self.clear()
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        self.n = 0
+        self.codes = {name: bytearray() for name in self.fields}
+        self.values = {name: array.array('d') for name in self.fields}
+        del self.objects[:]
+        self._object_index.clear()
+        self.timezones.clear()
+
+    def intern(self, value):
+        try:
+            key = (type(value), value)
+            index = self._object_index.get(key)
+        except TypeError:
+            key = index = None
+        if index is None:
+            index = len(self.objects)
+            self.objects.append(value)
+            if key is not None:
+                self._object_index[key] = index
+        return index
+
+    def append(self, row):
+        """
+        appends a row given as a dict; fields of the table that are not in it are missing
+        """
+        for name in self.fields:
+            codes = self.codes[name]
+            if name not in row:
+                codes.append(MISSING)
+                self.values[name].append(0.)
+                continue
+            value = row[name]
+            value_type = type(value)
+            if value is None:
+                codes.append(NONE)
+                value = 0.
+            elif value_type is int and -MAX_EXACT_INT <= value <= MAX_EXACT_INT:
+                codes.append(INT)
+            elif value_type is float:
+                codes.append(FLOAT)
+            elif (value_type is datetime.datetime and value.tzinfo is None
+                  and not value.microsecond):
+                codes.append(DATETIME)
+                value = (value - EPOCH).total_seconds()
+            else:
+                codes.append(OBJECT)
+                value = self.intern(value)
+            self.values[name].append(value)
+        self.n += 1
+
+    def column(self, name):
+        """
+        returns (codes, values) of a column as new numpy arrays
+        """
+        return (np.frombuffer(self.codes[name], dtype=np.uint8).copy(),
+                np.frombuffer(self.values[name], dtype=np.float64).copy())
+
+    def set_column(self, name, codes, values):
+        self.codes[name] = bytearray(np.asarray(codes, dtype=np.uint8).tobytes())
+        column_values = array.array('d')
+        column_values.frombytes(np.asarray(values, dtype=np.float64).tobytes())
+        self.values[name] = column_values
+
+    def localize(self, local_tz, tz_name, timestamp='timestamp',
+                 timestamp_utc='timestamp_utc', timezone='timezone'):
+        """
+        for every row with a timestamp, keeps the UTC timestamp in timestamp_utc, writes
+        the timezone name to timezone and writes the timestamp itself in local_tz
+        """
+        codes, values = self.column(timestamp)
+        has_timestamp = codes != MISSING
+        if timestamp_utc in self.codes:
+            utc_codes, utc_values = self.column(timestamp_utc)
+            utc_codes[has_timestamp] = codes[has_timestamp]
+            utc_values[has_timestamp] = values[has_timestamp]
+            self.set_column(timestamp_utc, utc_codes, utc_values)
+        if timezone in self.codes:
+            tz_codes, tz_values = self.column(timezone)
+            tz_codes[has_timestamp] = OBJECT
+            tz_values[has_timestamp] = self.intern(tz_name)
+            self.set_column(timezone, tz_codes, tz_values)
+        # timestamps with microseconds are objects (see append), localized one at a time
+        localized = False
+        for row in np.flatnonzero(codes == OBJECT).tolist():
+            value = self.objects[int(values[row])]
+            if type(value) is datetime.datetime and value.tzinfo is None:
+                values[row] = self.intern(UTC.localize(value).astimezone(local_tz))
+                localized = True
+        if localized:
+            self.set_column(timestamp, codes, values)
+        self.timezones[timestamp] = local_tz
+
+    def text_column(self, name, compact_numeric=False):
+        """
+        returns the cells of a column as strings, quoted for CSV where needed
+
+        by default a cell is str() of the value that was appended; with compact_numeric,
+        floats are rounded to COMPACT_DECIMALS first
+        """
+        codes, values = self.column(name)
+        present = np.unique(codes).tolist()
+        if present == [MISSING]:
+            return [''] * self.n
+        if len(present) == 1:
+            return self._format_cells(name, present[0], values, compact_numeric)
+        text = np.full(self.n, '', dtype=object)
+        for code in present:
+            if code == MISSING:
+                continue
+            rows = np.flatnonzero(codes == code)
+            text[rows] = self._format_cells(name, code, values[rows], compact_numeric)
+        return text.tolist()
+
+    def _format_cells(self, name, code, values, compact_numeric, quote=True):
+        if code == NONE:
+            return ['None'] * len(values)
+        elif code == INT:
+            return list(map(str, values.astype(np.int64).tolist()))
+        elif code == FLOAT:
+            if compact_numeric:
+                # + 0. turns -0. into 0.
+                values = np.round(values, COMPACT_DECIMALS) + 0.
+            return list(map(repr, values.tolist()))
+        elif code == DATETIME:
+            return format_timestamps(values, self.timezones.get(name))
+        objects = self.objects
+        if not quote:
+            return [str(objects[int(v)]) for v in values.tolist()]
+        return [csv_cell(str(objects[int(v)])) for v in values.tolist()]
+
+    def parsed_column(self, name, compact_numeric=False):
+        """
+        returns (values, unparsed): what float() makes of each cell of text_column, with
+        NaN where it raises, and where it does
+        """
+        codes, values = self.column(name)
+        if compact_numeric:
+            floats = codes == FLOAT
+            values[floats] = np.round(values[floats], COMPACT_DECIMALS) + 0.
+        unparsed = ~np.isin(codes, (INT, FLOAT))
+        for row in np.flatnonzero(codes == OBJECT).tolist():
+            try:
+                values[row] = float(str(self.objects[int(values[row])]))
+                unparsed[row] = False
+            except ValueError:
+                pass
+        values[unparsed] = np.nan
+        return values, unparsed
+
+    def write_csv(self, file, fields=None, compact_numeric=False):
+        """
+        writes the rows to an open text file, as csv.writer would
+        """
+        if not self.n:
+            return
+        if fields is None:
+            fields = self.fields
+        columns = [self.text_column(name, compact_numeric) for name in fields]
+        file.write(CSV_LINE_TERMINATOR.join(map(','.join, zip(*columns))))
+        file.write(CSV_LINE_TERMINATOR)
+
+    def bounds(self, coordinate_columns=COORDINATE_COLUMNS):
+        """
+        (min latitude, min longitude, max latitude, max longitude) over the rows where both
+        columns of a coordinate pair are numbers, or None if there are none
+        """
+        latitudes = []
+        longitudes = []
+        for latitude_name, longitude_name in coordinate_columns:
+            if latitude_name not in self.codes or longitude_name not in self.codes:
+                continue
+            latitude_codes, latitude_values = self.column(latitude_name)
+            longitude_codes, longitude_values = self.column(longitude_name)
+            valid = (np.isin(latitude_codes, (INT, FLOAT)) & np.isin(longitude_codes, (INT, FLOAT))
+                     & np.isfinite(latitude_values) & np.isfinite(longitude_values))
+            latitudes.append(latitude_values[valid])
+            longitudes.append(longitude_values[valid])
+        return array_bounds(latitudes, longitudes)
+
+    def typed_columns(self, fields=None):
+        """
+        returns (columns, timezones) for write_columns
+
+        a column of ints becomes int64, of numbers float64, of timestamps datetime64[s]
+        (UTC; timezones has the zone of localized columns) and anything else str;
+        missing and None cells are not valid
+        """
+        if fields is None:
+            fields = self.fields
+        columns = OrderedDict()
+        timezones = {}
+        for name in fields:
+            codes, values = self.column(name)
+            valid = (codes != MISSING) & (codes != NONE)
+            present = set(np.unique(codes[valid]).tolist())
+            if present and present <= {INT}:
+                values = values.astype(np.int64)
+            elif present <= {INT, FLOAT}:
+                pass
+            elif present == {DATETIME}:
+                values = values.astype(np.int64).astype('datetime64[s]')
+                if name in self.timezones:
+                    timezones[name] = self.timezones[name].zone
+            else:
+                text = np.full(self.n, '', dtype=object)
+                for code in present:
+                    rows = np.flatnonzero(codes == code)
+                    text[rows] = self._format_cells(name, code, values[rows], False, quote=False)
+                values = np.array(text.tolist(), dtype=str)
+            columns[name] = (values, valid)
+        return columns, timezones
+
+
+def csv_cell(text):
+    """
+    quotes a cell the way csv.writer does with the default dialect
+    """
+    if ',' in text or '"' in text or '\r' in text or '\n' in text:
+        return '"%s"' % text.replace('"', '""')
+    return text
+
+
+def csv_line(cells):
+    return ','.join(csv_cell(cell) for cell in cells) + CSV_LINE_TERMINATOR
+
+
+def utc_offsets(seconds, local_tz):
+    """
+    returns the UTC offset in seconds of local_tz at each of the POSIX seconds
+
+    this is what pytz's fromutc() does for a single datetime: the transition table
+    is looked up once and searched for the whole column
+    """
+    transitions = _transition_table(local_tz)
+    if transitions is None:
+        offset = local_tz.utcoffset(None) if local_tz is UTC else local_tz._utcoffset
+        return np.full(len(seconds), int(offset.total_seconds()), dtype=np.int64)
+    transition_seconds, transition_offsets = transitions
+    index = np.searchsorted(transition_seconds, seconds, side='right') - 1
+    return transition_offsets[np.maximum(index, 0)]
+
+
+# zone -> (UTC transition times as POSIX seconds, offset after each one)
+_TRANSITION_TABLES = {}
+
+def _transition_table(local_tz):
+    if not hasattr(local_tz, '_utc_transition_times'):
+        return None
+    key = local_tz.zone
+    if key not in _TRANSITION_TABLES:
+        _TRANSITION_TABLES[key] = (
+            np.array([(t - EPOCH).total_seconds() for t in local_tz._utc_transition_times]),
+            np.array([int(info[0].total_seconds()) for info in local_tz._transition_info],
+                     dtype=np.int64),
+        )
+    return _TRANSITION_TABLES[key]
+
+
+def _offset_suffix(offset):
+    # same as the tail of str() of an aware datetime
+    tzinfo = datetime.timezone(datetime.timedelta(seconds=offset))
+    return str(datetime.datetime(2000, 1, 1, tzinfo=tzinfo))[19:]
+
+
+def format_timestamps(seconds, local_tz=None):
+    """
+    formats POSIX seconds like str() of naive UTC datetimes, or like str() of the
+    datetimes converted to local_tz
+    """
+    seconds = np.asarray(seconds).astype(np.int64)
+    if local_tz is None:
+        offsets = np.zeros(len(seconds), dtype=np.int64)
+    else:
+        offsets = utc_offsets(seconds, local_tz)
+    text = np.datetime_as_string((seconds + offsets).astype('datetime64[s]')).tolist()
+    if local_tz is None:
+        return [t.replace('T', ' ') for t in text]
+    suffixes = {offset: _offset_suffix(offset) for offset in np.unique(offsets).tolist()}
+    return [t.replace('T', ' ') + suffixes[offset] for t, offset in zip(text, offsets.tolist())]
+
+
+def output_extension(output_format):
+    return '.' + output_format
+
+
+def write_columns(file, columns, output_format, timezones=None):
+    """
+    writes columns, an ordered mapping of name -> (values, valid), to an open binary file
+
+    npz files hold each column under its name and its valid mask under name + '__valid',
+    plus the column order in __fields__ and the zone of localized timestamp columns in
+    __timezones__; parquet files use nulls and timezone-aware timestamp types for the same
+    """
+    if timezones is None:
+        timezones = {}
+    if output_format == 'npz':
+        arrays = {
+            '__fields__': np.array(list(columns), dtype=str),
+            '__timezones__': np.array([timezones.get(name, '') for name in columns], dtype=str),
+        }
+        for name, (values, valid) in columns.items():
+            arrays[name] = values
+            arrays[name + '__valid'] = valid
+        np.savez_compressed(file, **arrays)
+    elif output_format == 'parquet':
+        import pyarrow
+        import pyarrow.parquet
+
+        arrays = []
+        for name, (values, valid) in columns.items():
+            if name in timezones:
+                arrays.append(pyarrow.array(values, mask=~valid,
+                                            type=pyarrow.timestamp('s', tz=timezones[name])))
+            else:
+                arrays.append(pyarrow.array(values, mask=~valid))
+        table = pyarrow.Table.from_arrays(arrays, names=list(columns))
+        pyarrow.parquet.write_table(table, file, compression='zstd')
+    else:
+        raise ValueError('cannot write columns as %s' % output_format)
+
+
+def read_columns(path):
+    """
+    reads a file written by write_columns; returns (columns, timezones)
+    """
+    columns = OrderedDict()
+    timezones = {}
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            for name, timezone in zip(data['__fields__'].tolist(), data['__timezones__'].tolist()):
+                columns[name] = (data[name], data[name + '__valid'])
+                if timezone:
+                    timezones[name] = timezone
+    elif path.endswith('.parquet'):
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+
+        table = pyarrow.parquet.read_table(path)
+        for name in table.column_names:
+            column = table.column(name)
+            valid = ~column.is_null().to_numpy(zero_copy_only=False)
+            if pyarrow.types.is_timestamp(column.type):
+                if column.type.tz is not None:
+                    timezones[name] = column.type.tz
+                column = column.cast(pyarrow.timestamp('s', tz=column.type.tz))
+                fill = pyarrow.scalar(0, type=column.type)
+            elif pyarrow.types.is_string(column.type) or pyarrow.types.is_large_string(column.type):
+                fill = ''
+            else:
+                fill = 0
+            values = pyarrow.compute.fill_null(column, fill).to_numpy(zero_copy_only=False)
+            if values.dtype == object:
+                values = values.astype(str)
+            columns[name] = (values, valid)
+    else:
+        raise ValueError('cannot read columns from %s' % path)
+    return columns, timezones
+
+
+def array_bounds(latitudes, longitudes):
+    """
+    bounding box of lists of coordinate arrays, as returned by ColumnTable.bounds
+    """
+    latitudes = np.concatenate(latitudes) if latitudes else np.zeros(0)
+    longitudes = np.concatenate(longitudes) if longitudes else np.zeros(0)
+    if not len(latitudes):
+        return None
+    return (float(latitudes.min()), float(longitudes.min()),
+            float(latitudes.max()), float(longitudes.max()))
+
+
+def merge_bounds(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def write_sidecar(path, rows, bounds):
+    """
+    records the row count and coordinate bounding box of the finished output at path
+
+    the output's size and mtime are kept too, so a sidecar is ignored once its output changes
+    """
+    stat = os.stat(path)
+    sidecar = {
+        'rows': rows,
+        'bbox': list(bounds) if bounds is not None else None,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+    }
+    with open(path + SIDECAR_SUFFIX, 'w') as f:
+        json.dump(sidecar, f)
+
+
+def read_sidecar(path):
+    """
+    returns the sidecar of the output at path, or None if there is none or it is stale
+    """
+    try:
+        with open(path + SIDECAR_SUFFIX, 'r') as f:
+            sidecar = json.load(f)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if sidecar.get('size') != stat.st_size or sidecar.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return sidecar